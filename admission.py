@@ -0,0 +1,177 @@
+'''
+Admission control: rate limits on clients and upstream hosts, checked
+before any upstream work is done for a request.
+'''
+
+from collections import OrderedDict
+from stats import Counters, monotonic
+
+import logging
+import threading
+import time
+
+from constants import *
+
+logger = logging.getLogger('laeproxy')
+
+
+class _Bucket(object):
+    __slots__ = ('requests', 'bytes', 'updated', 'blocked', 'synced', 'unsynced_requests', 'unsynced_bytes')
+
+    def __init__(self, requests, nbytes, now):
+        self.requests = requests
+        self.bytes = nbytes
+        self.updated = now
+        self.blocked = 0 # refused until then, when over limits across instances
+        self.synced = now
+        self.unsynced_requests = 0
+        self.unsynced_bytes = 0
+
+
+class RateLimiter(object):
+    '''
+    Token buckets counting requests and bytes per key, e.g. per client
+    address or per upstream host.
+
+    Each key has a request bucket holding up to reqburst tokens, refilled at
+    reqrate per second, and a byte bucket holding up to byteburst, refilled
+    at byterate. admit takes request tokens. How many bytes a request costs
+    is only known afterwards, so charge takes them out regardless, and a key
+    whose byte bucket has run into debt is refused until it's paid off. A
+    rate of None means no limit.
+
+    Buckets are kept for up to maxkeys recently seen keys, spread over
+    nstripes separately locked stripes so that requests for different keys
+    rarely wait on each other.
+
+    If client (a memcache client) is passed, what each key was admitted and
+    charged is also added up across instances in memcache, in fixed windows
+    of window seconds, at most every interval seconds per key. A key found
+    over its limits for the window is refused until the window ends.
+    '''
+
+    def __init__(self, reqrate, reqburst, byterate=None, byteburst=None, maxkeys=ADMISSION_MAX_KEYS,
+            nstripes=ADMISSION_STRIPES, client=None, namespace=ADMISSION_MEMCACHE_NAMESPACE,
+            window=ADMISSION_MEMCACHE_WINDOW, interval=ADMISSION_MEMCACHE_INTERVAL,
+            clock=monotonic, wallclock=time.time):
+        self.reqrate = reqrate
+        self.reqburst = reqburst
+        self.byterate = byterate
+        self.byteburst = byteburst
+        self.maxkeys = max(1, maxkeys // nstripes) # per stripe
+        self.client = client
+        self.namespace = namespace
+        self.window = window
+        self.interval = interval
+        self.clock = clock
+        self.wallclock = wallclock
+        self._stripes = [(threading.Lock(), OrderedDict()) for i in range(nstripes)]
+        self.counters = Counters()
+
+    def _bucket(self, buckets, key, now):
+        bucket = buckets.pop(key, None)
+        if bucket is None:
+            bucket = _Bucket(self.reqburst or 0, self.byteburst or 0, now)
+        else:
+            self._refill(bucket, now)
+        buckets[key] = bucket
+        while len(buckets) > self.maxkeys:
+            buckets.popitem(last=False)
+        return bucket
+
+    def _refill(self, bucket, now):
+        elapsed = now - bucket.updated
+        if self.reqrate:
+            bucket.requests = min(self.reqburst, bucket.requests + elapsed * self.reqrate)
+        if self.byterate:
+            bucket.bytes = min(self.byteburst, bucket.bytes + elapsed * self.byterate)
+        bucket.updated = now
+
+    def _wait(self, bucket, cost, now):
+        wait = bucket.blocked - now
+        if self.reqrate and bucket.requests < cost:
+            wait = max(wait, (cost - bucket.requests) / float(self.reqrate))
+        if self.byterate and bucket.bytes < 0:
+            wait = max(wait, -bucket.bytes / float(self.byterate))
+        return wait
+
+    def admit(self, key, cost=1):
+        '''
+        Takes cost request tokens for key. Returns 0 if the request may go
+        ahead, otherwise the seconds until it would be let through.
+        '''
+        lock, buckets = self._stripes[hash(key) % len(self._stripes)]
+        now = self.clock()
+        sync = None
+        with lock:
+            bucket = self._bucket(buckets, key, now)
+            wait = self._wait(bucket, cost, now)
+            if wait <= 0:
+                bucket.requests -= cost
+                if self.client is not None:
+                    bucket.unsynced_requests += cost
+                    if now >= bucket.synced + self.interval:
+                        sync = bucket.unsynced_requests, bucket.unsynced_bytes
+                        bucket.synced = now
+                        bucket.unsynced_requests = bucket.unsynced_bytes = 0
+        if wait > 0:
+            self.counters.incr('refused')
+            return wait
+        self.counters.incr('admitted')
+        if sync:
+            self._sync(lock, bucket, key, *sync)
+        return 0
+
+    def charge(self, key, nbytes):
+        '''
+        Takes nbytes out of key's byte bucket.
+        '''
+        if not nbytes or not (self.byterate or self.client is not None):
+            return
+        lock, buckets = self._stripes[hash(key) % len(self._stripes)]
+        with lock:
+            bucket = self._bucket(buckets, key, self.clock())
+            bucket.bytes -= nbytes
+            if self.client is not None:
+                bucket.unsynced_bytes += nbytes
+        self.counters.incr('bytes_charged', nbytes)
+
+    def _sync(self, lock, bucket, key, requests, nbytes):
+        '''
+        Adds what key was admitted and charged since the last sync to its
+        counts for the current window in memcache, and blocks it for the rest
+        of the window if they're over its limits.
+        '''
+        wallnow = self.wallclock()
+        rkey, bkey = 'r:%s' % key, 'b:%s' % key
+        deltas = dict((k, n) for k, n in ((rkey, requests), (bkey, nbytes)) if n)
+        try:
+            totals = self.client.offset_multi(deltas, key_prefix='%d:' % (wallnow // self.window),
+                namespace=self.namespace, initial_value=0) or {}
+        except Exception as e:
+            self.counters.incr('sync_failed')
+            logger.warn('Adding up admissions for %s in memcache failed: %r', key, e)
+            return
+        over = ((self.reqrate and (totals.get(rkey) or 0) > self.reqrate * self.window + self.reqburst) or
+            (self.byterate and (totals.get(bkey) or 0) > self.byterate * self.window + self.byteburst))
+        if not over:
+            return
+        left = self.window - wallnow % self.window
+        with lock:
+            bucket.blocked = self.clock() + left
+        self.counters.incr('blocked_shared')
+        logger.warn('%s over its rate limits across instances, refusing it for %ds', key, left)
+
+    def stats(self):
+        stats = self.counters.snapshot()
+        now = self.clock()
+        keys = limited = 0
+        for lock, buckets in self._stripes:
+            with lock:
+                keys += len(buckets)
+                for bucket in buckets.values():
+                    self._refill(bucket, now)
+                    limited += self._wait(bucket, 1, now) > 0
+        stats['keys'] = keys
+        stats['limited_keys'] = limited
+        return stats
@@ -0,0 +1,579 @@
+'''
+ASGI entry point for running laeproxy outside App Engine on asyncio
+(python 3.7+), for deployments holding many mostly idle connections to
+slow upstream servers, where a thread per request, as with wsgi.py, costs
+too much memory and context switching. Runs under any ASGI server, e.g.::
+
+    uvicorn asgi:application --workers 4
+
+Requests are validated, filtered and ranged like LaeproxyHandler does
+(validate.py, ranges.py), fetched without blocking over keep-alive
+connections pooled per upstream host (AsyncUpstream), and their bodies
+streamed through as they arrive. The response caches, coalescing,
+H_FANOUT and the batch and stats routes are only in the WSGI app.
+'''
+
+from backend import DownloadError, Headers, HostNotFoundError, InvalidURLError, OverQuotaError
+from binascii import hexlify
+from os import urandom
+from ranges import extract, format_content_range, multipart_byteranges, parse_content_range, parse_range
+from stats import Counters
+from urllib.parse import quote, urlsplit
+from validate import (Rejected, absolute_location, check_payload, check_ranges, conn_header_set, copy_headers,
+    error_result, now, strip_headers, target_url)
+
+import asyncio
+import logging
+import ssl
+
+from constants import *
+
+logger = logging.getLogger('laeproxy')
+
+BODYLESS_STATUSES = frozenset({204, 304})
+
+
+class UpstreamResponse(object):
+    '''
+    An upstream response whose status and headers have arrived, and whose
+    body is read incrementally with read, within the deadline of the
+    request. Must be closed once done with, which returns the connection
+    to the pool if the body was read to the end.
+    '''
+
+    def __init__(self, upstream, key, reader, writer, version, status, headers, bodyless, giveup, url):
+        self.status_code = status
+        self.headers = headers
+        self._upstream = upstream
+        self._key = key
+        self._reader = reader
+        self._writer = writer
+        self._giveup = giveup
+        self._url = url
+        self._chunked = not bodyless and 'chunked' in headers.get('transfer-encoding', '').lower()
+        self._chunkleft = 0
+        if bodyless:
+            self._remaining = 0
+        elif self._chunked:
+            self._remaining = None
+        elif 'content-length' in headers:
+            self._remaining = int(headers['content-length'])
+        else:
+            self._remaining = -1 # until the server closes the connection
+        self.length = self._remaining if self._remaining is not None and self._remaining >= 0 else None
+        self._keepalive = version == 'HTTP/1.1' and self._remaining != -1 and \
+            'close' not in conn_header_set(headers)
+        self.eof = self._remaining == 0
+
+    async def read(self, n=STREAM_BUFSIZE):
+        '''
+        Returns up to n bytes of the body, or b'' at its end. Raises
+        DownloadError if that takes us past the deadline or fails.
+        '''
+        if self.eof:
+            self.close()
+            return b''
+        loop = asyncio.get_running_loop()
+        try:
+            chunk = await asyncio.wait_for(self._read(n), self._giveup - loop.time())
+        except asyncio.TimeoutError:
+            self._fail()
+            raise DownloadError('Deadline exceeded reading response from %s' % self._url)
+        except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+            self._fail()
+            raise DownloadError('Error reading response from %s: %r' % (self._url, e))
+        if self.eof:
+            self.close()
+        return chunk
+
+    async def _read(self, n):
+        reader = self._reader
+        if self._chunked:
+            if not self._chunkleft:
+                size = int((await reader.readline()).split(b';', 1)[0], 16)
+                if not size:
+                    while (await reader.readline()).strip(): # trailers
+                        pass
+                    self.eof = True
+                    return b''
+                self._chunkleft = size
+            chunk = await reader.read(min(n, self._chunkleft))
+            if not chunk:
+                raise asyncio.IncompleteReadError(chunk, self._chunkleft)
+            self._chunkleft -= len(chunk)
+            if not self._chunkleft:
+                await reader.readexactly(2)
+            return chunk
+        if self._remaining < 0:
+            chunk = await reader.read(n)
+            self.eof = not chunk
+            return chunk
+        chunk = await reader.read(min(n, self._remaining))
+        if not chunk:
+            raise asyncio.IncompleteReadError(chunk, self._remaining)
+        self._remaining -= len(chunk)
+        self.eof = not self._remaining
+        return chunk
+
+    async def content(self, maxbytes=URLFETCH_RES_MAXBYTES):
+        '''
+        Reads the rest of the body, up to maxbytes. Returns it and whether
+        it was truncated.
+        '''
+        chunks = []
+        nbytes = 0
+        while nbytes <= maxbytes:
+            chunk = await self.read(min(STREAM_BUFSIZE, maxbytes + 1 - nbytes))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            nbytes += len(chunk)
+        self.close()
+        return b''.join(chunks)[:maxbytes], nbytes > maxbytes
+
+    def _fail(self):
+        self._keepalive = False
+        self.close()
+
+    def close(self):
+        writer, self._writer = self._writer, None
+        if writer is None:
+            return
+        if self.eof and self._keepalive:
+            self._upstream._release(self._key, self._reader, writer)
+        else:
+            writer.close()
+
+
+class AsyncUpstream(object):
+    '''
+    Non-blocking HTTP/1.1 client for upstream servers, keeping up to
+    maxidle idle connections per (scheme, host, port) for up to idlesecs.
+    Like PooledBackend.fetch_stream, open doesn't follow redirects, bounds
+    the whole fetch including reading the body by deadline, and raises
+    DownloadError or InvalidURLError.
+    '''
+
+    def __init__(self, maxidle=POOL_MAXIDLE_PER_HOST, idlesecs=POOL_IDLE_SECS):
+        self.maxidle = maxidle
+        self.idlesecs = idlesecs
+        self._idle = {} # pool key -> [(reader, writer, idle since)], most recent last
+        self._context = ssl.create_default_context()
+        self.counters = Counters()
+
+    async def _connection(self, key):
+        now = asyncio.get_running_loop().time()
+        idle = self._idle.get(key, [])
+        while idle:
+            reader, writer, since = idle.pop()
+            if now - since < self.idlesecs and not reader.at_eof() and not writer.is_closing():
+                self.counters.incr('connections_reused')
+                return reader, writer, True
+            writer.close()
+        scheme, host, port = key
+        if scheme == 'https':
+            reader, writer = await asyncio.open_connection(host, port, ssl=self._context, server_hostname=host)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        self.counters.incr('connections_opened')
+        return reader, writer, False
+
+    def _release(self, key, reader, writer):
+        idle = self._idle.setdefault(key, [])
+        idle.append((reader, writer, asyncio.get_running_loop().time()))
+        while len(idle) > self.maxidle:
+            idle.pop(0)[1].close()
+
+    def close(self):
+        for idle in self._idle.values():
+            for reader, writer, since in idle:
+                writer.close()
+        self._idle.clear()
+
+    async def open(self, url, payload=None, method='GET', headers={}, deadline=URLFETCH_REQ_MAXSECS):
+        '''
+        Sends a request and returns an UpstreamResponse as soon as the
+        response headers have arrived.
+        '''
+        try:
+            parts = urlsplit(url)
+            scheme, host = parts.scheme.lower(), parts.hostname
+            port = parts.port or (443 if scheme == 'https' else 80)
+        except ValueError:
+            raise InvalidURLError(url)
+        if scheme not in ('http', 'https') or not host:
+            raise InvalidURLError(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        key = scheme, host, port
+        method = method.upper()
+        head = ['%s %s HTTP/1.1' % (method, path), 'Host: %s' % parts.netloc]
+        # the payload is framed by the Content-Length we add, not the client's
+        head.extend('%s: %s' % (k, v) for k, v in headers.items() if k.lower() not in ('content-length', 'transfer-encoding'))
+        if payload is not None:
+            head.append('Content-Length: %d' % len(payload))
+        head = ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1')
+
+        loop = asyncio.get_running_loop()
+        giveup = loop.time() + deadline
+        retried = False
+        while True:
+            reused = False
+            writer = None
+            try:
+                reader, writer, reused = await asyncio.wait_for(self._connection(key), giveup - loop.time())
+                writer.write(head)
+                if payload:
+                    writer.write(payload)
+                version, status, fheaders = await asyncio.wait_for(self._read_head(reader), giveup - loop.time())
+                break
+            except asyncio.TimeoutError:
+                writer and writer.close()
+                self.counters.incr('errors')
+                raise DownloadError('Deadline exceeded fetching %s' % url)
+            except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+                writer and writer.close()
+                # keep-alive connections may have been closed by the server
+                # since we last used them
+                if reused and method in RETRYABLE_METHODS and not retried:
+                    logger.debug('Retrying %s on a new connection after %r', url, e)
+                    self.counters.incr('retries')
+                    retried = True
+                    continue
+                self.counters.incr('errors')
+                raise DownloadError('Error fetching %s: %r' % (url, e))
+        bodyless = method == 'HEAD' or status in BODYLESS_STATUSES
+        return UpstreamResponse(self, key, reader, writer, version, status, fheaders, bodyless, giveup, url)
+
+    async def _read_head(self, reader):
+        while True:
+            line = await reader.readuntil(b'\r\n')
+            version, status = line.decode('latin-1').split(None, 2)[:2]
+            status = int(status)
+            fheaders = Headers()
+            while True:
+                line = (await reader.readuntil(b'\r\n')).decode('latin-1')
+                if line == '\r\n':
+                    break
+                k, v = line.split(':', 1)
+                k, v = k.strip(), v.strip()
+                fheaders.add(k, v)
+            if status >= 200: # skip 100 Continue and friends
+                return version, status, fheaders
+
+    def stats(self):
+        stats = self.counters.snapshot()
+        stats['idle_connections'] = sum(len(i) for i in self._idle.values())
+        return stats
+
+
+def fetch_error(url, e, host=None):
+    '''
+    Returns the status code and H_LAEPROXY_RESULT to respond with when
+    fetching url from host raised e, like laeproxy.fetch_error.
+    '''
+    return error_result(url, e, host, InvalidURLError, HostNotFoundError, DownloadError, OverQuotaError)
+
+
+def request_headers(scope):
+    headers = Headers()
+    for k, v in scope['headers']:
+        k, v = k.decode('latin-1'), v.decode('latin-1')
+        headers.add(k, v)
+    return headers
+
+
+class Proxy(object):
+    '''
+    The ASGI application. One instance serves all of a process's requests
+    from its event loop.
+    '''
+
+    def __init__(self, upstream=None):
+        self.upstream = upstream or AsyncUpstream()
+        self.traffic = Counters()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    self.upstream.close()
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            return
+        method = scope['method'].lower()
+        self.traffic.incr(('requests', method))
+        status = await self._handle(method, scope, receive, send)
+        self.traffic.incr(('responses', '%dxx' % (status // 100)))
+
+    async def _respond(self, send, status, resheaders, body=b'', more=False):
+        '''
+        Sends the status and headers, and body if passed. Returns status.
+        '''
+        resheaders[H_LAEPROXY_VER] = LAEPROXY_VERSION
+        if not more:
+            resheaders['Content-Length'] = str(len(body))
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(k.encode('latin-1'), str(v).encode('latin-1')) for k, v in resheaders.items()],
+            })
+        if not more:
+            await send({'type': 'http.response.body', 'body': body})
+        return status
+
+    async def _read_payload(self, receive):
+        payload = bytearray()
+        while True:
+            message = await receive()
+            payload += message.get('body', b'')
+            check_payload(payload)
+            if not message.get('more_body'):
+                return bytes(payload)
+
+    async def _handle(self, method, scope, receive, send):
+        resheaders = Headers()
+        path = scope.get('raw_path') or quote(scope['path']).encode('latin-1')
+        path_qs = path.decode('latin-1')
+        if scope.get('query_string'):
+            path_qs += '?' + scope['query_string'].decode('latin-1')
+        reqheaders = request_headers(scope)
+        if method not in METHODS:
+            return await self._respond(send, 405, resheaders)
+        if not path_qs.startswith(('/http/', '/https/')):
+            return await self._respond(send, 404, resheaders)
+        rangemethod = method in RANGE_METHODS
+
+        try:
+            url, scheme, host = target_url(path_qs, reqheaders.get('host', ''))
+            payload = await self._read_payload(receive) if method in PAYLOAD_METHODS else None
+            ignored = strip_headers(reqheaders)
+            ignored and logger.debug('Stripped request headers: %s', ignored)
+            if rangemethod:
+                ranges = check_ranges(parse_range(reqheaders.get('range')))[0]
+        except Rejected as e:
+            resheaders[H_LAEPROXY_RESULT] = e.result
+            return await self._respond(send, e.status, resheaders)
+
+        if rangemethod and len(ranges) > 1:
+            return await self._send_multipart(send, url, reqheaders, ranges, resheaders)
+
+        try:
+            fetched = await self.upstream.open(url, payload, method, reqheaders)
+        except (DownloadError, InvalidURLError) as e:
+            self.traffic.incr(('errors', type(e).__name__))
+            status, resheaders[H_LAEPROXY_RESULT] = fetch_error(url, e, host)
+            return await self._respond(send, status, resheaders)
+
+        try:
+            status = fetched.status_code
+            fheaders = fetched.headers
+            resheaders[H_LAEPROXY_RESULT] = RETRIEVED_FROM_NET % now()
+            resheaders[H_UPSTREAM_STATUS_CODE] = str(status)
+            resheaders[H_UPSTREAM_SERVER] = fheaders.get('server', '')
+
+            # correct invalid relative Location header (#14)
+            loc = fheaders.get('location', '')
+            absloc = absolute_location(loc, scheme, host)
+            if absloc:
+                logger.debug('Detected relative Location header, adjusting: %s -> %s', loc, absloc)
+                fheaders['location'] = absloc
+            ignoreheaders = conn_header_set(fheaders) | HOPBYHOP | {'content-length'}
+
+            if rangemethod and status in (200, 206):
+                range_start, range_end = ranges[0]
+                sent = await self._send_range(send, fetched, resheaders, ignoreheaders, range_start, range_end)
+                if sent:
+                    return sent
+
+            if status == 206:
+                resheaders[H_UPSTREAM_CONTENT_RANGE] = fheaders.get('content-range', '')
+            copy_headers(fheaders, resheaders, ignoreheaders)
+            if method == 'head':
+                if 'content-length' in fheaders:
+                    resheaders['Content-Length'] = fheaders['content-length']
+                await self._respond(send, status, resheaders, more=True)
+                await send({'type': 'http.response.body', 'body': b''})
+                return status
+            if fetched.length is not None:
+                resheaders['Content-Length'] = str(fetched.length)
+            await self._respond(send, status, resheaders, more=True)
+            await self._pipe(send, fetched, url, 0, fetched.length)
+            return status
+        finally:
+            fetched.close()
+
+    async def _send_range(self, send, fetched, resheaders, ignoreheaders, range_start, range_end):
+        '''
+        Responds to a single range request with a 206 for the part of a 200
+        or 206 upstream response that covers it, streamed through if its
+        length is known up front. Returns None if the response doesn't
+        cover range_start, and nothing was sent.
+        '''
+        status = fetched.status_code
+        fheaders = fetched.headers
+        if status == 206:
+            crange = resheaders[H_UPSTREAM_CONTENT_RANGE] = fheaders.get('content-range', '')
+            try:
+                offset, end, total = parse_content_range(crange)
+            except ValueError as e:
+                logger.warning('Error parsing upstream Content-Range %r: %r, returning 206 response as-is', crange, e)
+                return None
+        elif fetched.length is not None:
+            offset, total = 0, fetched.length
+            end = total - 1
+        else:
+            # no length up front, so buffer it like the WSGI app would
+            try:
+                content, truncated = await fetched.content()
+            except DownloadError as e:
+                self.traffic.incr(('errors', type(e).__name__))
+                status, resheaders[H_LAEPROXY_RESULT] = fetch_error(fetched._url, e)
+                return await self._respond(send, status, resheaders)
+            if truncated:
+                resheaders[H_TRUNCATED] = 'true'
+                copy_headers(fheaders, resheaders, ignoreheaders)
+                return await self._respond(send, status, resheaders, content)
+            try:
+                start, end, total, body = extract(status, fheaders, content, range_start, range_end)
+            except ValueError:
+                resheaders['Content-Range'] = 'bytes */%d' % len(content)
+                resheaders[H_LAEPROXY_RESULT] = 'Requested range not satisfiable'
+                return await self._respond(send, 416, resheaders)
+            resheaders['Content-Range'] = format_content_range(start, end, total)
+            copy_headers(fheaders, resheaders, ignoreheaders | {'content-range'})
+            return await self._respond(send, 206, resheaders, bytes(body))
+        if not offset <= range_start <= end:
+            if status == 206:
+                return None
+            resheaders['Content-Range'] = 'bytes */%d' % total
+            resheaders[H_LAEPROXY_RESULT] = 'Requested range not satisfiable'
+            return await self._respond(send, 416, resheaders)
+        last = min(range_end, end)
+        nbytes = last - range_start + 1
+        resheaders['Content-Range'] = format_content_range(range_start, last, total)
+        resheaders['Content-Length'] = str(nbytes)
+        copy_headers(fheaders, resheaders, ignoreheaders | {'content-range'})
+        await self._respond(send, 206, resheaders, more=True)
+        await self._pipe(send, fetched, fetched._url, range_start - offset, nbytes)
+        return 206
+
+    async def _pipe(self, send, fetched, url, skip, nbytes):
+        '''
+        Sends nbytes of fetched's body, or all of it if None, after
+        skipping the first skip bytes. If upstream sends less than
+        promised, raises DownloadError after sending what it did send, for
+        the server to drop the connection: the length was sent up front,
+        so this is the only way left to tell the client.
+        '''
+        sent = 0
+        while skip > 0:
+            chunk = await fetched.read(min(skip, STREAM_BUFSIZE))
+            if not chunk:
+                break
+            skip -= len(chunk)
+        while nbytes is None or sent < nbytes:
+            chunk = await fetched.read(STREAM_BUFSIZE if nbytes is None else min(nbytes - sent, STREAM_BUFSIZE))
+            if not chunk:
+                break
+            sent += len(chunk)
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        self.traffic.incr('bytes_to_client', sent)
+        if nbytes is not None and sent < nbytes:
+            logger.warning('Upstream response for %s ended %d bytes short', url, nbytes - sent)
+            self.traffic.incr('streams_cut_short')
+            raise DownloadError('Upstream response for %s ended %d bytes short' % (url, nbytes - sent))
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def _fetch_part(self, url, reqheaders, start, end):
+        headers = Headers(reqheaders.items())
+        headers['Range'] = 'bytes=%d-%d' % (start, end)
+        fetched = await self.upstream.open(url, None, 'GET', headers)
+        content, truncated = await fetched.content()
+        return fetched.status_code, fetched.headers, content, truncated
+
+    async def _send_multipart(self, send, url, reqheaders, ranges, resheaders):
+        '''
+        Responds to a request for multiple ranges with a multipart/byteranges
+        206, like LaeproxyHandler._send_multipart. The first range is fetched
+        on its own: if upstream answers it with the entire entity, the rest
+        of the parts are cut from that, otherwise they are fetched
+        concurrently.
+        '''
+        async def fetch(some):
+            return await asyncio.gather(*[self._fetch_part(url, reqheaders, start, end)
+                for start, end in some], return_exceptions=True)
+
+        fetched = await fetch(ranges[:1])
+        resheaders[H_LAEPROXY_RESULT] = RETRIEVED_FROM_NET % now()
+        whole = None # (status, headers, content) of the entire entity
+        parts = []
+        fheaders = total = None
+        for i, (start, end) in enumerate(ranges):
+            if whole:
+                status, headers, content = whole
+            else:
+                if i == len(fetched):
+                    fetched += await fetch(ranges[i:])
+                result = fetched[i]
+                if isinstance(result, (DownloadError, InvalidURLError)):
+                    self.traffic.incr(('errors', type(result).__name__))
+                    status, resheaders[H_LAEPROXY_RESULT] = fetch_error(url, result)
+                    return await self._respond(send, status, resheaders)
+                if isinstance(result, Exception):
+                    raise result
+                status, headers, content, truncated = result
+                if truncated:
+                    logger.warning('Part %d-%d of %s truncated', start, end, url)
+                    resheaders[H_LAEPROXY_RESULT] = 'Upstream response truncated for range %d-%d' % (start, end)
+                    return await self._respond(send, 502, resheaders)
+                if status == 416:
+                    continue
+                if not 200 <= status < 300:
+                    logger.debug('Upstream answered part %d-%d with %d, returning it as-is', start, end, status)
+                    resheaders[H_UPSTREAM_STATUS_CODE] = str(status)
+                    resheaders[H_UPSTREAM_SERVER] = headers.get('server', '')
+                    copy_headers(headers, resheaders, conn_header_set(headers) | HOPBYHOP | {'content-length'})
+                    self.traffic.incr('bytes_to_client', len(content))
+                    return await self._respond(send, status, resheaders, content)
+                if status == 200:
+                    logger.debug('Upstream ignored Range, cutting the remaining parts from the entire entity')
+                    whole = status, headers, content
+            try:
+                part = extract(status, headers, content, start, end)
+            except ValueError as e:
+                if status == 200 and start >= len(content):
+                    continue
+                logger.warning('Part %d-%d of %s invalid: %s', start, end, url, e)
+                resheaders[H_UPSTREAM_STATUS_CODE] = str(status)
+                resheaders[H_LAEPROXY_RESULT] = 'Invalid upstream response for range %d-%d: %s' % (start, end, e)
+                return await self._respond(send, 502, resheaders)
+            fheaders = fheaders or headers
+            total = total or part[2]
+            parts.append(part)
+        if not parts:
+            if total is not None:
+                resheaders['Content-Range'] = 'bytes */%d' % total
+            resheaders[H_LAEPROXY_RESULT] = 'No requested range satisfiable'
+            return await self._respond(send, 416, resheaders)
+
+        boundary = hexlify(urandom(16)).decode('ascii')
+        body = multipart_byteranges(parts, fheaders.get('content-type'), boundary)
+        resheaders[H_UPSTREAM_STATUS_CODE] = '200' if whole else '206'
+        resheaders[H_UPSTREAM_SERVER] = fheaders.get('server', '')
+        ignoreheaders = conn_header_set(fheaders) | HOPBYHOP | {'age', 'content-length', 'content-range', 'content-type'}
+        copy_headers(fheaders, resheaders, ignoreheaders)
+        resheaders['Content-Type'] = 'multipart/byteranges; boundary=%s' % boundary
+        self.traffic.incr('bytes_to_client', len(body))
+        return await self._respond(send, 206, resheaders, bytes(body))
+
+    def stats(self):
+        return {'traffic': self.traffic.snapshot(), 'upstream': self.upstream.stats()}
+
+
+application = Proxy()
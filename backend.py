@@ -0,0 +1,481 @@
+'''
+Upstream fetch backends for laeproxy.
+
+laeproxy talks to upstream servers through a backend's fetch, fetch_async
+and wait_any, and recognizes its DownloadError and InvalidURLError. On App
+Engine these are urlfetch's (UrlfetchBackend). Elsewhere, PooledBackend
+provides the same semantics over keep-alive connections kept in per-host
+pools, reusing TLS sessions when reconnecting.
+
+Backends that can read response bodies incrementally also provide
+fetch_stream, returning a StreamingResult. Backends whose wait_any takes a
+timeout set timed_wait, which hedged fetches need (see upstream.Hedger),
+and those whose rpcs may be waited for by requests other than the one that
+made them set detached (see upstream.Prefetcher).
+'''
+
+from stats import Counters
+
+try:
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib.parse import urljoin, urlsplit
+except ImportError: # python 2
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
+    from urlparse import urljoin, urlsplit
+
+import logging
+import socket
+import ssl
+import threading
+import time
+
+from constants import *
+
+logger = logging.getLogger('laeproxy')
+
+# SSLSocket.session is python 3.6+
+TLS_SESSIONS = hasattr(ssl.SSLSocket, 'session')
+
+
+class DownloadError(Exception):
+    pass
+
+
+class InvalidURLError(Exception):
+    pass
+
+
+class ResponseTooLargeError(DownloadError):
+    pass
+
+
+class HostNotFoundError(DownloadError):
+    '''
+    The upstream host name didn't resolve. urlfetch doesn't tell these
+    apart from other DownloadErrors.
+    '''
+
+
+class DeadlineExceededError(BaseException):
+    '''
+    Stands in for google.appengine.runtime.DeadlineExceededError, which
+    nothing raises outside App Engine.
+    '''
+
+
+class OverQuotaError(Exception):
+    '''
+    Stands in for google.appengine.runtime.apiproxy_errors.OverQuotaError.
+    '''
+
+
+class Headers(dict):
+    '''
+    Case-insensitive dict of response headers, like urlfetch's.
+    '''
+
+    def __init__(self, items=()):
+        dict.__init__(self)
+        self._names = {}
+        for k, v in items:
+            self[k] = v
+
+    def __setitem__(self, k, v):
+        name = self._names.setdefault(k.lower(), k)
+        if name != k:
+            dict.__delitem__(self, name)
+            self._names[k.lower()] = k
+        dict.__setitem__(self, k, v)
+
+    def __getitem__(self, k):
+        return dict.__getitem__(self, self._names[k.lower()])
+
+    def add(self, k, v):
+        '''
+        Sets header k to v, or appends v if k is already set, joining
+        repeated headers with commas as urlfetch does.
+        '''
+        self[k] = self[k] + ', ' + v if k in self else v
+
+    def __delitem__(self, k):
+        dict.__delitem__(self, self._names.pop(k.lower()))
+
+    def __contains__(self, k):
+        return k.lower() in self._names
+
+    has_key = __contains__
+
+    def get(self, k, default=None):
+        return self[k] if k in self else default
+
+    def pop(self, k, *default):
+        if k in self:
+            v = self[k]
+            del self[k]
+            return v
+        if default:
+            return default[0]
+        raise KeyError(k)
+
+
+class FetchResult(object):
+    '''
+    Result of a fetch, with the attributes of urlfetch's _URLFetchResult
+    that laeproxy uses.
+    '''
+
+    def __init__(self, status_code, headers, content, content_was_truncated, final_url=None):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.content_was_truncated = content_was_truncated
+        self.final_url = final_url
+
+
+class StreamingResult(object):
+    '''
+    An upstream response whose status and headers have arrived, and whose
+    body is read incrementally with read. Must be closed once done with.
+    '''
+
+    def __init__(self, backend, key, conn, response, url, giveup):
+        self.status_code = response.status
+        self.headers = Headers()
+        for k, v in response.getheaders():
+            self.headers.add(k, v)
+        self.eof = False
+        self._backend = backend
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self._url = url
+        self._giveup = giveup
+
+    def read(self, n=POOL_READ_SIZE):
+        '''
+        Returns up to n bytes of the body, or b'' at its end. Raises
+        DownloadError if that takes us past the deadline or fails.
+        '''
+        try:
+            remaining = self._giveup - time.time()
+            if remaining <= 0:
+                raise socket.timeout('deadline exceeded')
+            self._conn.sock and self._conn.sock.settimeout(remaining)
+            chunk = self._response.read(n)
+        except (HTTPException, socket.error, ssl.SSLError) as e:
+            self.close()
+            self._backend.counters.incr('errors')
+            raise DownloadError('Error reading response from %s: %r' % (self._url, e))
+        # httplib closes the response once Content-Length bytes are read
+        self.eof = not chunk or self._response.isclosed()
+        return chunk
+
+    def result(self, maxbytes=URLFETCH_RES_MAXBYTES, allow_truncated=True):
+        '''
+        Reads the rest of the body, up to maxbytes, and returns it as a
+        FetchResult.
+        '''
+        chunks = []
+        nbytes = 0
+        while nbytes <= maxbytes:
+            chunk = self.read(min(POOL_READ_SIZE, maxbytes + 1 - nbytes))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            nbytes += len(chunk)
+        self.close()
+        content = b''.join(chunks)
+        truncated = nbytes > maxbytes
+        if truncated:
+            if not allow_truncated:
+                raise ResponseTooLargeError('Response from %s exceeds %d bytes' % (self._url, maxbytes))
+            content = content[:maxbytes]
+        return FetchResult(self.status_code, self.headers, content, truncated)
+
+    def close(self):
+        '''
+        Returns the connection to the pool if the body was read to the end
+        and the server keeps it alive, otherwise closes it.
+        '''
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        if self.eof and not self._response.will_close:
+            self._backend._release(self._key, conn)
+        else:
+            conn.close()
+
+
+class UrlfetchBackend(object):
+    '''
+    App Engine's urlfetch service.
+    '''
+
+    timed_wait = False # UserRPC.wait_any can't give up early, so no hedging
+    detached = False # rpcs belong to the request that made them
+
+    def __init__(self):
+        from google.appengine.api import apiproxy_stub_map, urlfetch
+        self._urlfetch = urlfetch
+        self.fetch = urlfetch.fetch
+        self.wait_any = apiproxy_stub_map.UserRPC.wait_any
+        self.DownloadError = urlfetch.DownloadError
+        self.InvalidURLError = urlfetch.InvalidURLError
+        self.counters = Counters()
+
+    def fetch_async(self, url, deadline=URLFETCH_REQ_MAXSECS, **kw):
+        rpc = self._urlfetch.create_rpc(deadline=deadline)
+        self._urlfetch.make_fetch_call(rpc, url, **kw)
+        return rpc
+
+    def stats(self):
+        return self.counters.snapshot()
+
+
+class _HTTPSConnection(HTTPSConnection):
+    '''
+    HTTPSConnection resuming tls_session if it is set.
+    '''
+
+    tls_session = None
+
+    def connect(self):
+        HTTPConnection.connect(self)
+        kw = {'session': self.tls_session} if self.tls_session is not None else {}
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=self.host, **kw)
+
+
+class _Rpc(object):
+    '''
+    An in-flight PooledBackend.fetch_async or fetch_stream_async call,
+    running fn on its own thread.
+    '''
+
+    def __init__(self, backend, fn, url, kw):
+        self._backend = backend
+        self._done = threading.Event()
+        self._result = self._error = None
+        self._discarded = False
+        thread = threading.Thread(target=self._run, args=(fn, url, kw))
+        thread.daemon = True
+        thread.start()
+
+    def _run(self, fn, url, kw):
+        try:
+            self._result = fn(url, **kw)
+        except Exception as e:
+            self._error = e
+        with self._backend._completed:
+            self._done.set()
+            self._backend._completed.notify_all()
+            discarded = self._discarded
+        if discarded and isinstance(self._result, StreamingResult):
+            self._result.close()
+
+    def discard(self):
+        '''
+        Says the result won't be used, so a StreamingResult can be closed
+        once it arrives.
+        '''
+        with self._backend._completed:
+            self._discarded = True
+            done = self._done.is_set()
+        if done and isinstance(self._result, StreamingResult):
+            self._result.close()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self):
+        self._done.wait()
+
+    def check_success(self):
+        self.get_result()
+
+    def get_result(self):
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class PooledBackend(object):
+    '''
+    Fetches with httplib over keep-alive connections, keeping up to
+    maxidle idle connections per (scheme, host, port) for up to idlesecs.
+    TLS sessions are remembered per host and resumed on new connections
+    (python 3.6+).
+
+    Follows urlfetch's semantics: responses over maxbytes are truncated if
+    allow_truncated, otherwise raise ResponseTooLargeError; deadline bounds
+    the whole fetch; redirects are only followed if follow_redirects, up to
+    MAX_REDIRECTS; and failures raise DownloadError or InvalidURLError.
+    fetch_stream leaves reading the body, within the deadline, to the
+    caller.
+    '''
+
+    DownloadError = DownloadError
+    InvalidURLError = InvalidURLError
+    timed_wait = True # wait_any takes a timeout
+    detached = True # rpcs run on their own threads, any request may wait for them
+
+    def __init__(self, maxidle=POOL_MAXIDLE_PER_HOST, idlesecs=POOL_IDLE_SECS, maxbytes=URLFETCH_RES_MAXBYTES):
+        self.maxidle = maxidle
+        self.idlesecs = idlesecs
+        self.maxbytes = maxbytes
+        self._idle = {} # pool key -> [(connection, idle since)], most recent last
+        self._sessions = {} # pool key -> TLS session
+        self._lock = threading.Lock()
+        self._completed = threading.Condition()
+        self._contexts = {True: ssl.create_default_context(), False: ssl._create_unverified_context()}
+        self.counters = Counters()
+
+    def _connection(self, key, deadline):
+        now = time.time()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                conn, since = idle.pop()
+                if now - since < self.idlesecs:
+                    conn.timeout = deadline
+                    conn.sock.settimeout(deadline)
+                    self.counters.incr('connections_reused')
+                    return conn, True
+                conn.close()
+            session = self._sessions.get(key)
+        scheme, host, port, validate = key
+        if scheme == 'https':
+            conn = _HTTPSConnection(host, port, timeout=deadline, context=self._contexts[validate])
+            conn.tls_session = session
+        else:
+            conn = HTTPConnection(host, port, timeout=deadline)
+        self.counters.incr('connections_opened')
+        return conn, False
+
+    def _release(self, key, conn):
+        if TLS_SESSIONS and key[0] == 'https' and conn.sock is not None:
+            if conn.sock.session_reused:
+                self.counters.incr('tls_sessions_resumed')
+            session = conn.sock.session
+        else:
+            session = None
+        with self._lock:
+            if session is not None:
+                self._sessions[key] = session
+            idle = self._idle.setdefault(key, [])
+            idle.append((conn, time.time()))
+            while len(idle) > self.maxidle:
+                idle.pop(0)[0].close()
+
+    def fetch(self, url, payload=None, method='GET', headers={}, allow_truncated=False,
+            follow_redirects=True, deadline=URLFETCH_REQ_MAXSECS, validate_certificate=None):
+        giveup = time.time() + deadline
+        method = method.upper()
+        for redirects in range(MAX_REDIRECTS + 1):
+            stream = self._open(url, payload, method, headers, giveup, bool(validate_certificate))
+            result = stream.result(self.maxbytes, allow_truncated)
+            location = result.headers.get('location')
+            if not (follow_redirects and location and result.status_code in REDIRECT_STATUSES):
+                result.final_url = url if redirects else None
+                return result
+            url = urljoin(url, location)
+            if result.status_code == 303 or (result.status_code in (301, 302) and method == 'POST'):
+                method, payload = 'GET', None
+        raise DownloadError('Too many redirects fetching %s' % url)
+
+    def fetch_stream(self, url, payload=None, method='GET', headers={},
+            deadline=URLFETCH_REQ_MAXSECS, validate_certificate=None):
+        '''
+        Like fetch without following redirects, but returns as soon as the
+        response headers have arrived, with a StreamingResult.
+        '''
+        giveup = time.time() + deadline
+        return self._open(url, payload, method.upper(), headers, giveup, bool(validate_certificate))
+
+    def _open(self, url, payload, method, headers, giveup, validate):
+        try:
+            parts = urlsplit(url)
+            scheme, host = parts.scheme.lower(), parts.hostname
+            port = parts.port or (443 if scheme == 'https' else 80)
+        except ValueError:
+            raise InvalidURLError(url)
+        if scheme not in ('http', 'https') or not host:
+            raise InvalidURLError(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        key = scheme, host, port, validate and scheme == 'https'
+
+        retried = False
+        while True:
+            remaining = giveup - time.time()
+            if remaining <= 0:
+                raise DownloadError('Deadline exceeded fetching %s' % url)
+            conn, reused = self._connection(key, remaining)
+            try:
+                conn.request(method, path, payload, headers)
+                response = conn.getresponse()
+                break
+            except socket.gaierror as e:
+                conn.close()
+                self.counters.incr('errors')
+                raise HostNotFoundError('Error resolving %s: %r' % (host, e))
+            except (HTTPException, socket.error, ssl.SSLError) as e:
+                conn.close()
+                # keep-alive connections may have been closed by the server
+                # since we last used them
+                stale = reused and not isinstance(e, socket.timeout) and method in RETRYABLE_METHODS
+                if stale and not retried:
+                    logger.debug('Retrying %s on a new connection after %r', url, e)
+                    self.counters.incr('retries')
+                    retried = True
+                    continue
+                self.counters.incr('errors')
+                raise DownloadError('Error fetching %s: %r' % (url, e))
+
+        return StreamingResult(self, key, conn, response, url, giveup)
+
+    def fetch_async(self, url, deadline=URLFETCH_REQ_MAXSECS, **kw):
+        return _Rpc(self, self.fetch, url, dict(kw, deadline=deadline))
+
+    def fetch_stream_async(self, url, deadline=URLFETCH_REQ_MAXSECS, **kw):
+        return _Rpc(self, self.fetch_stream, url, dict(kw, deadline=deadline))
+
+    def wait_any(self, rpcs, timeout=None):
+        '''
+        Waits for any of rpcs to complete and returns it, or None if none
+        has after timeout seconds.
+        '''
+        rpcs = list(rpcs)
+        if not rpcs:
+            return None
+        giveup = None if timeout is None else time.time() + timeout
+        with self._completed:
+            while True:
+                for rpc in rpcs:
+                    if rpc.done():
+                        return rpc
+                if giveup is None:
+                    self._completed.wait()
+                    continue
+                remaining = giveup - time.time()
+                if remaining <= 0:
+                    return None
+                self._completed.wait(remaining)
+
+    def stats(self):
+        stats = self.counters.snapshot()
+        with self._lock:
+            stats['idle_connections'] = sum(len(i) for i in self._idle.values())
+        return stats
+
+
+def default_backend():
+    '''
+    Returns UrlfetchBackend on App Engine, otherwise PooledBackend.
+    '''
+    try:
+        return UrlfetchBackend()
+    except ImportError:
+        logger.info('urlfetch unavailable, fetching with PooledBackend')
+        return PooledBackend()
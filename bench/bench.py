@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+'''
+Microbenchmarks for laeproxy's request path, run against the App Engine
+stand-ins in gaestub.py and the canned responses in mockupstream.py, so
+neither the SDK nor the network is needed::
+
+    python bench/bench.py [-k pattern] [-o results.json] [--compare baseline.json]
+
+Each benchmark reports operations per second and the latency distribution
+of single operations. Helper functions are too quick to time one call at
+a time, so their latencies are averages over FUNCTION_BATCH calls. Results can be written as JSON and compared against
+a previous run, exiting non-zero if any benchmark's median got slower by
+more than --threshold percent.
+'''
+
+from __future__ import print_function
+
+from collections import OrderedDict
+from datetime import datetime
+from os.path import abspath, dirname
+from timeit import default_timer
+
+import argparse
+import json
+import logging
+import os
+import platform
+import re
+import sys
+
+HERE = dirname(abspath(__file__))
+sys.path[:0] = [HERE, dirname(HERE)]
+
+import gaestub
+gaestub.install()
+
+from constants import *
+from mockupstream import MockUpstream
+
+gaestub.upstream = MockUpstream()
+
+import laeproxy
+
+# a single client requesting as fast as it can would soon be over its rate
+# limits. lift them, but keep checking them so that their cost is measured.
+for limiter in (laeproxy.clientlimits, laeproxy.hostlimits):
+    limiter.reqrate = limiter.byterate = None
+
+BODY_SIZES = (1024, 1024 * 64, 1024 * 512, RANGE_REQ_SIZE)
+HEADER_COUNTS = (4, 16, 64)
+WARMUP_ITERS = 20
+FUNCTION_BATCH = 100
+
+ORIGIN = '/http/upstream.example'
+
+devnull = open(os.devnull, 'w')
+
+
+def make_headers(n):
+    '''
+    n request headers like a browser would send, padded with made up ones.
+    '''
+    common = [
+        ('User-Agent', 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36'),
+        ('Accept', 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8'),
+        ('Accept-Language', 'en-US,en;q=0.5'),
+        ('Connection', 'keep-alive, X-Bench-1'),
+        ]
+    padding = [('X-Bench-%d' % i, 'value-%d' % i) for i in range(max(0, n - len(common)))]
+    return OrderedDict((common + padding)[:n])
+
+
+def handler_bench(path, headers=None, method='GET'):
+    def prepare():
+        return gaestub.Request(ORIGIN + path, method, dict(headers or {}))
+    return prepare, laeproxy.app.handle, 1
+
+
+def logging_bench(level, sample):
+    '''
+    A range request, handled with laeproxy logging at level and sampling
+    sample of its requests, to a sink that discards what's logged. Setting
+    the level is slow, so it's done in prepare, outside the timing.
+    '''
+    prepare, run, batch = handler_bench('/size?size=1024', {'Range': 'bytes=0-1023'})
+    def prepare_logging():
+        laeproxy.logger.setLevel(level)
+        laeproxy.REQUEST_LOG_SAMPLE = sample
+        laeproxy.loghandler.stream = devnull
+        return prepare()
+    return prepare_logging, run, batch
+
+
+def function_bench(fn, *args):
+    return (lambda: args), (lambda args: fn(*args)), FUNCTION_BATCH
+
+
+def benchmarks():
+    '''
+    Yields (name, prepare, run, batch). Each timed operation is batch
+    calls of run(prepare()), with prepare called once, outside the timing.
+    '''
+    for size in BODY_SIZES:
+        rangeheader = {'Range': 'bytes=0-%d' % (size - 1)}
+        yield ('handler/size/%d' % size,) + handler_bench('/size?size=%d' % size, rangeheader)
+        yield ('handler/size_cached/%d' % size,) + handler_bench('/size?size=%d&max_age=3600' % size, rangeheader)
+    for n in HEADER_COUNTS:
+        headers = dict(make_headers(n), Range='bytes=0-1023')
+        yield ('handler/headers/%d' % n,) + handler_bench('/size?size=1024', headers)
+    yield ('handler/echo',) + handler_bench('/echo?msg=hello', {'Range': 'bytes=0-4'})
+    yield ('handler/redirect',) + handler_bench('/redirect/relative', {'Range': 'bytes=0-4'})
+    # every request logged at DEBUG, as laeproxy used to in production,
+    # against the sampled request log, and a record for every request
+    saved = laeproxy.logger.level, laeproxy.REQUEST_LOG_SAMPLE, laeproxy.loghandler.stream
+    yield ('handler/logging/debug',) + logging_bench(logging.DEBUG, 0)
+    yield ('handler/logging/sampled',) + logging_bench(LOG_LEVEL, REQUEST_LOG_SAMPLE)
+    yield ('handler/logging/every_request',) + logging_bench(LOG_LEVEL, 1)
+    # resumed once the last of them has run
+    level, laeproxy.REQUEST_LOG_SAMPLE, laeproxy.loghandler.stream = saved
+    laeproxy.logger.setLevel(level)
+
+    handler = laeproxy.LaeproxyHandler(None, None)
+    request = gaestub.Request(ORIGIN + '/some/path?with=query')
+    yield ('extract_url',) + function_bench(handler._extract_url, request)
+    yield ('admit',) + function_bench(laeproxy.clientlimits.admit, '127.0.0.1')
+    for n in HEADER_COUNTS:
+        headers = make_headers(n)
+        ignore = laeproxy.conn_header_set(headers) | HOPBYHOP
+        yield ('conn_header_set/%d' % n,) + function_bench(laeproxy.conn_header_set, headers)
+        yield ('copy_headers/%d' % n,) + function_bench(laeproxy.copy_headers, headers, {}, ignore)
+        yield ('headers_str/%d' % n,) + function_bench(laeproxy.headers_str, headers)
+
+
+def measure(prepare, run, batch, min_time, min_iters):
+    for i in range(WARMUP_ITERS):
+        run(prepare())
+    calls = range(batch)
+    times = []
+    deadline = default_timer() + min_time
+    while len(times) < min_iters or default_timer() < deadline:
+        args = prepare()
+        start = default_timer()
+        for i in calls:
+            run(args)
+        times.append((default_timer() - start) / batch)
+    return summarize(times)
+
+
+def summarize(times):
+    times.sort()
+    n = len(times)
+    us = lambda secs: round(secs * 1e6, 3)
+    return OrderedDict([
+        ('iterations', n),
+        ('ops_per_sec', round(n / sum(times), 1)),
+        ('mean_us', us(sum(times) / n)),
+        ('p50_us', us(times[n // 2])),
+        ('p95_us', us(times[min(n - 1, n * 95 // 100)])),
+        ('p99_us', us(times[min(n - 1, n * 99 // 100)])),
+        ('max_us', us(times[-1])),
+        ])
+
+
+def compare(results, baseline, threshold):
+    '''
+    Prints how median latency changed since baseline, which is steadier
+    than throughput on a busy machine. Returns the names of the benchmarks
+    whose median got slower by more than threshold percent.
+    '''
+    regressions = []
+    print('\n%-32s %14s %14s %9s' % ('benchmark', 'baseline p50 us', 'p50 us', 'change'))
+    for name, result in results.items():
+        old = baseline.get(name)
+        if not old:
+            print('%-32s %14s %14.1f %9s' % (name, '-', result['p50_us'], 'new'))
+            continue
+        change = (result['p50_us'] - old['p50_us']) * 100.0 / old['p50_us']
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = ' <-- slower'
+        print('%-32s %14.1f %14.1f %+8.1f%%%s' % (name, old['p50_us'], result['p50_us'], change, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark laeproxy without App Engine.')
+    parser.add_argument('-k', '--filter', help='only run benchmarks whose name matches this regex')
+    parser.add_argument('-o', '--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='compare against results previously written with -o')
+    parser.add_argument('--threshold', type=float, default=10, help='percent slowdown counted as a regression')
+    parser.add_argument('--min-time', type=float, default=1, help='seconds to run each benchmark for')
+    parser.add_argument('--min-iters', type=int, default=100)
+    parser.add_argument('--log-level', default='WARNING', help="laeproxy's log level during the run")
+    args = parser.parse_args(argv)
+    laeproxy.logger.setLevel(args.log_level.upper())
+
+    results = OrderedDict()
+    print('%-32s %10s %10s %10s %10s %10s' % ('benchmark', 'op/s', 'mean us', 'p50 us', 'p95 us', 'p99 us'))
+    for name, prepare, run, batch in benchmarks():
+        if args.filter and not re.search(args.filter, name):
+            continue
+        result = results[name] = measure(prepare, run, batch, args.min_time, args.min_iters)
+        print('%-32s %10.1f %10.1f %10.1f %10.1f %10.1f' % (name, result['ops_per_sec'],
+            result['mean_us'], result['p50_us'], result['p95_us'], result['p99_us']))
+        sys.stdout.flush()
+
+    if args.output:
+        meta = OrderedDict([
+            ('laeproxy_version', laeproxy.__version__),
+            ('python', platform.python_version()),
+            ('implementation', platform.python_implementation()),
+            ('platform', platform.platform()),
+            ('date', datetime.utcnow().isoformat()),
+            ])
+        with open(args.output, 'w') as f:
+            json.dump(OrderedDict([('meta', meta), ('results', results)]), f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('\n%d benchmark(s) slower by more than %s%%: %s' % (len(regressions), args.threshold, ', '.join(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
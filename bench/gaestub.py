@@ -0,0 +1,325 @@
+'''
+Stand-ins for the parts of the App Engine SDK laeproxy uses, so it can be
+imported and driven without the SDK or the network. Call install() before
+importing laeproxy, and set upstream to a callable like::
+
+    upstream(url, method, headers, payload) -> (status, headers, body)
+
+to answer urlfetch calls. Async fetches complete synchronously, so
+benchmarks measure laeproxy rather than thread scheduling.
+'''
+
+import re
+import sys
+import types
+
+URLFETCH_RES_MAXBYTES = 1024 * 1024 * 32
+
+upstream = None
+
+
+class CaselessDict(dict):
+    '''
+    Case-insensitive dict like the headers of webob requests and urlfetch
+    results, remembering the case keys were last set with.
+    '''
+
+    def __init__(self, *args, **kw):
+        dict.__init__(self)
+        self._keys = {}
+        self.update(*args, **kw)
+
+    def __setitem__(self, k, v):
+        old = self._keys.get(k.lower())
+        if old is not None and old != k:
+            dict.__delitem__(self, old)
+        self._keys[k.lower()] = k
+        dict.__setitem__(self, k, v)
+
+    def __getitem__(self, k):
+        return dict.__getitem__(self, self._keys[k.lower()])
+
+    def __delitem__(self, k):
+        dict.__delitem__(self, self._keys.pop(k.lower()))
+
+    def __contains__(self, k):
+        return k.lower() in self._keys
+
+    has_key = __contains__
+
+    def get(self, k, default=None):
+        return self[k] if k in self else default
+
+    def pop(self, k, *default):
+        if k in self:
+            v = self[k]
+            del self[k]
+            return v
+        if default:
+            return default[0]
+        raise KeyError(k)
+
+    def update(self, *args, **kw):
+        for k, v in dict(*args, **kw).items():
+            self[k] = v
+
+    def setdefault(self, k, v=None):
+        if k not in self:
+            self[k] = v
+        return self[k]
+
+    def copy(self):
+        return CaselessDict(self.items())
+
+
+# google.appengine.api.urlfetch
+
+class DownloadError(Exception):
+    pass
+
+
+class InvalidURLError(Exception):
+    pass
+
+
+class _Result(object):
+
+    def __init__(self, status_code, headers, content, truncated):
+        self.status_code = status_code
+        self.headers = CaselessDict(headers)
+        self.content = content
+        self.content_was_truncated = truncated
+        self.final_url = None
+
+
+def fetch(url, payload=None, method='GET', headers={}, allow_truncated=False,
+        follow_redirects=True, deadline=None, validate_certificate=None):
+    if not url.startswith('http'):
+        raise InvalidURLError(url)
+    status, rheaders, body = upstream(url, method.upper(), CaselessDict(headers), payload)
+    truncated = len(body) > URLFETCH_RES_MAXBYTES
+    if truncated:
+        body = body[:URLFETCH_RES_MAXBYTES]
+    return _Result(status, rheaders, body, truncated)
+
+
+class _RPC(object):
+
+    def __init__(self, deadline=None, callback=None):
+        self.deadline = deadline
+        self._result = self._error = None
+
+    def wait(self):
+        pass
+
+    def check_success(self):
+        self.get_result()
+
+    def get_result(self):
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    @staticmethod
+    def wait_any(rpcs):
+        return next(iter(rpcs), None)
+
+
+def create_rpc(deadline=None, callback=None):
+    return _RPC(deadline, callback)
+
+
+def make_fetch_call(rpc, url, payload=None, method='GET', headers={}, **kw):
+    try:
+        rpc._result = fetch(url, payload, method, headers, **kw)
+    except Exception as e:
+        rpc._error = e
+    return rpc
+
+
+# google.appengine.api.memcache
+
+class MemcacheClient(object):
+    '''
+    In-memory memcache, ignoring expiration times.
+    '''
+
+    def __init__(self):
+        self._data = {}
+        self._cas = {}
+
+    def get(self, key, namespace=None):
+        return self._data.get((namespace, key))
+
+    def set(self, key, value, time=0, namespace=None):
+        self._data[(namespace, key)] = value
+        return True
+
+    def add(self, key, value, time=0, namespace=None):
+        if (namespace, key) in self._data:
+            return False
+        return self.set(key, value, time, namespace)
+
+    def delete(self, key, namespace=None):
+        self._data.pop((namespace, key), None)
+        return 2
+
+    def get_multi(self, keys, namespace=None):
+        return dict((k, self._data[(namespace, k)]) for k in keys if (namespace, k) in self._data)
+
+    def set_multi(self, mapping, time=0, namespace=None):
+        for k, v in mapping.items():
+            self.set(k, v, time, namespace)
+        return []
+
+    def gets(self, key, namespace=None):
+        value = self._cas[(namespace, key)] = self.get(key, namespace)
+        return value
+
+    def cas(self, key, value, time=0, namespace=None):
+        if (namespace, key) not in self._data or self._data[(namespace, key)] is not self._cas.get((namespace, key)):
+            return False
+        return self.set(key, value, time, namespace)
+
+    def offset_multi(self, mapping, namespace=None, initial_value=0):
+        for k, delta in mapping.items():
+            self._data[(namespace, k)] = self._data.get((namespace, k), initial_value) + delta
+        return dict((k, self._data[(namespace, k)]) for k in mapping)
+
+
+# google.appengine.ext.webapp
+
+class Range(object):
+
+    def __init__(self, ranges):
+        self.ranges = ranges
+
+
+class Request(object):
+    '''
+    The subset of webob 1.1's Request laeproxy uses.
+    '''
+
+    def __init__(self, path_qs, method='GET', headers=None, body='', host='laeproxy.local', remote_addr='127.0.0.1'):
+        self.path_qs = path_qs
+        self.path, _, query = path_qs.partition('?')
+        self.method = method
+        self.headers = CaselessDict(headers or {})
+        self.body = body
+        self.content_length = len(body) if body else None
+        self.host = host
+        self.remote_addr = remote_addr
+        self.params = dict(i.split('=', 1) for i in query.split('&') if '=' in i)
+
+    @property
+    def range(self):
+        from ranges import parse_range
+        ranges = parse_range(self.headers.get('range'))
+        return ranges and Range(ranges)
+
+    def get(self, name, default=''):
+        return self.params.get(name, default)
+
+    def __str__(self):
+        return '%s %s\n%s' % (self.method, self.path_qs,
+            '\n'.join('%s: %s' % i for i in self.headers.items()))
+
+
+class _Out(object):
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+
+class Response(object):
+
+    def __init__(self):
+        self.headers = CaselessDict()
+        self.out = _Out()
+        self.status_int = 200
+
+    def set_status(self, code, message=None):
+        self.status_int = code
+
+    def clear(self):
+        self.out = _Out()
+
+    @property
+    def body(self):
+        return b''.join(self.out.chunks)
+
+
+class RequestHandler(object):
+
+    def __init__(self, request=None, response=None):
+        self.initialize(request, response)
+
+    def initialize(self, request, response):
+        self.request = request
+        self.response = response
+
+    def error(self, code):
+        self.response.set_status(code)
+        self.response.clear()
+
+
+class WSGIApplication(object):
+    '''
+    Routes requests to handlers like webapp does. handle calls the handler
+    directly rather than going through WSGI.
+    '''
+
+    def __init__(self, routes, debug=False):
+        self.routes = [(re.compile(pattern + '$'), handler) for pattern, handler in routes]
+
+    def handle(self, request):
+        response = Response()
+        for pattern, handler in self.routes:
+            if pattern.match(request.path):
+                getattr(handler(request, response), request.method.lower())()
+                return response
+        response.set_status(404)
+        return response
+
+
+# google.appengine.runtime
+
+class DeadlineExceededError(BaseException):
+    pass
+
+
+class OverQuotaError(Exception):
+    pass
+
+
+def _module(name, **attrs):
+    module = sys.modules[name] = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    parent, _, child = name.rpartition('.')
+    if parent:
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+def install():
+    '''
+    Makes the stand-ins importable under the SDK's module names.
+    '''
+    client = MemcacheClient()
+    _module('google')
+    _module('google.appengine')
+    _module('google.appengine.api')
+    _module('google.appengine.api.urlfetch', fetch=fetch, create_rpc=create_rpc,
+        make_fetch_call=make_fetch_call, DownloadError=DownloadError, InvalidURLError=InvalidURLError)
+    _module('google.appengine.api.apiproxy_stub_map', UserRPC=_RPC)
+    _module('google.appengine.api.memcache', Client=MemcacheClient,
+        **dict((name, getattr(client, name)) for name in ('get', 'set', 'add', 'delete', 'get_multi', 'set_multi', 'offset_multi')))
+    _module('google.appengine.ext')
+    _module('google.appengine.ext.webapp', RequestHandler=RequestHandler, WSGIApplication=WSGIApplication,
+        Request=Request, Response=Response)
+    _module('google.appengine.ext.webapp.util', run_wsgi_app=lambda app: None)
+    _module('google.appengine.runtime', DeadlineExceededError=DeadlineExceededError)
+    _module('google.appengine.runtime.apiproxy_errors', OverQuotaError=OverQuotaError)
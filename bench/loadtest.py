@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+'''
+Load test comparing laeproxy's front ends at high connection counts: the
+threaded WSGI app (wsgi.py) and the asyncio ASGI one (asgi.py). Unlike
+bench.py, this drives real servers over loopback against a slow upstream
+it serves itself, so what's measured is the cost of holding many
+requests open at once. Python 3.7+::
+
+    python3 bench/loadtest.py upstream --port 9000 --delay 0.5 &
+    python wsgi.py 8080 &
+    uvicorn asgi:application --port 8081 &
+    python3 bench/loadtest.py run --upstream 127.0.0.1:9000 -c 1000 \\
+        wsgi=http://127.0.0.1:8080@<pid> asgi=http://127.0.0.1:8081@<pid>
+
+Each target gets -c keep-alive connections requesting a range of
+--size bytes from the upstream for --duration seconds, and its
+throughput, latency and errors are reported, along with the server's
+peak memory and threads if given its pid (read from /proc, so Linux
+only). Raise the open files limit (ulimit -n) to go past ~1000
+connections.
+'''
+
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+CONNECT_TIMEOUT = 10
+REQUEST_TIMEOUT = 120
+
+
+async def serve_upstream(port, delay, maxsize=1024 * 1024 * 2):
+    '''
+    Answers every GET after delay seconds with the requested range of a
+    body of "-"s, as a 206, or a 200 for all of it without a Range header.
+    '''
+    body = b'-' * maxsize
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                rng = [i for i in head.split(b'\r\n') if i.lower().startswith(b'range:')]
+                await asyncio.sleep(delay)
+                if rng:
+                    start, end = [int(i) for i in rng[0].split(b'=', 1)[1].split(b'-')]
+                    end = min(end, maxsize - 1)
+                    status = 'HTTP/1.1 206 Partial Content\r\nContent-Range: bytes %d-%d/%d\r\n' % (start, end, maxsize)
+                else:
+                    start, end = 0, maxsize - 1
+                    status = 'HTTP/1.1 200 OK\r\n'
+                writer.write(('%sContent-Length: %d\r\nCache-Control: no-store\r\n\r\n' % (status, end - start + 1)).encode('ascii'))
+                writer.write(body[start:end + 1])
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', port, backlog=4096)
+    print('upstream listening on port %d, answering after %ss' % (port, delay))
+    async with server:
+        await server.serve_forever()
+
+
+async def client(host, port, request, giveup, latencies, errors):
+    '''
+    Makes requests over one keep-alive connection until giveup,
+    reconnecting after errors or if the server closes it (wsgiref only
+    speaks HTTP/1.0).
+    '''
+    writer = None
+    while time.monotonic() < giveup:
+        start = time.monotonic()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), CONNECT_TIMEOUT)
+            writer.write(request)
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), REQUEST_TIMEOUT)
+            status = int(head.split(None, 2)[1])
+            lines = head.lower().split(b'\r\n')
+            length = [i for i in lines if i.startswith(b'content-length:')]
+            if length:
+                await asyncio.wait_for(reader.readexactly(int(length[0].split(b':', 1)[1])), REQUEST_TIMEOUT)
+            else:
+                await asyncio.wait_for(reader.read(), REQUEST_TIMEOUT)
+            if not length or head.startswith(b'HTTP/1.0') or b'connection: close' in lines:
+                writer.close()
+                writer = None
+            if status != 206:
+                errors[status] = errors.get(status, 0) + 1
+                continue
+            latencies.append(time.monotonic() - start)
+        except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+            name = type(e).__name__
+            errors[name] = errors.get(name, 0) + 1
+            writer and writer.close()
+            writer = None
+            await asyncio.sleep(0.1)
+    writer and writer.close()
+
+
+def proc_status(pid):
+    '''
+    Peak resident memory in MB and current thread count of process pid and
+    its children (e.g. uvicorn or gunicorn workers).
+    '''
+    pids = [pid]
+    try:
+        with open('/proc/%d/task/%d/children' % (pid, pid)) as f:
+            pids += [int(i) for i in f.read().split()]
+    except (IOError, ValueError):
+        pass
+    peak = threads = 0
+    for p in pids:
+        try:
+            with open('/proc/%d/status' % p) as f:
+                fields = dict(line.split(':', 1) for line in f)
+        except IOError: # exited since
+            continue
+        peak += int(fields['VmHWM'].split()[0]) / 1024.0
+        threads += int(fields['Threads'])
+    return round(peak, 1), threads
+
+
+def run_target(url, upstream, connections, duration, size, pid=None):
+    parts = urlsplit(url)
+    request = ('GET /http/%s/load HTTP/1.1\r\nHost: %s\r\nRange: bytes=0-%d\r\n\r\n' % (
+        upstream, parts.netloc, size - 1)).encode('ascii')
+    latencies = []
+    errors = {}
+
+    threads = [0]
+
+    async def sample():
+        while True:
+            threads[0] = max(threads[0], proc_status(pid)[1])
+            await asyncio.sleep(0.5)
+
+    async def run():
+        giveup = time.monotonic() + duration
+        sampler = pid and asyncio.ensure_future(sample())
+        await asyncio.gather(*[client(parts.hostname, parts.port or 80, request, giveup, latencies, errors)
+            for i in range(connections)])
+        sampler and sampler.cancel()
+
+    started = time.monotonic()
+    asyncio.run(run())
+    elapsed = time.monotonic() - started
+    latencies.sort()
+    n = len(latencies)
+    ms = lambda secs: round(secs * 1e3, 1)
+    result = OrderedDict([
+        ('connections', connections),
+        ('requests', n),
+        ('errors', errors),
+        ('req_per_sec', round(n / elapsed, 1)),
+        ('p50_ms', ms(latencies[n // 2]) if n else None),
+        ('p95_ms', ms(latencies[min(n - 1, n * 95 // 100)]) if n else None),
+        ('p99_ms', ms(latencies[min(n - 1, n * 99 // 100)]) if n else None),
+        ])
+    if pid:
+        result['peak_rss_mb'] = proc_status(pid)[0]
+        result['peak_threads'] = threads[0]
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare laeproxy's front ends under many concurrent connections.")
+    commands = parser.add_subparsers(dest='command')
+    up = commands.add_parser('upstream', help='serve the slow upstream')
+    up.add_argument('--port', type=int, default=9000)
+    up.add_argument('--delay', type=float, default=0.5, help='seconds to wait before answering')
+    run = commands.add_parser('run', help='load the given targets, one after the other')
+    run.add_argument('targets', nargs='+', metavar='name=url[@pid]')
+    run.add_argument('--upstream', default='127.0.0.1:9000', help='host:port of the slow upstream')
+    run.add_argument('-c', '--connections', type=int, action='append',
+        help='concurrent connections, may be given several times (default 100 and 1000)')
+    run.add_argument('--duration', type=float, default=20, help='seconds to load each target for')
+    run.add_argument('--size', type=int, default=1024 * 64, help='bytes requested per request')
+    run.add_argument('-o', '--output', help='write results to this JSON file')
+    args = parser.parse_args(argv)
+
+    if args.command == 'upstream':
+        asyncio.run(serve_upstream(args.port, args.delay))
+        return 0
+    if args.command != 'run':
+        parser.print_help()
+        return 2
+
+    results = OrderedDict()
+    print('%-20s %6s %9s %8s %9s %9s %9s %9s %8s  %s' % ('target', 'conns', 'requests', 'req/s',
+        'p50 ms', 'p95 ms', 'p99 ms', 'peak MB', 'threads', 'errors'))
+    for connections in args.connections or [100, 1000]:
+        for target in args.targets:
+            name, url = target.split('=', 1)
+            url, _, pid = url.partition('@')
+            result = run_target(url, args.upstream, connections, args.duration, args.size, int(pid) if pid else None)
+            results['%s/%d' % (name, connections)] = result
+            print('%-20s %6d %9d %8.1f %9s %9s %9s %9s %8s  %s' % (name, connections, result['requests'],
+                result['req_per_sec'], result['p50_ms'], result['p95_ms'], result['p99_ms'],
+                result.get('peak_rss_mb', '-'), result.get('peak_threads', '-'),
+                ' '.join('%s=%d' % i for i in sorted(result['errors'].items(), key=str)) or '-'))
+            sys.stdout.flush()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
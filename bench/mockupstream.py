@@ -0,0 +1,60 @@
+'''
+Canned upstream responses for benchmarks, modeled on test.py's MockServer:
+urls like http://<host>/<command>[/<arg>...][?<kwarg>=<value>...] are
+answered by MockUpstream._handle_<command>.
+'''
+
+try:
+    from urllib import unquote
+except ImportError: # python 3
+    from urllib.parse import unquote
+
+
+class MockUpstream(object):
+
+    def __init__(self):
+        self._bodies = {}
+
+    def __call__(self, url, method, headers, payload):
+        path, _, query = url.split('://', 1)[1].partition('/')[2].partition('?')
+        path = path.split('/')
+        kw = dict((k, unquote(v)) for k, v in (i.split('=', 1) for i in query.split('&') if '=' in i))
+        kw.pop('nonce', None)
+        handler = getattr(self, '_handle_' + path[0], None)
+        if handler is None:
+            return 404, {}, b''
+        return handler(headers, *path[1:], **kw)
+
+    def _body(self, size):
+        # built once per size, so benchmarks don't measure us
+        body = self._bodies.get(size)
+        if body is None:
+            body = self._bodies[size] = b'-' * size
+        return body
+
+    def _handle_echo(self, headers, msg=''):
+        return 200, {'Content-Type': 'text/plain'}, msg.encode('utf-8')
+
+    def _handle_redirect(self, headers, location, status=302):
+        return int(status), {'Location': location}, b''
+
+    def _handle_size(self, headers, size='1024', ignore_range='False', max_age=None, etag=None):
+        '''
+        Like MockServer._handle_size, honors Range headers of the form
+        bytes=x-y unless ignore_range is True.
+        '''
+        size = int(size)
+        resheaders = {'Content-Type': 'application/octet-stream', 'Server': 'mockupstream'}
+        if max_age is not None:
+            resheaders['Cache-Control'] = 'max-age=%s' % max_age
+        if etag is not None:
+            resheaders['ETag'] = '"%s"' % etag
+        range = headers.get('range', '')
+        if ignore_range != 'True' and range.startswith('bytes=') and ',' not in range:
+            start, end = [int(i) for i in range[6:].split('-')]
+            if start >= size:
+                return 416, {'Content-Range': 'bytes */%d' % size}, b''
+            end = min(end, size - 1)
+            resheaders['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+            return 206, resheaders, self._body(end - start + 1)
+        return 200, resheaders, self._body(size)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+'''
+Measures what a new instance costs before it's up to speed, against the
+same stand-ins as bench.py: how long importing laeproxy takes, how long a
+warmup request takes, and how long the first requests take with and
+without one. Each run is made in a fresh interpreter::
+
+    python bench/startup.py [-n runs] [-o results.json] [--compare baseline.json]
+
+Results are written and compared like bench.py's.
+'''
+
+from __future__ import print_function
+
+from collections import OrderedDict
+from os.path import abspath, dirname
+from subprocess import check_output
+from timeit import default_timer
+
+import argparse
+import json
+import sys
+
+HERE = dirname(abspath(__file__))
+sys.path[:0] = [HERE, dirname(HERE)]
+
+RUNS = 20
+REQUEST = '/http/upstream.example/size?size=1024', 'GET', {'Range': 'bytes=0-1023'}
+
+
+def child(warm, log_level):
+    '''
+    Run in a fresh interpreter: prints the seconds each phase took as JSON.
+    '''
+    import gaestub
+    gaestub.install()
+    from mockupstream import MockUpstream
+    gaestub.upstream = MockUpstream()
+
+    times = OrderedDict()
+    start = default_timer()
+    import laeproxy
+    times['import'] = default_timer() - start
+    laeproxy.logger.setLevel(log_level.upper())
+    if warm:
+        start = default_timer()
+        laeproxy.app.handle(gaestub.Request('/_ah/warmup'))
+        times['warmup'] = default_timer() - start
+    for name in ('first_request', 'second_request'):
+        start = default_timer()
+        laeproxy.app.handle(gaestub.Request(*REQUEST))
+        times[name + ('_warmed' if warm else '')] = default_timer() - start
+    print(json.dumps(times))
+
+
+def run(runs, log_level):
+    samples = OrderedDict()
+    for i in range(runs):
+        for warm in ('', 'warm'):
+            out = check_output([sys.executable, abspath(__file__), '--child', warm, '--log-level', log_level])
+            for name, secs in json.loads(out.decode('utf-8').splitlines()[-1], object_pairs_hook=OrderedDict).items():
+                samples.setdefault('startup/' + name, []).append(secs)
+    return samples
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark laeproxy instance startup without App Engine.')
+    parser.add_argument('-n', '--runs', type=int, default=RUNS, help='fresh interpreters to time, with and without warmup each')
+    parser.add_argument('-o', '--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='compare against results previously written with -o')
+    parser.add_argument('--threshold', type=float, default=10, help='percent slowdown counted as a regression')
+    parser.add_argument('--log-level', default='WARNING', help="laeproxy's log level during the run")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child is not None:
+        return child(args.child == 'warm', args.log_level)
+
+    # bench.py drives laeproxy in this process when imported; ours are
+    # measured in fresh interpreters
+    from bench import compare, laeproxy, summarize
+
+    results = OrderedDict()
+    print('%-32s %10s %10s %10s %10s' % ('benchmark', 'mean us', 'p50 us', 'p95 us', 'max us'))
+    for name, times in run(args.runs, args.log_level).items():
+        result = results[name] = summarize(times)
+        print('%-32s %10.1f %10.1f %10.1f %10.1f' % (name, result['mean_us'], result['p50_us'], result['p95_us'], result['max_us']))
+
+    if args.output:
+        meta = OrderedDict([('laeproxy_version', laeproxy.__version__), ('python', sys.version.split()[0]), ('runs', args.runs)])
+        with open(args.output, 'w') as f:
+            json.dump(OrderedDict([('meta', meta), ('results', results)]), f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('\n%d benchmark(s) slower by more than %s%%: %s' % (len(regressions), args.threshold, ', '.join(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,607 @@
+'''
+Response caching for laeproxy.
+'''
+
+from binascii import hexlify
+from calendar import timegm
+from collections import OrderedDict
+from email.utils import parsedate
+from hashlib import sha1
+from ranges import parse_content_range
+from stats import Counters
+
+import logging
+import os
+import threading
+import time
+
+from constants import *
+
+logger = logging.getLogger('laeproxy')
+
+
+def parse_cache_control(value):
+    directives = {}
+    for part in value.split(','):
+        name, _, arg = part.partition('=')
+        name = name.strip().lower()
+        if name:
+            directives[name] = arg.strip().strip('"') or None
+    return directives
+
+
+def http_date(value):
+    try:
+        return timegm(parsedate(value))
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def freshness_lifetime(headers, now):
+    '''
+    Number of seconds a response with the given headers may be served from
+    a shared cache, per http://tools.ietf.org/html/rfc2616#section-13.2.4.
+    0 means the response must not be cached.
+    '''
+    cc = parse_cache_control(headers.get('cache-control', ''))
+    if NOCACHE_DIRECTIVES.intersection(cc):
+        return 0
+    try:
+        age = int(headers.get('age', 0))
+    except ValueError:
+        age = 0
+    for directive in ('s-maxage', 'max-age'):
+        if directive in cc:
+            try:
+                return max(0, int(cc[directive]) - age)
+            except (TypeError, ValueError):
+                return 0
+    date = http_date(headers.get('date', '')) or now
+    if 'expires' in headers:
+        expires = http_date(headers['expires'])
+        return max(0, expires - date - age) if expires else 0
+    lastmod = http_date(headers.get('last-modified', ''))
+    if lastmod:
+        # heuristic freshness, http://tools.ietf.org/html/rfc2616#section-13.2.4
+        return max(0, min((date - lastmod) // 10, CACHE_HEURISTIC_MAXSECS) - age)
+    return 0
+
+
+def vary_headers(fheaders, reqheaders):
+    '''
+    Returns the (name, value) pairs of the request headers the response
+    varies on, or None if the response varies on something we can't see.
+    '''
+    names = [i.strip().lower() for i in fheaders.get('vary', '').split(',')]
+    names = sorted(i for i in names if i)
+    if '*' in names:
+        return None
+    return tuple((i, reqheaders.get(i)) for i in names)
+
+
+def request_allows_cache(reqheaders):
+    cc = parse_cache_control(reqheaders.get('cache-control', ''))
+    if 'no-cache' in cc or 'no-store' in cc:
+        return False
+    return 'no-cache' not in reqheaders.get('pragma', '').lower()
+
+
+class CacheEntry(object):
+    __slots__ = ('status', 'headers', 'content', 'etag', 'vary', 'stored', 'expires', 'size')
+
+    def __init__(self, status, headers, content, etag, vary, stored, expires):
+        self.status = status
+        self.headers = headers
+        self.content = content
+        self.etag = etag
+        self.vary = vary
+        self.stored = stored
+        self.expires = expires
+        self.size = len(content) + sum(len(k) + len(v) for k, v in headers) + CACHE_ENTRY_OVERHEAD
+
+    def header(self, name, default=None):
+        name = name.lower()
+        for k, v in self.headers:
+            if k.lower() == name:
+                return v
+        return default
+
+    def matches(self, reqheaders):
+        return all(reqheaders.get(k) == v for k, v in self.vary)
+
+    def conditional_headers(self):
+        '''
+        Request headers for revalidating this entry upstream.
+        '''
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        lastmod = self.header('last-modified')
+        if lastmod:
+            headers['If-Modified-Since'] = lastmod
+        return headers
+
+    def refreshed(self, headers, now):
+        '''
+        Returns a copy of this entry updated with the headers of a 304
+        response revalidating it, per
+        http://tools.ietf.org/html/rfc2616#section-10.3.5.
+        '''
+        updates = dict((k.lower(), (k, v)) for k, v in headers.items()
+            if k.lower() not in HOPBYHOP and k.lower() not in NOT_MODIFIED_KEEP_HEADERS)
+        kept = [(k, v) for k, v in self.headers if k.lower() not in updates]
+        merged = tuple(kept) + tuple(updates.values())
+        ttl = max(0, freshness_lifetime(dict((k.lower(), v) for k, v in merged), now))
+        return CacheEntry(self.status, merged, self.content, headers.get('etag', self.etag),
+            self.vary, now, now + ttl)
+
+
+def make_entry(status, headers, content, reqheaders, ignoreheaders, now, min_ttl=0):
+    '''
+    Returns a CacheEntry for the response if a shared cache may store it,
+    otherwise None.
+
+    If min_ttl is passed, responses without explicit freshness information
+    are kept for that long, unless upstream forbids storing them. Otherwise
+    such responses are only kept if they carry validators, and are
+    revalidated before being served.
+    '''
+    if status not in CACHEABLE_STATUSES:
+        return None
+    cc = parse_cache_control(headers.get('cache-control', ''))
+    if 'authorization' in reqheaders and not ('public' in cc or 's-maxage' in cc):
+        return None
+    ttl = freshness_lifetime(headers, now)
+    if ttl <= 0 and min_ttl and not NOCACHE_DIRECTIVES.intersection(cc):
+        ttl = min_ttl
+    vary = vary_headers(headers, reqheaders)
+    if vary is None or NOSTORE_DIRECTIVES.intersection(cc):
+        return None
+    if ttl <= 0 and not (headers.get('etag') or headers.get('last-modified')):
+        return None
+    kept = tuple((k, v) for k, v in headers.items() if k.lower() not in ignoreheaders)
+    return CacheEntry(status, kept, content, headers.get('etag'), vary, now, now + ttl)
+
+
+class Validators(object):
+    __slots__ = ('etag', 'last_modified', 'expires')
+
+    def __init__(self, etag, last_modified, expires):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.expires = expires
+
+
+def _etags(value):
+    # weak comparison, http://tools.ietf.org/html/rfc2616#section-13.3.3
+    return set(i.strip()[2:] if i.strip().startswith('W/') else i.strip() for i in value.split(','))
+
+
+class _UrlStore(object):
+    '''
+    Small per-url records, striped like LruCache and bounded by number of
+    urls, least recently recorded evicted first.
+    '''
+
+    def __init__(self, maxurls, nstripes, clock):
+        self._stripes = [(threading.Lock(), OrderedDict()) for i in range(nstripes)]
+        self.stripe_maxurls = maxurls // nstripes
+        self.clock = clock
+        self.counters = Counters()
+
+    def _stripe(self, url):
+        return self._stripes[hash(url) % len(self._stripes)]
+
+    def _put(self, url, record):
+        lock, urls = self._stripe(url)
+        with lock:
+            urls.pop(url, None)
+            urls[url] = record
+            while len(urls) > self.stripe_maxurls:
+                urls.popitem(last=False)
+
+    def _discard(self, url):
+        lock, urls = self._stripe(url)
+        with lock:
+            return urls.pop(url, None)
+
+    def get(self, url):
+        lock, urls = self._stripe(url)
+        with lock:
+            return urls.get(url)
+
+    def stats(self):
+        stats = self.counters.snapshot()
+        stats['urls'] = sum(len(urls) for lock, urls in self._stripes)
+        return stats
+
+
+class ValidatorStore(_UrlStore):
+    '''
+    Remembers the latest validators (ETag and Last-Modified) seen upstream
+    for each url, along with how long the response they came with stays
+    fresh.
+    '''
+
+    def __init__(self, maxurls=VALIDATOR_STORE_MAXURLS, nstripes=LRU_CACHE_STRIPES, clock=time.time):
+        _UrlStore.__init__(self, maxurls, nstripes, clock)
+
+    def record(self, url, headers):
+        etag = headers.get('etag')
+        lastmod = headers.get('last-modified')
+        if not (etag or lastmod):
+            return
+        now = self.clock()
+        self._put(url, Validators(etag, lastmod, now + freshness_lifetime(headers, now)))
+
+    def etag(self, url):
+        validators = self.get(url)
+        return validators and validators.etag
+
+    def not_modified(self, url, reqheaders):
+        '''
+        Returns the validators proving the entity unchanged since the
+        client's conditional request headers were made, or None.
+        '''
+        inm = reqheaders.get('if-none-match')
+        ims = reqheaders.get('if-modified-since')
+        if not (inm or ims):
+            return None
+        validators = self.get(url)
+        if validators is None or validators.expires <= self.clock():
+            return None
+        if inm:
+            # If-Modified-Since is ignored if If-None-Match is present
+            tags = _etags(inm)
+            matched = validators.etag and ('*' in tags or _etags(validators.etag) & tags)
+        else:
+            lastmod = validators.last_modified and http_date(validators.last_modified)
+            since = http_date(ims)
+            matched = lastmod and since and lastmod <= since
+        if matched:
+            self.counters.incr('not_modified')
+            return validators
+
+
+class EntityInfo(object):
+    __slots__ = ('total', 'etag', 'content_type', 'accept_ranges', 'first', 'expires')
+
+    def __init__(self, total, etag, content_type, accept_ranges, first, expires):
+        self.total = total
+        self.etag = etag
+        self.content_type = content_type
+        self.accept_ranges = accept_ranges
+        self.first = first # the entity's first byte, if we've seen it
+        self.expires = expires
+
+
+class MetadataCache(_UrlStore):
+    '''
+    Remembers what 200 and 206 responses told us about each url's entity:
+    its total length, ETag, Content-Type, whether upstream supports range
+    requests for it, and its first byte if we've seen it. Enough to answer
+    HEAD requests and "bytes=0-0" size probes without an upstream fetch.
+
+    Like LruCache, records are no longer served once validators has a
+    different ETag for the url.
+    '''
+
+    def __init__(self, maxurls=METADATA_CACHE_MAXURLS, nstripes=LRU_CACHE_STRIPES, validators=None, clock=time.time):
+        _UrlStore.__init__(self, maxurls, nstripes, clock)
+        self.validators = validators or ValidatorStore(clock=clock)
+
+    def record(self, url, status, headers, content, reqheaders):
+        '''
+        Records the entity metadata in a response to a GET (content is its
+        body) or HEAD (content is None), or forgets what we knew if the
+        response can't be stored in a shared cache.
+        '''
+        now = self.clock()
+        cc = parse_cache_control(headers.get('cache-control', ''))
+        ttl = freshness_lifetime(headers, now)
+        storable = (ttl > 0 and not NOSTORE_DIRECTIVES.intersection(cc)
+            and not headers.get('vary') and not headers.get('content-encoding')
+            and ('authorization' not in reqheaders or 'public' in cc or 's-maxage' in cc))
+        try:
+            if not storable:
+                raise ValueError('not storable')
+            if status == 206:
+                start, end, total = parse_content_range(headers.get('content-range', ''))
+                first = content[:1] if content and start == 0 else None
+                accept_ranges = True
+            elif status == 200:
+                total = len(content) if content is not None else int(headers['content-length'])
+                first = content[:1] if content else None
+                accept_ranges = headers.get('accept-ranges', '').lower() == 'bytes'
+            else:
+                raise ValueError('status %d' % status)
+            if not total:
+                raise ValueError('entity length unknown')
+        except (KeyError, ValueError):
+            if self._discard(url):
+                self.counters.incr('forgotten')
+            return
+        etag = headers.get('etag')
+        known = self.get(url)
+        if first is None and known and (known.total, known.etag) == (total, etag):
+            first = known.first
+        self._put(url, EntityInfo(total, etag, headers.get('content-type'), accept_ranges, first, now + ttl))
+        self.counters.incr('recorded')
+
+    def lookup(self, url, first_byte=False):
+        '''
+        Returns the EntityInfo for url if it is fresh and, if first_byte is
+        passed, includes the first byte, and counts the fetch it saves.
+        Otherwise returns None.
+        '''
+        info = self.get(url)
+        if (info is None or info.expires <= self.clock() or (first_byte and not info.first)
+                or (info.etag and self.validators.etag(url) not in (None, info.etag))):
+            self.counters.incr('miss')
+            return None
+        self.counters.incr('fetches_avoided')
+        return info
+
+
+class RedirectCache(_UrlStore):
+    '''
+    Remembers where permanent (301 and 308) redirects point, for as long as
+    their Cache-Control or Expires allow, or REDIRECT_CACHE_SECS if they
+    don't say.
+    '''
+
+    def __init__(self, maxurls=REDIRECT_CACHE_MAXURLS, nstripes=LRU_CACHE_STRIPES, clock=time.time):
+        _UrlStore.__init__(self, maxurls, nstripes, clock)
+
+    def record(self, url, status, headers, target):
+        '''
+        Records that url redirected to target, the (url, scheme, host) from
+        validate.redirect_target, with a response with status and headers,
+        if that's a permanent redirect we may keep.
+        '''
+        if status not in PERMANENT_REDIRECT_STATUSES:
+            return
+        now = self.clock()
+        cc = parse_cache_control(headers.get('cache-control', ''))
+        if 'max-age' in cc or 's-maxage' in cc or 'expires' in headers or NOCACHE_DIRECTIVES.intersection(cc):
+            ttl = freshness_lifetime(headers, now)
+        else:
+            ttl = REDIRECT_CACHE_SECS
+        if ttl <= 0:
+            self._discard(url)
+            return
+        self._put(url, (target, now + ttl))
+        self.counters.incr('recorded')
+
+    def resolve(self, url, maxhops):
+        '''
+        Follows up to maxhops remembered redirects from url. Returns the
+        target they lead to, or None, and how many were followed.
+        '''
+        target = None
+        hops = 0
+        now = self.clock()
+        while hops < maxhops:
+            record = self.get(url)
+            if record is None or record[1] <= now:
+                break
+            target = record[0]
+            url = target[0]
+            hops += 1
+        if hops:
+            self.counters.incr('fetches_avoided', hops)
+        else:
+            self.counters.incr('miss')
+        return target, hops
+
+
+class _Stripe(object):
+    __slots__ = ('lock', 'entries', 'nbytes')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # least recently used first
+        self.nbytes = 0
+
+
+class LruCache(object):
+    '''
+    Thread-safe, byte-budgeted LRU cache of upstream responses.
+
+    Entries are spread over independently locked stripes so concurrent
+    handler threads rarely wait on each other. Each stripe gets an equal
+    share of the byte budget and evicts its own least recently used entries.
+
+    Keys are tuples whose first element is the target url. Entries also
+    record the ETag they were fetched with; once validators records a
+    different ETag for the url, older entries for it are no longer served.
+    '''
+
+    def __init__(self, maxbytes=LRU_CACHE_MAXBYTES, nstripes=LRU_CACHE_STRIPES, validators=None, clock=time.time):
+        self._stripes = [_Stripe() for i in range(nstripes)]
+        self.stripe_maxbytes = maxbytes // nstripes
+        self.validators = validators or ValidatorStore(clock=clock)
+        self.clock = clock
+        self.counters = Counters()
+
+    def _stripe(self, key):
+        return self._stripes[hash(key) % len(self._stripes)]
+
+    def _unlink(self, stripe, key):
+        entry = stripe.entries.pop(key)
+        stripe.nbytes -= entry.size
+        return entry
+
+    def get(self, key, reqheaders, stale_ok=False):
+        '''
+        Returns the entry for key if it is fresh, or, if stale_ok, stale but
+        revalidatable. Callers passing stale_ok should check entry.expires.
+        '''
+        stripe = self._stripe(key)
+        now = self.clock()
+        with stripe.lock:
+            entry = stripe.entries.get(key)
+            if entry is not None and entry.expires <= now:
+                if not entry.conditional_headers():
+                    self._unlink(stripe, key)
+                    self.counters.incr('expired')
+                    entry = None
+                elif not stale_ok:
+                    entry = None # keep it around for revalidation
+            if entry is not None:
+                # OrderedDict.move_to_end is python 3 only
+                stripe.entries[key] = self._unlink(stripe, key)
+                stripe.nbytes += entry.size
+        if entry is None or not entry.matches(reqheaders):
+            self.counters.incr('miss')
+            return None
+        if entry.etag and self.validators.etag(key[0]) not in (None, entry.etag):
+            with stripe.lock:
+                if stripe.entries.get(key) is entry:
+                    self._unlink(stripe, key)
+            self.counters.incr('superseded')
+            self.counters.incr('miss')
+            return None
+        self.counters.incr('hit' if entry.expires > now else 'stale')
+        return entry
+
+    def insert(self, key, entry):
+        if entry.size > self.stripe_maxbytes:
+            self.counters.incr('too_large')
+            return False
+        stripe = self._stripe(key)
+        with stripe.lock:
+            if key in stripe.entries:
+                self._unlink(stripe, key)
+            stripe.entries[key] = entry
+            stripe.nbytes += entry.size
+            while stripe.nbytes > self.stripe_maxbytes:
+                self._unlink(stripe, next(iter(stripe.entries)))
+                self.counters.incr('evicted')
+        self.counters.incr('stored')
+        return True
+
+    def stats(self):
+        stats = self.counters.snapshot()
+        stats['bytes'] = sum(i.nbytes for i in self._stripes)
+        stats['entries'] = sum(len(i.entries) for i in self._stripes)
+        return stats
+
+
+class NullTier(object):
+    '''
+    Stands in for MemcacheTier where there is no memcache.
+    '''
+
+    def __init__(self):
+        self.counters = Counters()
+
+    def get(self, key, reqheaders):
+        return None
+
+    def put(self, key, entry):
+        return False
+
+    def stats(self):
+        return self.counters.snapshot()
+
+
+class MemcacheTier(object):
+    '''
+    Cache tier shared by all instances of the app, backed by memcache.
+
+    memcache values are limited to about 1MB, so bodies larger than
+    MEMCACHE_CHUNK_SIZE are split into chunks stored with set_multi. A
+    manifest holding the response metadata is written after all the chunks,
+    and names them with a random generation token. When reading, if any
+    chunk has been evicted, the manifest is dropped and we report a miss
+    rather than return a corrupted body.
+
+    client can be the google.appengine.api.memcache module, a
+    memcache.Client, or anything else with the same get/get_multi/set_multi/
+    delete methods.
+    '''
+
+    def __init__(self, client, namespace=MEMCACHE_NAMESPACE, clock=time.time):
+        self.client = client
+        self.namespace = namespace
+        self.clock = clock
+        self.counters = Counters()
+
+    @staticmethod
+    def _digest(key):
+        return sha1(repr(key).encode('utf-8')).hexdigest()
+
+    def get(self, key, reqheaders):
+        digest = self._digest(key)
+        try:
+            manifest = self.client.get(MEMCACHE_MANIFEST_KEY % digest, namespace=self.namespace)
+        except Exception as e:
+            logger.warn('memcache get failed: %r', e)
+            manifest = None
+        if manifest is None:
+            self.counters.incr('miss')
+            return None
+        status, headers, etag, vary, stored, expires, gen, nchunks, inline = manifest
+        if expires <= self.clock():
+            self.counters.incr('miss')
+            return None
+        entry = CacheEntry(status, headers, inline, etag, vary, stored, expires)
+        if not entry.matches(reqheaders):
+            self.counters.incr('miss')
+            return None
+        if nchunks:
+            keys = [MEMCACHE_CHUNK_KEY % (digest, gen, i) for i in range(nchunks)]
+            try:
+                chunks = self.client.get_multi(keys, namespace=self.namespace)
+            except Exception as e:
+                logger.warn('memcache get_multi failed: %r', e)
+                self.counters.incr('miss')
+                return None
+            if len(chunks) != nchunks:
+                logger.debug('%d of %d chunks evicted for %r', nchunks - len(chunks), nchunks, key)
+                try:
+                    self.client.delete(MEMCACHE_MANIFEST_KEY % digest, namespace=self.namespace)
+                except Exception as e:
+                    logger.warn('memcache delete failed: %r', e)
+                self.counters.incr('partial_eviction')
+                self.counters.incr('miss')
+                return None
+            entry = CacheEntry(status, headers, b''.join(chunks[k] for k in keys), etag, vary, stored, expires)
+        self.counters.incr('hit')
+        return entry
+
+    def put(self, key, entry):
+        digest = self._digest(key)
+        ttl = int(entry.expires - self.clock())
+        if ttl < 1:
+            return False
+        content = entry.content
+        gen = hexlify(os.urandom(4)).decode('ascii')
+        nchunks = 0
+        inline = content
+        try:
+            if len(content) > MEMCACHE_CHUNK_SIZE:
+                inline = b''
+                chunks = {}
+                for offset in range(0, len(content), MEMCACHE_CHUNK_SIZE):
+                    chunks[MEMCACHE_CHUNK_KEY % (digest, gen, nchunks)] = content[offset:offset+MEMCACHE_CHUNK_SIZE]
+                    nchunks += 1
+                if self.client.set_multi(chunks, time=ttl, namespace=self.namespace):
+                    # set_multi returns the keys it failed to set
+                    self.counters.incr('store_failed')
+                    return False
+            manifest = (entry.status, entry.headers, entry.etag, entry.vary,
+                entry.stored, entry.expires, gen, nchunks, inline)
+            if not self.client.set(MEMCACHE_MANIFEST_KEY % digest, manifest, time=ttl, namespace=self.namespace):
+                self.counters.incr('store_failed')
+                return False
+        except Exception as e:
+            logger.warn('memcache set failed: %r', e)
+            self.counters.incr('store_failed')
+            return False
+        self.counters.incr('stored')
+        return True
+
+    def stats(self):
+        return self.counters.snapshot()
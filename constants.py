@@ -12,23 +12,246 @@ GAE_REQ_MAXBYTES = 1024 * 1024 * 32
 GAE_RES_MAXBYTES = 1024 * 1024 * 32
 GAE_REQ_MAXSECS = 60
 
+# fetching outside App Engine (see backend.PooledBackend)
+POOL_MAXIDLE_PER_HOST = 8 # idle keep-alive connections kept per upstream host
+POOL_IDLE_SECS = 60 # close idle connections after this long
+POOL_READ_SIZE = 1024 * 64
+MAX_REDIRECTS = 5 # as urlfetch when following redirects
+REDIRECT_STATUSES = frozenset({301, 302, 303, 307, 308})
+RETRYABLE_METHODS = frozenset({'GET', 'HEAD', 'PUT', 'DELETE'}) # idempotent, retried once on a stale connection
+
+# with backends that support it (see backend.StreamingResult), upstream
+# 206 responses to range requests are piped through to the client in
+# STREAM_BUFSIZE chunks rather than buffered. streamed responses are not
+# coalesced, and only exact upstream 206s are cached.
+STREAMING_ENABLED = True
+STREAM_BUFSIZE = 1024 * 64
+
 RANGE_REQ_SIZE = 2000000 # bytes. corresponds to Lantern's CHUNK_SIZE.
+# clients sending H_FANOUT may request up to this many bytes at once, which
+# we fetch as concurrent RANGE_REQ_SIZE sub-ranges
+FANOUT_MAXBYTES = RANGE_REQ_SIZE * (GAE_RES_MAXBYTES // RANGE_REQ_SIZE)
+# http://code.google.com/appengine/docs/python/urlfetch/asynchronousrequests.html
+FANOUT_MAX_RPCS = 10 # simultaneous async urlfetch calls per request
+MULTIRANGE_MAX_PARTS = 16 # ranges accepted in a single multi-range request
+
+# per-host sub-range size for fanned out fetches (see upstream.ChunkSizer),
+# also recommended to clients in H_CHUNK_SIZE. aims for chunks taking
+# CHUNK_TARGET_SECS to fetch, at most CHUNK_DEADLINE_SHARE of the fetch
+# deadline, growing at most CHUNK_MAX_GROWTH times per sample. clients not
+# sending H_FANOUT are never told, or allowed, more than RANGE_REQ_SIZE.
+CHUNK_TARGET_SECS = 5
+CHUNK_DEADLINE_SHARE = 0.5
+CHUNK_MIN_SIZE = 1024 * 256
+CHUNK_MAX_SIZE = FANOUT_MAXBYTES # a multiple of RANGE_REQ_SIZE under GAE_RES_MAXBYTES
+CHUNK_SIZE_STEP = 1024 * 64 # recommendations are multiples of this
+CHUNK_RATE_MINBYTES = 1024 * 64 # smaller fetches only inform the latency estimate
+CHUNK_MIN_SAMPLES = 3 # throughput samples needed before departing from RANGE_REQ_SIZE
+CHUNK_EWMA_ALPHA = 0.2 # weight of each new sample in the moving averages
+CHUNK_MAX_GROWTH = 2
+CHUNK_MAX_HOSTS = 1024
+
+# upstream fetches get what's left of the request's GAE_REQ_MAXSECS, up to
+# URLFETCH_REQ_MAXSECS, keeping DEADLINE_RESERVE_SECS back for responding
+DEADLINE_RESERVE_SECS = 2
+FETCH_MIN_DEADLINE_SECS = 1
+
+# hedged fetches (see upstream.Hedger), with backends whose wait_any takes a
+# timeout. a GET or HEAD still unanswered after the HEDGE_PERCENTILE latency
+# of its host is repeated, so about 1 in 20 fetches from a host is doubled.
+HEDGE_ENABLED = True
+HEDGE_METHODS = frozenset({'get', 'head'})
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 20 # fetches from a host before hedging any
+HEDGE_MIN_DELAY_SECS = 0.05
+HEDGE_MAX_HOSTS = 256
+
+# server-side redirect following, for clients sending H_FOLLOW_REDIRECTS
+# with the most redirects to follow (or any other value for
+# REDIRECT_FOLLOW_MAX). permanent redirects are remembered (see
+# cache.RedirectCache), so later such requests for the old url go straight
+# to the new one.
+REDIRECT_FOLLOW_MAX = MAX_REDIRECTS
+PERMANENT_REDIRECT_STATUSES = frozenset({301, 308})
+REDIRECT_CACHE_SECS = 60 * 60 * 24 # for permanent redirects that don't say how long they're fresh
+REDIRECT_CACHE_MAXURLS = 1024 * 4
+
+# per-host circuit breaker (see upstream.CircuitBreaker). after
+# BREAKER_FAILURES consecutive failed fetches from a host, requests for it
+# fail fast for BREAKER_COOLDOWN_SECS, then one trial request is let through
+# every BREAKER_COOLDOWN_SECS until one succeeds.
+BREAKER_ENABLED = True
+BREAKER_FAILURES = 5
+BREAKER_COOLDOWN_SECS = 30
+BREAKER_STATUSES = frozenset({500, 502, 503, 504}) # upstream responses counted as failures
+BREAKER_MAX_HOSTS = 1024
+# invalid urls and hosts that don't resolve are remembered for this long
+NEGATIVE_CACHE_SECS = 60
+NEGATIVE_CACHE_MAXKEYS = 1024
+# optionally share open circuits across instances in memcache. an instance
+# only looks there after a fetch from the host has failed, so healthy hosts
+# cost nothing.
+BREAKER_MEMCACHE_ENABLED = False
+BREAKER_MEMCACHE_NAMESPACE = 'laeproxy-breaker'
+
+# read-ahead for clients downloading a url chunk by chunk (see
+# upstream.Prefetcher). when a client's range request starts where its last
+# one for the url ended, the next PREFETCH_DEPTH ranges of the same size are
+# fetched alongside it and kept for up to PREFETCH_TTL_SECS for the client
+# to ask for. in-flight and unclaimed prefetches share PREFETCH_MAXBYTES,
+# counting the bytes they got once they're in. urls served with the
+# entire entity in answer to range requests aren't prefetched for
+# PREFETCH_RANGELESS_SECS. where rpcs can't outlive the request that made
+# them, they are waited for before it is answered, so get at most
+# PREFETCH_MAX_WAIT_SECS.
+PREFETCH_ENABLED = True
+PREFETCH_DEPTH = 3
+PREFETCH_MAXBYTES = RANGE_REQ_SIZE * PREFETCH_DEPTH * 4
+PREFETCH_TTL_SECS = 60
+PREFETCH_MAX_STREAMS = 1024 # (client, url) pairs followed
+PREFETCH_RANGELESS_SECS = 3600
+PREFETCH_MAX_WAIT_SECS = 5
+
+# admission control (see admission.RateLimiter). requests from clients over
+# their limits, and fetches from upstream hosts over theirs, are refused with
+# a 503 and a Retry-After before any upstream work is done. clients are
+# limited in requests and bytes sent to them, hosts in fetches and bytes
+# fetched. rates are per second, None for no limit.
+ADMISSION_ENABLED = True
+CLIENT_REQ_RATE = 20
+CLIENT_REQ_BURST = 200
+CLIENT_BYTE_RATE = 1024 * 1024 * 8
+CLIENT_BYTE_BURST = GAE_RES_MAXBYTES * 4
+HOST_REQ_RATE = 200
+HOST_REQ_BURST = 1000
+HOST_BYTE_RATE = None
+HOST_BYTE_BURST = None
+ADMISSION_MAX_KEYS = 1024 * 8 # clients or hosts tracked, per limiter
+ADMISSION_STRIPES = 8
+# optionally add up what each client and host was admitted across instances
+# in memcache, in fixed windows of ADMISSION_MEMCACHE_WINDOW seconds. each
+# instance adds its counts for a key at most every ADMISSION_MEMCACHE_INTERVAL
+# seconds, and refuses keys over their limits for the rest of the window.
+ADMISSION_MEMCACHE_ENABLED = False
+ADMISSION_MEMCACHE_NAMESPACE = 'laeproxy-admission'
+ADMISSION_MEMCACHE_WINDOW = 60
+ADMISSION_MEMCACHE_INTERVAL = 5
+
+# urls fetched (HEAD) when App Engine warms up a new instance (see
+# WarmupHandler), so that connections to them are open by its first request
+WARMUP_URLS = ()
+WARMUP_DEADLINE_SECS = 10
+
+# coalescing of identical concurrent upstream requests (see upstream.py)
+COALESCE_METHODS = frozenset({'get', 'head'})
+COALESCE_MAXWAITSECS = URLFETCH_REQ_MAXSECS + 5 # the leader's fetch gives up before this
+COALESCE_STRIPES = 8
+
+# batch endpoint (see BatchHandler)
+BATCH_MAX_ENTRIES = 32
+BATCH_RES_MAXBYTES = GAE_RES_MAXBYTES - 1024 * 1024 # headroom for framing
+BATCH_CONTENT_TYPE = 'application/x-laeproxy-batch'
+BATCH_METHODS = METHODS - PAYLOAD_METHODS
 
 H_LAEPROXY_VER = 'X-laeproxy-version' # stamp responses with our version number
+LAEPROXY_VERSION = '0.7.1' # http://semver.org/
 # absence of the following 2 headers means we responded before forwarding the request
 H_UPSTREAM_SERVER = 'X-laeproxy-upstream-server'
 H_UPSTREAM_STATUS_CODE = 'X-laeproxy-upstream-status-code'
 H_UPSTREAM_CONTENT_RANGE = 'X-laeproxy-upstream-content-range' # if 206
 H_TRUNCATED = 'X-laeproxy-truncated' # indicates urlfetch truncated response
+# sent by clients to opt in to ranges up to FANOUT_MAXBYTES. in responses,
+# the number of sub-ranges fetched, or 'fallback' if we fell back to
+# fetching a single RANGE_REQ_SIZE range
+H_FANOUT = 'X-laeproxy-fanout'
+H_COALESCED = 'X-laeproxy-coalesced' # response shared with a concurrent identical request
+H_CHUNK_SIZE = 'X-laeproxy-chunk-size' # range size recommended for the upstream host
+H_STREAMED = 'X-laeproxy-streamed' # body piped through as it arrived from upstream
+H_FOLLOW_REDIRECTS = 'X-laeproxy-follow-redirects' # sent by clients to have us follow redirects
+H_FINAL_URL = 'X-laeproxy-final-url' # url the response came from, if we followed redirects
+H_SERVER_TIMING = 'Server-Timing' # durations of the phases of handling the request
 
 H_LAEPROXY_RESULT = 'X-laeproxy-result' # possible results:
 RETRIEVED_FROM_NET = 'Retrieved from network %s'
+RETRIEVED_FROM_CACHE = 'Retrieved from cache %s'
+RETRIEVED_FROM_MEMCACHE = 'Retrieved from memcache %s'
+RETRIEVED_FROM_ENTITY_CACHE = 'Retrieved from cached entity %s'
+RETRIEVED_FROM_METADATA = 'Answered from cached entity metadata %s'
+RETRIEVED_FROM_PREFETCH = 'Retrieved from prefetch %s'
+REVALIDATED_CACHE = 'Revalidated cache with upstream %s'
+NOT_MODIFIED_LOCAL = 'Not modified per cached validators %s'
 IGNORED_RECURSIVE = 'Ignored recursive request'
 REQ_TOO_LARGE = 'Request size exceeds urlfetch limit'
 MISSED_DEADLINE_URLFETCH = 'Missed urlfetch deadline'
 MISSED_DEADLINE_GAE = ' Missed GAE deadline'
 EXCEEDED_URLFETCH_QUOTA = 'Exceeded urlfetch quota'
+UPSTREAM_NOT_FOUND = 'Upstream host not found'
+CIRCUIT_OPEN = 'Upstream host failing, circuit open'
+NEGATIVE_CACHED = 'Recently failed, not retried: %s'
+CLIENT_RATE_LIMITED = 'Client over rate limit'
+HOST_RATE_LIMITED = 'Upstream host over rate limit'
 UNEXPECTED_ERROR = 'Unexpected error: %r'
+BATCH_TOO_LARGE = 'Batch response size limit reached'
+
+# logging. on App Engine laeproxy logs at LOG_LEVEL (the dev server logs
+# everything), and a single line of JSON for a REQUEST_LOG_SAMPLE fraction
+# of requests, or REQUEST_LOG_ERROR_SAMPLE of those answered with a 5xx,
+# to the 'laeproxy.requests' logger (see log_request)
+LOG_LEVEL = 'INFO'
+REQUEST_LOG_ENABLED = True
+REQUEST_LOG_SAMPLE = 0.01
+REQUEST_LOG_ERROR_SAMPLE = 1.0
+
+# latency is broken down by the H_LAEPROXY_RESULT values below, anything
+# else is classed as 'error' or 'other' depending on the status code
+RESULT_CLASSES = (
+    (RETRIEVED_FROM_NET, 'net'),
+    (RETRIEVED_FROM_CACHE, 'cache'),
+    (RETRIEVED_FROM_MEMCACHE, 'memcache'),
+    (RETRIEVED_FROM_ENTITY_CACHE, 'entity'),
+    (RETRIEVED_FROM_METADATA, 'metadata'),
+    (RETRIEVED_FROM_PREFETCH, 'prefetch'),
+    (REVALIDATED_CACHE, 'revalidated'),
+    (NOT_MODIFIED_LOCAL, 'not_modified'),
+    (CLIENT_RATE_LIMITED, 'limited'),
+    (HOST_RATE_LIMITED, 'limited'),
+)
+
+# latency histograms (see stats.LatencyStats). buckets grow by 20% from
+# 0.1ms, so the last of 80 covers everything over ~180s
+LATENCY_MIN_MS = 0.1
+LATENCY_BUCKET_GROWTH = 1.2
+LATENCY_BUCKETS = 80
+LATENCY_PERCENTILES = (50, 95, 99)
+LATENCY_MAX_KEYS = 64 # per dimension, e.g. upstream hosts
+STATS_OTHER_KEY = '(other)' # stands in for keys over the limit
+
+# admin routes (stats and warmup). app.yaml restricts them to admins on
+# App Engine. run standalone (see wsgi.py) they are only answered for
+# loopback clients, or if ADMIN_TOKEN is set, for requests carrying it in
+# an H_ADMIN_TOKEN header (e.g. behind a reverse proxy, where every client
+# looks like a loopback one)
+ADMIN_TOKEN = None
+H_ADMIN_TOKEN = 'X-laeproxy-admin-token'
+
+# admin stats route (see StatsHandler)
+STATS_MAX_HOSTS = 64 # upstream hosts counted individually
+# optionally add up counters across instances in memcache. each instance
+# adds its counts to memcache at most every STATS_MEMCACHE_INTERVAL seconds.
+STATS_MEMCACHE_ENABLED = False
+STATS_MEMCACHE_INTERVAL = 60
+STATS_MEMCACHE_NAMESPACE = 'laeproxy-stats'
+STATS_MEMCACHE_INDEX_KEY = 'index'
+STATS_MEMCACHE_MAXKEYS = 1024
+# label names for the keyed counters in the Prometheus text format
+PROMETHEUS_LABELS = {
+    'requests': 'method',
+    'responses': 'status',
+    'errors': 'type',
+    'host_fetches': 'host',
+    'host_bytes': 'host',
+    'hosts': 'host', # per-host stats of upstream.ChunkSizer and Hedger
+}
 
 # remove hop-by-hop headers
 # http://www.w3.org/Protocols/rfc2616/rfc2616-sec13.html#sec13.5.1
@@ -42,4 +265,44 @@ HOPBYHOP = frozenset({
     'transfer-encoding',
     'upgrade',
 })
-IGNOREHEADERS = HOPBYHOP | {'host'}
+# request headers meant for laeproxy, never forwarded upstream
+LAEPROXY_REQ_HEADERS = frozenset({H_FANOUT.lower(), H_FOLLOW_REDIRECTS.lower()})
+IGNOREHEADERS = HOPBYHOP | {'host'} | LAEPROXY_REQ_HEADERS
+# request headers not sent on when following a redirect to another host
+CREDENTIAL_HEADERS = frozenset({'authorization', 'cookie', 'proxy-authorization'})
+
+# in-instance response cache (see cache.py). each stripe gets an equal share
+# of the budget, so keep the share comfortably above RANGE_REQ_SIZE.
+LRU_CACHE_MAXBYTES = 1024 * 1024 * 32
+LRU_CACHE_STRIPES = 8
+VALIDATOR_STORE_MAXURLS = 1024 * 8
+VALIDATOR_STATUSES = frozenset({200, 206, 304}) # responses whose validators we record
+CONDITIONAL_METHODS = frozenset({'get', 'head'}) # may be answered with a 304
+CONDITIONAL_HEADERS = frozenset({'if-none-match', 'if-modified-since', 'if-match', 'if-unmodified-since', 'if-range'})
+# per-url entity metadata answering HEAD requests and size probes (see
+# cache.MetadataCache)
+METADATA_CACHE_MAXURLS = 1024 * 8
+METADATA_METHODS = frozenset({'get', 'head'})
+CACHE_ENTRY_OVERHEAD = 512 # rough per-entry bookkeeping cost in bytes
+CACHE_HEURISTIC_MAXSECS = 60 * 60 * 24
+CACHEABLE_STATUSES = frozenset({200, 206})
+# keep the entire entity when upstream answers a range request with a 200,
+# and serve the client's following range requests for it from memory.
+# entities can be up to URLFETCH_RES_MAXBYTES, hence the single stripe.
+ENTITY_CACHE_ENABLED = True
+ENTITY_CACHE_MAXBYTES = 1024 * 1024 * 40
+ENTITY_CACHE_STRIPES = 1
+# how long to keep entities whose responses carry no freshness information,
+# long enough for a client to fetch the remaining chunks
+ENTITY_CACHE_MINSECS = 60
+NOCACHE_DIRECTIVES = frozenset({'no-store', 'no-cache', 'private'})
+NOSTORE_DIRECTIVES = frozenset({'no-store', 'private'})
+# headers of a 304 that must not replace those of the entry it revalidates
+NOT_MODIFIED_KEEP_HEADERS = frozenset({'content-length', 'content-range', 'content-type', 'content-encoding'})
+
+# memcache tier shared across instances (see cache.MemcacheTier)
+# http://code.google.com/appengine/docs/python/memcache/#Quotas_and_Limits
+MEMCACHE_NAMESPACE = 'laeproxy'
+MEMCACHE_CHUNK_SIZE = 1000 * 1000 - 1024 * 8 # leave room under the 1MB limit for pickling and the key
+MEMCACHE_MANIFEST_KEY = 'm1:%s'
+MEMCACHE_CHUNK_KEY = 'c1:%s:%s:%d'
@@ -41,21 +41,35 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-__version__ = '0.7.1' # http://semver.org/
-
+from admission import RateLimiter
+from backend import HostNotFoundError, default_backend
+from cache import LruCache, MemcacheTier, MetadataCache, NullTier, RedirectCache, ValidatorStore, make_entry, request_allows_cache
 from constants import *
-from datetime import datetime
 from functools import wraps
+from math import ceil
 from os import environ
-from pprint import pformat
-from traceback import format_exc
-from urllib import unquote
+from random import random
+from ranges import extract, format_content_range, multipart_byteranges, parse_content_range, parse_range, view
+from stats import Counters, KeyCap, LatencyStats, MemcacheAggregate, PhaseTimer, monotonic, nest, prometheus_text
+from upstream import ChunkSizer, CircuitBreaker, CoalesceTimeout, Hedger, Prefetcher, SingleFlight
+from uuid import uuid4
+from validate import (Rejected, absolute_location, check_payload, check_ranges, conn_header_set, copy_headers,
+    error_result, now, redirect_limit, redirect_target, strip_headers, target_url)
 
-from google.appengine.api import urlfetch
-from google.appengine.ext import webapp
-from google.appengine.runtime import DeadlineExceededError
-from google.appengine.runtime.apiproxy_errors import OverQuotaError
+try:
+    from google.appengine.api import memcache
+    from google.appengine.ext import webapp
+    from google.appengine.runtime import DeadlineExceededError
+    from google.appengine.runtime.apiproxy_errors import OverQuotaError
+    STANDALONE = False
+except ImportError: # not on app engine, see wsgi.py
+    import webapp2 as webapp
+    from backend import DeadlineExceededError, OverQuotaError
+    memcache = None
+    STANDALONE = True
 
+import hmac
+import json
 import logging
 
 logformatter = logging.Formatter(fmt='%(levelname)-8s %(asctime)s %(filename)s:%(lineno)s] %(message)s')
@@ -63,72 +77,738 @@ loghandler = logging.StreamHandler()
 loghandler.setFormatter(logformatter)
 logger = logging.getLogger('laeproxy')
 logger.addHandler(loghandler)
-logger.setLevel(logging.DEBUG)
-
-fetch = urlfetch.fetch
-DownloadError = urlfetch.DownloadError
-InvalidURLError = urlfetch.InvalidURLError
+requestlog = logging.getLogger('laeproxy.requests') # see log_request
 
-now = datetime.utcnow
+__version__ = LAEPROXY_VERSION
 
 PROD = environ.get('SERVER_SOFTWARE', '').startswith('Google App Engine')
 DEV = not PROD
 
+logger.setLevel(LOG_LEVEL if PROD else logging.DEBUG)
+
+validators = ValidatorStore()
+responsecache = LruCache(validators=validators)
+sharedcache = MemcacheTier(memcache) if memcache else NullTier()
+entitycache = LruCache(ENTITY_CACHE_MAXBYTES, ENTITY_CACHE_STRIPES, validators)
+metadatacache = MetadataCache(validators=validators)
+redirects = RedirectCache()
+coalescer = SingleFlight()
+chunksizes = ChunkSizer()
+hedger = Hedger()
+prefetcher = Prefetcher()
+breaker = CircuitBreaker(client=memcache.Client() if memcache and BREAKER_MEMCACHE_ENABLED else None)
+clientlimits = RateLimiter(CLIENT_REQ_RATE, CLIENT_REQ_BURST, CLIENT_BYTE_RATE, CLIENT_BYTE_BURST,
+    client=memcache.Client() if memcache and ADMISSION_MEMCACHE_ENABLED else None)
+hostlimits = RateLimiter(HOST_REQ_RATE, HOST_REQ_BURST, HOST_BYTE_RATE, HOST_BYTE_BURST,
+    client=memcache.Client() if memcache and ADMISSION_MEMCACHE_ENABLED else None)
+latency = LatencyStats()
+
+# request path counters, see StatsHandler
+started = monotonic()
+traffic = Counters()
+hostkey = KeyCap(STATS_MAX_HOSTS)
+components = {
+    'responsecache': responsecache,
+    'entitycache': entitycache,
+    'sharedcache': sharedcache,
+    'validators': validators,
+    'metadatacache': metadatacache,
+    'redirects': redirects,
+    'coalescer': coalescer,
+    'chunksizes': chunksizes,
+    'hedger': hedger,
+    'breaker': breaker,
+    'prefetcher': prefetcher,
+    'clientlimits': clientlimits,
+    'hostlimits': hostlimits,
+    }
+
+
+def use_backend(backend):
+    '''
+    Makes laeproxy fetch through backend (see backend.py).
+    '''
+    global fetch, fetch_async, fetch_stream, fetch_stream_async, wait_any, hedging, detached, DownloadError, InvalidURLError
+    fetch = backend.fetch
+    fetch_stream = getattr(backend, 'fetch_stream', None)
+    fetch_async = backend.fetch_async
+    fetch_stream_async = getattr(backend, 'fetch_stream_async', None)
+    wait_any = backend.wait_any
+    hedging = HEDGE_ENABLED and getattr(backend, 'timed_wait', False)
+    detached = getattr(backend, 'detached', False)
+    DownloadError = backend.DownloadError
+    InvalidURLError = backend.InvalidURLError
+    components['backend'] = backend
+
+use_backend(default_backend())
+
+aggregate = memcache and MemcacheAggregate(memcache.Client(),
+    dict([('traffic', traffic)] + [(k, v.counters) for k, v in components.items()]))
+
 
 def headers_str(headers):
+    from pprint import pformat # only used for debug logging, so loaded lazily
     return pformat(sorted(headers.items(), key=lambda i: i[0].lower()))
 
 
-def copy_headers(frm, to, ignore):
-    ignored = []
-    for k, v in frm.items():
-        if ignore and k.lower() not in ignore:
-            to[k] = v
-        else:
-            ignored.append((k, v))
-    return ignored
+def instance_stats():
+    stats = dict((k, v.stats()) for k, v in components.items())
+    stats['traffic'] = nest(traffic.snapshot())
+    stats['latency'] = latency.stats()
+    stats['uptime'] = int(monotonic() - started)
+    return stats
 
 
-def conn_header_set(headers):
-    conn_header = headers.get('connection', '').lower()
-    stripped = (i.strip() for i in conn_header.split(','))
-    return frozenset(filter(None, stripped) if conn_header else ())
+def fetch_deadline(started):
+    '''
+    Returns the deadline for an upstream fetch made for a request that
+    started at started (monotonic): what's left of GAE_REQ_MAXSECS after
+    keeping DEADLINE_RESERVE_SECS back for responding, between
+    FETCH_MIN_DEADLINE_SECS and URLFETCH_REQ_MAXSECS.
+    '''
+    left = GAE_REQ_MAXSECS - DEADLINE_RESERVE_SECS - (monotonic() - started)
+    return max(FETCH_MIN_DEADLINE_SECS, min(URLFETCH_REQ_MAXSECS, left))
 
 
-class LaeproxyHandler(webapp.RequestHandler):
+def count_fetched(host, fetched):
+    count_outcome(host, fetched.status_code)
+    count_upstream(host, len(fetched.content))
+    if fetched.content_was_truncated:
+        traffic.incr('truncated')
 
-    def _extract_url(self, req):
-        # reconstruct original url
-        path = req.path_qs.lstrip('/')
-        try:
-            scheme, rest = path.split('/', 1)
-            parts = rest.split('/', 1)
-        except ValueError:
-            logger.debug('Invalid url: %s', path)
-            self.response.headers[H_LAEPROXY_RESULT] = 'Invalid url'
-            return self.error(404)
+
+def count_outcome(host, status):
+    '''
+    Feeds the circuit breaker the status of a response from host.
+    '''
+    if status in BREAKER_STATUSES:
+        breaker.failed(host)
+    else:
+        breaker.succeeded(host)
+
+
+def count_upstream(host, nbytes):
+    if ADMISSION_ENABLED:
+        hostlimits.charge(host, nbytes)
+    host = hostkey(host)
+    traffic.incr(('host_fetches', host))
+    traffic.incr(('host_bytes', host), nbytes)
+    traffic.incr('bytes_from_upstream', nbytes)
+
+
+def count_sent(client, nbytes):
+    if ADMISSION_ENABLED:
+        clientlimits.charge(client, nbytes)
+    traffic.incr('bytes_to_client', nbytes)
+
+
+def admission(limiter, key, cost=1):
+    '''
+    Returns the Retry-After to refuse a request for key with if it's over
+    limiter's rate limits, otherwise None.
+    '''
+    if not ADMISSION_ENABLED:
+        return None
+    wait = limiter.admit(key, cost)
+    return str(int(ceil(wait))) if wait else None
+
+
+def count_request(method, status, payloadlen):
+    traffic.incr(('requests', method))
+    traffic.incr(('responses', '%dxx' % (status // 100)))
+    traffic.incr('bytes_from_client', payloadlen or 0)
+    if STATS_MEMCACHE_ENABLED and aggregate:
+        aggregate.maybe_flush()
+
+
+def fetch_error(url, e, host=None):
+    '''
+    Returns the status code and H_LAEPROXY_RESULT to respond with when
+    fetching url from host raised e, and feeds the circuit breaker.
+    '''
+    traffic.incr(('errors', type(e).__name__))
+    status, result = error_result(url, e, host, InvalidURLError, HostNotFoundError,
+        (DownloadError, CoalesceTimeout), OverQuotaError)
+    if status == 404:
+        breaker.remember(url, status, result)
+    elif status == 502:
+        breaker.remember(host, status, result)
+    elif isinstance(e, DownloadError):
+        breaker.failed(host)
+    return status, result
+
+
+def refusal(url, host):
+    '''
+    Returns the (status, H_LAEPROXY_RESULT, Retry-After) to fail a fetch of
+    url from host fast with, if url or host recently failed for good, host
+    is over its rate limits or host's circuit is open, otherwise None.
+    '''
+    for key in (url, host):
+        hit = BREAKER_ENABLED and breaker.negative(key)
+        if hit:
+            status, result = hit
+            return status, NEGATIVE_CACHED % result, None
+    retry = admission(hostlimits, host)
+    if retry:
+        return 503, HOST_RATE_LIMITED, retry
+    if not BREAKER_ENABLED:
+        return None
+    wait = breaker.allow(host)
+    if wait:
+        return 503, CIRCUIT_OPEN, str(int(ceil(wait)))
+    return None
+
+
+def warm_up():
+    '''
+    Readies a new instance for its first requests: loads what the request
+    path would otherwise load lazily, makes a first memcache call, and opens
+    connections for WARMUP_URLS. Returns how many of those were fetched.
+    '''
+    if logger.isEnabledFor(logging.DEBUG):
+        headers_str({})
+    if memcache:
+        memcache.get('warmup', namespace=MEMCACHE_NAMESPACE)
+    rpcs = [(url, fetch_async(url,
+        method='HEAD',
+        follow_redirects=False,
+        deadline=WARMUP_DEADLINE_SECS,
+        validate_certificate=True,
+        )) for url in WARMUP_URLS]
+    fetched = 0
+    for url, rpc in rpcs:
         try:
-            rest = parts[1]
-        except IndexError:
-            rest = ''
-        host = unquote(parts[0])
-        if not host:
-            logger.debug('No host specified: %s', path)
-            self.response.headers[H_LAEPROXY_RESULT] = 'Missing host'
-            return self.error(404)
-        if req.host.lower() == host.lower():
-            logger.info('Ignoring recursive request: %s', req.url)
-            self.response.headers[H_LAEPROXY_RESULT] = IGNORED_RECURSIVE
+            rpc.get_result()
+            fetched += 1
+        except Exception as e:
+            logger.warn('Warming up connection for %s failed: %r', url, e)
+    return fetched
+
+
+def sampled(status):
+    '''
+    Returns whether to log a request answered with status (see log_request).
+    '''
+    rate = REQUEST_LOG_ERROR_SAMPLE if status >= 500 else REQUEST_LOG_SAMPLE
+    return REQUEST_LOG_ENABLED and rate > 0 and (rate >= 1 or random() < rate)
+
+
+def log_request(**record):
+    '''
+    Logs a single line of JSON describing a request, for sampled requests.
+    '''
+    requestlog.info('request %s', json.dumps(record, separators=(',', ':'), sort_keys=True))
+
+
+def result_class(status, result):
+    '''
+    Classifies a response by its status and H_LAEPROXY_RESULT value, for
+    breaking down latency.
+    '''
+    if result.endswith(MISSED_DEADLINE_GAE):
+        return 'deadline'
+    for template, cls in RESULT_CLASSES:
+        if result.startswith(template.split('%')[0]):
+            return cls
+    return 'error' if status >= 400 else 'other'
+
+
+def admin_allowed(req):
+    '''
+    Returns whether req may use the admin routes. On App Engine app.yaml
+    restricts them to admins. Run standalone, they need ADMIN_TOKEN in the
+    H_ADMIN_TOKEN header if it is set, otherwise a loopback client.
+    '''
+    if not STANDALONE:
+        return True
+    if ADMIN_TOKEN:
+        return hmac.compare_digest(str(req.headers.get(H_ADMIN_TOKEN, '')), str(ADMIN_TOKEN))
+    return req.remote_addr == '::1' or (req.remote_addr or '').startswith('127.')
+
+
+def admin_only(method):
+    '''
+    Answers requests for the decorated handler method with a 404, as if it
+    weren't routed, unless admin_allowed.
+    '''
+    @wraps(method)
+    def wrapper(self, *args, **kw):
+        if not admin_allowed(self.request):
+            logger.warn('Refused %s from %s', self.request.path, self.request.remote_addr)
             return self.error(404)
-        url = scheme + '://' + host + '/' + rest
-        logger.debug('Target url: %s', url)
-        return url, scheme, host
+        return method(self, *args, **kw)
+    return wrapper
+
+
+def truncated_headers(headers, length):
+    '''
+    Returns a list of (name, value) headers for a response whose body was
+    cut short to length bytes: marked with H_TRUNCATED, with any
+    Content-Range corrected to match.
+    '''
+    out = [(H_TRUNCATED, 'true')]
+    for k, v in headers:
+        if k.lower() == 'content-range':
+            try:
+                start, end, total = parse_content_range(v)
+            except ValueError:
+                pass
+            else:
+                v = format_content_range(start, start + length - 1, total)
+        out.append((k, v))
+    return out
+
+
+class LaeproxyHandler(webapp.RequestHandler):
+
+    def _extract_url(self, req):
+        return target_url(req.path_qs, req.host)
 
     def _send_response(self, fheaders, resheaders, ignoreheaders, content):
         ignored = copy_headers(fheaders, resheaders, ignoreheaders)
         ignored and logger.debug('Stripped response headers: %s', ignored)
-        logger.debug('final response headers:\n%s', headers_str(resheaders))
-        self.response.out.write(content)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('final response headers:\n%s', headers_str(resheaders))
+        self.timer.mark('process')
+        # the response body must be made of strs, this is the only copy we
+        # make. content may be a list of parts, written one by one.
+        nbytes = 0
+        for part in content if isinstance(content, list) else [content]:
+            if isinstance(part, memoryview):
+                part = part.tobytes()
+            elif isinstance(part, bytearray):
+                part = bytes(part)
+            self.response.out.write(part)
+            nbytes += len(part)
+        self.timer.mark('write')
+        self.sent += nbytes
+        count_sent(self.request.remote_addr, nbytes)
+
+    def _send_range(self, fheaders, resheaders, ignoreheaders, content, start, end, offset=0, total=None):
+        '''
+        Responds with bytes start through end (inclusive) of the entity as a
+        206. content holds the entity's bytes from offset on, and is the
+        entire entity if total is not passed. end may lie past the end of
+        content.
+        '''
+        if total is None:
+            total = len(content)
+        last = offset + len(content) - 1
+        if start > last:
+            logger.debug('Range start %d lies beyond entity of length %d', start, total)
+            resheaders['Content-Range'] = 'bytes */%d' % total
+            return self.error(416)
+        end = min(end, last)
+        body = view(content, start - offset, end - offset)
+        trimmed = len(content) - len(body)
+        trimmed and logger.debug('Trimmed %d bytes outside of requested range', trimmed)
+        self.response.set_status(206)
+        resheaders['Content-Range'] = format_content_range(start, end, total)
+        ignoreheaders = ignoreheaders | {'content-length', 'content-range'}
+        return self._send_response(fheaders, resheaders, ignoreheaders, body)
+
+    def _fetch_ranges(self, url, reqheaders, ranges, concurrency=FANOUT_MAX_RPCS):
+        '''
+        Fetches each (start, end) range of url with concurrent async urlfetch
+        calls, at most concurrency at a time. Yields (start, end, result)
+        in order, where result is the urlfetch result or the exception
+        raised fetching it. The next range is only started once the caller
+        asks for another, so no more are started once it stops.
+        '''
+        headers = dict((k, v) for k, v in reqheaders.items() if k.lower() != 'range')
+
+        def start_fetch(i):
+            return fetch_async(url,
+                method='GET',
+                headers=dict(headers, Range='bytes=%d-%d' % ranges[i]),
+                allow_truncated=True,
+                follow_redirects=False,
+                deadline=fetch_deadline(self.timer.started),
+                validate_certificate=True,
+                )
+
+        rpcs = [start_fetch(i) for i in range(min(concurrency, len(ranges)))]
+        try:
+            for i, (start, end) in enumerate(ranges):
+                try:
+                    result = rpcs[i].get_result()
+                except Exception as e:
+                    result = e
+                yield start, end, result
+                if i + concurrency < len(ranges):
+                    rpcs.append(start_fetch(i + concurrency))
+        finally:
+            for rpc in rpcs[i + 1:]:
+                getattr(rpc, 'discard', lambda: None)()
+
+    def _fanout(self, url, reqheaders, range_start, range_end):
+        '''
+        Fetches range_start..range_end as concurrent sub-ranges of the size
+        recommended for the host (see upstream.ChunkSizer) and responds with
+        them as a single 206.
+
+        Stops at the first sub-range that fails, is truncated, or doesn't
+        match what we asked for, and responds with the sub-ranges before it.
+        Returns False without responding if not even the first one
+        succeeded.
+        '''
+        chunk = chunksizes.recommend(self.upstream_host)
+        subranges = [(i, min(i + chunk, range_end + 1) - 1)
+            for i in range(range_start, range_end + 1, chunk)]
+        first = None
+        parts = []
+        total = None
+        for start, end, fetched in self._fetch_ranges(url, reqheaders, subranges):
+            try:
+                if isinstance(fetched, Exception):
+                    traffic.incr(('errors', type(fetched).__name__))
+                    raise fetched
+                count_fetched(self.upstream_host, fetched)
+                assert fetched.status_code == 206, 'status %d' % fetched.status_code
+                assert not fetched.content_was_truncated, 'truncated'
+                start, last, length, body = extract(206, fetched.headers, fetched.content, start, end)
+                assert length is not None and total in (None, length), 'entity length changed'
+                total = length
+                assert last == min(end, total - 1), 'Content-Range mismatch'
+            except Exception as e:
+                logger.warn('Sub-range %d-%d of %s failed: %r', start, end, url, e)
+                break
+            first = first or fetched
+            parts.append(body)
+            if last == total - 1:
+                break
+        self.timer.mark('fetch')
+        if not parts:
+            return False
+
+        # the parts are contiguous, so they are sent as they are rather than
+        # joined into one more copy
+        length = sum(len(part) for part in parts)
+        res = self.response
+        resheaders = res.headers
+        fheaders = first.headers
+        resheaders[H_LAEPROXY_RESULT] = RETRIEVED_FROM_NET % now()
+        resheaders[H_UPSTREAM_STATUS_CODE] = '206'
+        resheaders[H_UPSTREAM_SERVER] = fheaders.get('server', '')
+        resheaders[H_FANOUT] = str(len(parts))
+        logger.debug('Assembled %d sub-ranges, %d bytes', len(parts), length)
+        res.set_status(206)
+        resheaders['Content-Range'] = format_content_range(range_start, range_start + length - 1, total)
+        ignoreheaders = conn_header_set(fheaders) | HOPBYHOP | {'content-length', 'content-range'}
+        self._send_response(fheaders, resheaders, ignoreheaders, parts)
+        return True
+
+    def _stream(self, url, stream, reqheaders, range_start, range_end, cachekey):
+        '''
+        Responds to a single range request by piping the part of stream's
+        body that covers it through to the client. Only possible if upstream
+        answered with a 206 covering range_start; otherwise returns False
+        without responding or reading the body. A 200 is left to the
+        buffered path, which caches the entity and signals truncation.
+        '''
+        status = stream.status_code
+        fheaders = stream.headers
+        if status != 206:
+            return False
+        try:
+            offset, end, total = parse_content_range(fheaders.get('content-range', ''))
+        except ValueError:
+            return False
+        if not offset <= range_start <= end:
+            return False
+        last = min(range_end, end)
+        validators.record(url, fheaders)
+        # an exact 206 is what we'd have cached if we had buffered it
+        exact = offset == range_start and end <= range_end
+        logger.debug('Streaming bytes %d-%d of upstream %d response', range_start, last, status)
+
+        res = self.response
+        resheaders = res.headers
+        res.set_status(206)
+        resheaders[H_LAEPROXY_RESULT] = RETRIEVED_FROM_NET % now()
+        resheaders[H_UPSTREAM_STATUS_CODE] = str(status)
+        resheaders[H_UPSTREAM_SERVER] = fheaders.get('server', '')
+        resheaders[H_STREAMED] = 'true'
+        resheaders[H_UPSTREAM_CONTENT_RANGE] = fheaders['content-range']
+        resheaders['Content-Range'] = format_content_range(range_start, last, total)
+        ignoreheaders = conn_header_set(fheaders) | HOPBYHOP | {'content-length', 'content-range'}
+        copy_headers(fheaders, resheaders, ignoreheaders)
+        if exact and cachekey:
+            store = lambda content: self._store(cachekey, status, fheaders, content, reqheaders)
+        else:
+            store = None
+        # recorded with the first byte once it's through, if that's ours
+        metadata = lambda first: metadatacache.record(url, status, fheaders, first if offset == 0 else None, reqheaders)
+        res.app_iter = self._pipe(url, stream, range_start - offset, last - range_start + 1, store, metadata)
+        # after setting app_iter, which makes webob drop any Content-Length
+        resheaders['Content-Length'] = str(last - range_start + 1)
+        return True
+
+    def _pipe(self, url, stream, skip, nbytes, store=None, first=None):
+        '''
+        Yields nbytes of stream's body after skipping the first skip bytes,
+        in chunks of at most STREAM_BUFSIZE, and closes it. If store is
+        passed, it is called with the whole body once it has been sent. If
+        first is, it is called with the first chunk of the body (before
+        skipping) once that has been read.
+
+        If upstream sends less than promised, raises DownloadError after
+        sending what it did send, for the server to drop the connection:
+        the length was sent up front, so this is the only way left to tell
+        the client.
+        '''
+        sent = 0
+        skipped = skip
+        reading = 0 # seconds spent on upstream, not on the client
+        chunks = [] if store else None
+        try:
+            while skip > 0 or sent < nbytes:
+                started = monotonic()
+                chunk = stream.read(min(skip or nbytes - sent, STREAM_BUFSIZE))
+                reading += monotonic() - started
+                if not chunk:
+                    break
+                if first:
+                    first(chunk)
+                    first = None
+                if skip > 0:
+                    skip -= len(chunk)
+                    continue
+                sent += len(chunk)
+                if store:
+                    chunks.append(chunk)
+                yield chunk
+        finally:
+            stream.close()
+            count_upstream(self.upstream_host, sent)
+            count_sent(self.request.remote_addr, sent)
+        chunksizes.record(self.upstream_host, skipped + sent, self.fetch_ttfb + reading, self.fetch_ttfb)
+        if sent < nbytes:
+            logger.warn('Upstream response for %s ended %d bytes short', url, nbytes - sent)
+            traffic.incr('streams_cut_short')
+            raise DownloadError('Upstream response for %s ended %d bytes short' % (url, nbytes - sent))
+        if store:
+            store(b''.join(chunks))
+
+    def _store(self, cachekey, status, fheaders, content, reqheaders):
+        ignoreheaders = conn_header_set(fheaders) | HOPBYHOP
+        entry = make_entry(status, fheaders, content, reqheaders, ignoreheaders, responsecache.clock())
+        if entry:
+            logger.debug('Caching response for %s', cachekey)
+            responsecache.insert(cachekey, entry)
+            sharedcache.put(cachekey, entry)
+
+    def _send_multipart(self, url, reqheaders, ranges):
+        '''
+        Responds to a request for multiple ranges with a multipart/byteranges
+        206, fetching the ranges concurrently unless we have the entire
+        entity cached. Ranges lying beyond the end of the entity are left
+        out, per http://tools.ietf.org/html/rfc2616#section-14.35.1.
+
+        If upstream answers a range with the entire entity, the rest of the
+        parts are cut from that rather than fetched, and for urls known to
+        be served that way, ranges are fetched one at a time until it does.
+        '''
+        res = self.response
+        resheaders = res.headers
+        entity = request_allows_cache(reqheaders) and entitycache.get((url,), reqheaders)
+        whole = None # (status, headers, content) of the entire entity
+        if entity:
+            whole = 200, dict(entity.headers), entity.content
+            resheaders[H_LAEPROXY_RESULT] = RETRIEVED_FROM_ENTITY_CACHE % now()
+        elif self._refused(url):
+            return
+        else:
+            concurrency = 1 if prefetcher.ranges_ignored(url) else FANOUT_MAX_RPCS
+            fetched = self._fetch_ranges(url, reqheaders, ranges, concurrency)
+            resheaders[H_LAEPROXY_RESULT] = RETRIEVED_FROM_NET % now()
+        parts = []
+        fheaders = total = None
+        for start, end in ranges:
+            if whole:
+                status, headers, content = whole
+            else:
+                result = next(fetched)[2]
+                if isinstance(result, Exception):
+                    return self._fetch_failed(url, result)
+                count_fetched(self.upstream_host, result)
+                status, headers, content = result.status_code, result.headers, result.content
+                if result.content_was_truncated:
+                    logger.warn('Part %d-%d of %s truncated', start, end, url)
+                    resheaders[H_LAEPROXY_RESULT] = 'Upstream response truncated for range %d-%d' % (start, end)
+                    return self.error(502)
+                if status == 416:
+                    continue
+                if not 200 <= status < 300:
+                    logger.debug('Upstream answered part %d-%d with %d, returning it as-is', start, end, status)
+                    fetched.close()
+                    res.set_status(status)
+                    resheaders[H_UPSTREAM_STATUS_CODE] = str(status)
+                    resheaders[H_UPSTREAM_SERVER] = headers.get('server', '')
+                    return self._send_response(headers, resheaders, conn_header_set(headers) | HOPBYHOP, content)
+                if status == 200:
+                    logger.debug('Upstream ignored Range, cutting the remaining parts from the entire entity')
+                    prefetcher.ignores_ranges(url)
+                    whole = status, headers, content
+                    fetched.close()
+            try:
+                part = extract(status, headers, content, start, end)
+            except ValueError as e:
+                if status == 200 and start >= len(content):
+                    continue
+                logger.warn('Part %d-%d of %s invalid: %s', start, end, url, e)
+                resheaders[H_UPSTREAM_STATUS_CODE] = str(status)
+                resheaders[H_LAEPROXY_RESULT] = 'Invalid upstream response for range %d-%d: %s' % (start, end, e)
+                return self.error(502)
+            fheaders = fheaders or headers
+            total = total or part[2]
+            parts.append(part)
+        self.timer.mark('cache' if entity else 'fetch')
+        if not parts:
+            if total is not None:
+                resheaders['Content-Range'] = 'bytes */%d' % total
+            resheaders[H_LAEPROXY_RESULT] = 'No requested range satisfiable'
+            return self.error(416)
+
+        boundary = uuid4().hex # a native str on python 2 and 3
+        body = multipart_byteranges(parts, fheaders.get('content-type'), boundary)
+        res.set_status(206)
+        resheaders[H_UPSTREAM_STATUS_CODE] = '200' if whole else '206'
+        resheaders[H_UPSTREAM_SERVER] = fheaders.get('server', '')
+        resheaders['Content-Type'] = 'multipart/byteranges; boundary=%s' % boundary
+        logger.debug('Sending %d parts, %d bytes', len(parts), len(body))
+        ignoreheaders = conn_header_set(fheaders) | HOPBYHOP | {'age', 'content-length', 'content-range', 'content-type'}
+        return self._send_response(fheaders, resheaders, ignoreheaders, body)
+
+    def _fetch_failed(self, url, e):
+        status, self.response.headers[H_LAEPROXY_RESULT] = fetch_error(url, e, self.upstream_host)
+        return self.error(status)
+
+    def _over_limit(self):
+        '''
+        Fails the request fast if its client is over its rate limits.
+        Returns whether it did.
+        '''
+        retry = admission(clientlimits, self.request.remote_addr)
+        if not retry:
+            return False
+        logger.debug('Client %s over its rate limits', self.request.remote_addr)
+        self.response.headers[H_LAEPROXY_RESULT] = CLIENT_RATE_LIMITED
+        self.response.headers['Retry-After'] = retry
+        self.error(503)
+        return True
+
+    def _refused(self, url):
+        '''
+        Fails the request fast if fetching url shouldn't be tried (see
+        refusal). Returns whether it did.
+        '''
+        refused = refusal(url, self.upstream_host)
+        if not refused:
+            return False
+        status, result, retry = refused
+        logger.debug('Not fetching %s: %s', url, result)
+        self.response.headers[H_LAEPROXY_RESULT] = result
+        if retry:
+            self.response.headers['Retry-After'] = retry
+        self.error(status)
+        return True
+
+    def _prefetch(self, url, reqheaders, range_start, range_end):
+        '''
+        Returns what was prefetched of bytes range_start through range_end
+        of url for this client, if anything, and if the client looks to be
+        reading url sequentially, starts prefetching the ranges after it.
+        '''
+        client = self.request.remote_addr
+        prefetched = prefetcher.claim((client, url, range_start, range_end), wait=detached)
+        info = metadatacache.get(url)
+        headers = dict((k, v) for k, v in reqheaders.items() if k.lower() != 'range')
+
+        deadline = fetch_deadline(self.timer.started)
+        if not detached:
+            # settled before we respond, so they may only hold it up so long
+            deadline = min(deadline, PREFETCH_MAX_WAIT_SECS)
+
+        def start_fetch(start, end):
+            return fetch_async(url,
+                method='GET',
+                headers=dict(headers, Range='bytes=%d-%d' % (start, end)),
+                allow_truncated=True,
+                follow_redirects=False,
+                deadline=deadline,
+                validate_certificate=True,
+                )
+
+        for start, end in prefetcher.observe(client, url, range_start, range_end, info and info.total):
+            key = client, url, start, end
+            if not prefetcher.start(key, end - start + 1, lambda: start_fetch(start, end)):
+                break
+            logger.debug('Prefetching bytes %d-%d of %s', start, end, url)
+            if not detached:
+                # settled before we respond, as its rpc can't outlive this request
+                self.prefetches.append(key)
+        return prefetched
+
+    def _send_cached(self, entry, result=RETRIEVED_FROM_CACHE, range=None, upstream_status=None):
+        self.timer.mark('fetch' if upstream_status else 'cache')
+        res = self.response
+        resheaders = res.headers
+        res.set_status(entry.status)
+        resheaders[H_LAEPROXY_RESULT] = result % now()
+        resheaders[H_UPSTREAM_STATUS_CODE] = str(upstream_status or entry.status)
+        resheaders[H_UPSTREAM_SERVER] = entry.header('server', '')
+        if entry.status == 206:
+            resheaders[H_UPSTREAM_CONTENT_RANGE] = entry.header('content-range', '')
+        logger.debug('Serving cached %d response stored at %s', entry.status, entry.stored)
+        resheaders['Age'] = str(int(responsecache.clock() - entry.stored))
+        fheaders = dict(entry.headers)
+        ignoreheaders = HOPBYHOP | {'age'}
+        if range and entry.status == 200:
+            return self._send_range(fheaders, resheaders, ignoreheaders, entry.content, *range)
+        if range and entry.status == 206:
+            # sliced to the range requested, whatever the entry holds
+            try:
+                start, end, total, body = extract(206, {'content-range': entry.header('content-range', '')}, entry.content, *range)
+            except ValueError as e:
+                logger.warn('Cached 206 response does not cover range %d-%d, returning it as-is: %s', range[0], range[1], e)
+            else:
+                return self._send_range(fheaders, resheaders, ignoreheaders, body, start, end, start, total)
+        return self._send_response(fheaders, resheaders, ignoreheaders, entry.content)
+
+    def _send_not_modified(self, validators):
+        self.timer.mark('cache')
+        resheaders = self.response.headers
+        self.response.set_status(304)
+        resheaders[H_LAEPROXY_RESULT] = NOT_MODIFIED_LOCAL % now()
+        if validators.etag:
+            resheaders['ETag'] = validators.etag
+        if validators.last_modified:
+            resheaders['Last-Modified'] = validators.last_modified
+        logger.debug('Answering conditional request from cached validators')
+
+    def _send_metadata(self, info, probe):
+        '''
+        Answers a HEAD request, or if probe, a "bytes=0-0" size probe, from
+        cached entity metadata.
+        '''
+        self.timer.mark('cache')
+        res = self.response
+        resheaders = res.headers
+        resheaders[H_LAEPROXY_RESULT] = RETRIEVED_FROM_METADATA % now()
+        if info.etag:
+            resheaders['ETag'] = info.etag
+        if info.content_type:
+            resheaders['Content-Type'] = info.content_type
+        if info.accept_ranges:
+            resheaders['Accept-Ranges'] = 'bytes'
+        logger.debug('Answering from cached metadata, entity length %d', info.total)
+        if probe:
+            res.set_status(206)
+            resheaders['Content-Range'] = format_content_range(0, 0, info.total)
+            return self._send_response({}, resheaders, HOPBYHOP, info.first)
+        resheaders['Content-Length'] = str(info.total)
 
     def make_handler(httpmethod):
         assert httpmethod in METHODS, 'unsupported method: %s' % httpmethod
@@ -143,75 +823,182 @@ class LaeproxyHandler(webapp.RequestHandler):
 
             logger.debug('processing request:\n%s\n', req)
 
-            url, scheme, host = self._extract_url(req)
+            try:
+                url, scheme, host = self._extract_url(req)
+                self.upstream_host = host
+                self.timer.mark('url')
+                fanout = rangemethod and H_FANOUT in reqheaders
+                follow = redirect_limit(reqheaders.get(H_FOLLOW_REDIRECTS))
+                if follow:
+                    target, hops = redirects.resolve(url, follow)
+                    if target:
+                        logger.debug('Going straight to %s, permanently redirected from %s', target[0], url)
+                        url, scheme, host = target
+                        self.upstream_host = host
+                        resheaders[H_FINAL_URL] = url
+                        follow -= hops
+
+                # check payload
+                payload = req.body if payloadmethod else None
+                check_payload(payload)
+
+                # strip headers from the request that should be ignored
+                ignored = strip_headers(reqheaders)
+                ignored and logger.debug('Stripped request headers: %s', ignored)
 
-            # check payload
-            payload = req.body if payloadmethod else None
-            payloadlen = len(payload) if payload else 0
-            if payloadlen >= URLFETCH_REQ_MAXBYTES:
-                resheaders[H_LAEPROXY_RESULT] = REQ_TOO_LARGE
-                return self.error(400)
+                if rangemethod:
+                    # only clients sending H_FANOUT may ask for more than
+                    # RANGE_REQ_SIZE at once
+                    chunk = chunksizes.recommend(host)
+                    resheaders[H_CHUNK_SIZE] = str(chunk if fanout else min(chunk, RANGE_REQ_SIZE))
+                    # parsed like webob 1.1's req.range.ranges, which later
+                    # webob versions removed
+                    ranges, fanout = check_ranges(parse_range(reqheaders.get('range')), fanout)
+            except Rejected as e:
+                resheaders[H_LAEPROXY_RESULT] = e.result
+                return self.error(e.status)
+            self.timer.mark('headers')
 
-            # strip headers from the request that should be ignored
-            ignoreheaders = conn_header_set(reqheaders) | IGNOREHEADERS
-            ignored = [(i, reqheaders.pop(i)) for i in ignoreheaders if i in reqheaders]
-            ignored and logger.debug('Stripped request headers: %s', ignored)
+            if httpmethod in CONDITIONAL_METHODS:
+                notmodified = validators.not_modified(url, reqheaders)
+                if notmodified:
+                    return self._send_not_modified(notmodified)
 
             if rangemethod:
-                if not req.range:
-                    logger.debug('No upstream range header')
-                    resheaders[H_LAEPROXY_RESULT] = 'Missing or invalid range header'
-                    return self.error(400)
-                ranges = req.range.ranges # removed in webob 1.2b1 (http://docs.webob.org/en/latest/news.html) but app engine python 2.7 runtime uses webob 1.1.1
-                if len(ranges) != 1:
-                    logger.debug('Multiple ranges requested')
-                    resheaders[H_LAEPROXY_RESULT] = 'Multiple ranges unsupported'
-                    return self.error(400)
+                if len(ranges) > 1:
+                    return self._send_multipart(url, reqheaders, ranges)
                 range_start, range_end = ranges[0]
-                if range_end is None:
-                    logger.debug('Expected range header of the form bytes=x-y')
-                    resheaders[H_LAEPROXY_RESULT] = 'Range must be of the form bytes=x-y'
-                    return self.error(400)
-                range_end -= 1 # webob uses uninclusive end, we use inclusive
-                assert range_start is not None, 'Expected range header of the form bytes=x-y'
-                if not (0 <= range_start <= range_end):
-                    logger.debug('Range must satisfy 0 <= range_start <= range_end')
-                    resheaders[H_LAEPROXY_RESULT] = 'Range must satisfy 0 <= range_start <= range_end'
-                    return self.error(416)
-                nbytes_requested = range_end - range_start + 1
-                if nbytes_requested > RANGE_REQ_SIZE:
-                    logger.warn('Range specifies %d bytes, limit is %d', nbytes_requested, RANGE_REQ_SIZE)
-                    resheaders[H_LAEPROXY_RESULT] = 'Range specifies %d bytes, limit is %d' % (nbytes_requested, RANGE_REQ_SIZE)
-                    return self.error(400)
 
-            try:
-                fetched = fetch(url,
+            probe = rangemethod and (range_start, range_end) == (0, 0)
+            if (httpmethod == 'head' or probe) and request_allows_cache(reqheaders) \
+                    and not any(i in reqheaders for i in CONDITIONAL_HEADERS):
+                info = metadatacache.lookup(url, first_byte=probe)
+                if info:
+                    return self._send_metadata(info, probe)
+
+            cachekey = revalidating = None
+            if httpmethod == 'get':
+                cachekey = (url, range_start, range_end)
+                if request_allows_cache(reqheaders):
+                    cached = responsecache.get(cachekey, reqheaders, stale_ok=True)
+                    if cached and cached.expires > responsecache.clock():
+                        return self._send_cached(cached, range=(range_start, range_end))
+                    conditional = cached and cached.conditional_headers()
+                    if conditional and not any(i in reqheaders for i in CONDITIONAL_HEADERS):
+                        logger.debug('Revalidating stale cached response with %s', conditional)
+                        revalidating = cached
+                        reqheaders.update(conditional)
+                    cached = entitycache.get((url,), reqheaders)
+                    if cached:
+                        return self._send_cached(cached, RETRIEVED_FROM_ENTITY_CACHE, (range_start, range_end))
+                    cached = sharedcache.get(cachekey, reqheaders)
+                    if cached:
+                        responsecache.insert(cachekey, cached)
+                        return self._send_cached(cached, RETRIEVED_FROM_MEMCACHE, (range_start, range_end))
+
+            self.timer.mark('cache')
+            if self._refused(url):
+                return
+            if fanout:
+                if self._fanout(url, reqheaders, range_start, range_end):
+                    return
+                logger.warn('Falling back to fetching a single range')
+                resheaders[H_FANOUT] = 'fallback'
+                range_end = range_start + RANGE_REQ_SIZE - 1
+                reqheaders['Range'] = 'bytes=%d-%d' % (range_start, range_end)
+                cachekey = (url, range_start, range_end)
+
+            prefetched = None
+            if PREFETCH_ENABLED and rangemethod and not any(i in reqheaders for i in CONDITIONAL_HEADERS):
+                prefetched = self._prefetch(url, reqheaders, range_start, range_end)
+
+            method = httpmethod # unless a redirect we follow changes it
+
+            def fetch_upstream():
+                kw = dict(
                     payload=payload,
-                    method=httpmethod,
+                    method=method,
                     headers=reqheaders,
                     allow_truncated=True,
                     follow_redirects=False,
-                    deadline=URLFETCH_REQ_MAXSECS,
                     validate_certificate=True,
                     )
-                resheaders[H_LAEPROXY_RESULT] = RETRIEVED_FROM_NET % now()
-            except InvalidURLError:
-                logger.debug('InvalidURLError: %s', url)
-                resheaders[H_LAEPROXY_RESULT] = 'Invalid url'
-                return self.error(404)
-            except DownloadError:
-                logger.warn(MISSED_DEADLINE_URLFETCH)
-                resheaders[H_LAEPROXY_RESULT] = MISSED_DEADLINE_URLFETCH
-                return self.error(504)
-            except OverQuotaError:
-                logger.warn(EXCEEDED_URLFETCH_QUOTA)
-                resheaders[H_LAEPROXY_RESULT] = EXCEEDED_URLFETCH_QUOTA
-                return self.error(503)
-            except Exception as e:
-                logger.error('Unexpected error: %s', e)
-                logger.debug(format_exc())
-                resheaders[H_LAEPROXY_RESULT] = UNEXPECTED_ERROR % e
-                return self.error(500)
+                deadline = fetch_deadline(self.timer.started)
+                if hedging and method in HEDGE_METHODS:
+                    return hedger.race(host, lambda deadline: fetch_async(url, deadline=deadline, **kw), wait_any, deadline)
+                return fetch(url, deadline=deadline, **kw)
+
+            def open_stream():
+                kw = dict(method=method, headers=reqheaders, validate_certificate=True)
+                deadline = fetch_deadline(self.timer.started)
+                if hedging and method in HEDGE_METHODS and fetch_stream_async:
+                    return hedger.race(host, lambda deadline: fetch_stream_async(url, deadline=deadline, **kw), wait_any, deadline)
+                return fetch_stream(url, deadline=deadline, **kw)
+
+            followed = 0
+            while True:
+                if followed and self._refused(url):
+                    return
+                streaming = STREAMING_ENABLED and fetch_stream and rangemethod and not revalidating
+                self.fetch_started = monotonic()
+                try:
+                    source = RETRIEVED_FROM_NET
+                    if prefetched is not None:
+                        fetched, shared, source = prefetched, False, RETRIEVED_FROM_PREFETCH
+                        prefetched = None
+                    elif streaming:
+                        stream = open_stream()
+                        self.timer.mark('fetch')
+                        self.fetch_ttfb = monotonic() - self.fetch_started
+                        if self._stream(url, stream, reqheaders, range_start, range_end, cachekey):
+                            count_outcome(host, stream.status_code)
+                            return
+                        fetched, shared = stream.result(), False
+                    elif method in COALESCE_METHODS:
+                        flightkey = (method, url, tuple(sorted((k.lower(), v) for k, v in reqheaders.items())))
+                        fetched, shared = coalescer.do(flightkey, fetch_upstream)
+                    else:
+                        fetched, shared = fetch_upstream(), False
+                    self.timer.mark('fetch')
+                    resheaders[H_LAEPROXY_RESULT] = source % now()
+                    if shared:
+                        logger.debug('Coalesced with concurrent identical request')
+                        resheaders[H_COALESCED] = 'true'
+                    else:
+                        count_fetched(host, fetched)
+                        if not fetched.content_was_truncated and source == RETRIEVED_FROM_NET:
+                            chunksizes.record(host, len(fetched.content), monotonic() - self.fetch_started)
+                except Exception as e:
+                    self.timer.mark('fetch')
+                    return self._fetch_failed(url, e)
+
+                location = fetched.headers.get('location')
+                target = (location and followed < follow and fetched.status_code in REDIRECT_STATUSES
+                    and redirect_target(url, location, req.host))
+                if not target:
+                    break
+                status = fetched.status_code
+                redirects.record(url, status, fetched.headers, target)
+                logger.debug('Following %d redirect from %s to %s', status, url, target[0])
+                if (status == 303 and method != 'head') or (status in (301, 302) and method == 'post'):
+                    method, payload = 'get', None
+                    for i in ('content-type', 'content-length'):
+                        reqheaders.pop(i, None)
+                if revalidating:
+                    # the validators we sent were for the url redirected from
+                    for i in conditional:
+                        reqheaders.pop(i, None)
+                    revalidating = None
+                if target[2].lower() != host.lower():
+                    # don't hand the client's credentials to another host
+                    for i in CREDENTIAL_HEADERS:
+                        reqheaders.pop(i, None)
+                url, scheme, host = target
+                self.upstream_host = host
+                resheaders[H_FINAL_URL] = url
+                if cachekey:
+                    cachekey = (url, range_start, range_end)
+                followed += 1
 
             status = fetched.status_code
             res.set_status(status)
@@ -220,16 +1007,26 @@ class LaeproxyHandler(webapp.RequestHandler):
 
             fheaders = fetched.headers
             resheaders[H_UPSTREAM_SERVER] = fheaders.get('server', '')
-            logger.debug('urlfetch response headers:\n%s', headers_str(fheaders))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('urlfetch response headers:\n%s', headers_str(fheaders))
+
+            if status in VALIDATOR_STATUSES:
+                validators.record(url, fheaders)
+            if revalidating and status == 304:
+                entry = revalidating.refreshed(fheaders, responsecache.clock())
+                if not shared:
+                    responsecache.insert(cachekey, entry)
+                    sharedcache.put(cachekey, entry)
+                return self._send_cached(entry, REVALIDATED_CACHE, (range_start, range_end), 304)
 
             # headers from fetched response that should not be sent to client
             ignoreheaders = conn_header_set(fheaders) | HOPBYHOP
 
-            # correct invalid relative Location header (#14)
+            # correct invalid relative Location header (#14). fetched may be
+            # shared with coalesced requests, but they all rewrite it the same
             loc = fheaders.get('location', '')
-            if loc and not loc.startswith('http'):
-                path = loc if loc.startswith('/') else '/' + loc
-                absloc = scheme + '://' + host + path
+            absloc = absolute_location(loc, scheme, host)
+            if absloc:
                 logger.debug('Detected relative Location header, adjusting: %s -> %s', loc, absloc)
                 fheaders['location'] = absloc
 
@@ -242,17 +1039,29 @@ class LaeproxyHandler(webapp.RequestHandler):
                 resheaders[H_TRUNCATED] = 'true'
                 return self._send_response(fheaders, resheaders, ignoreheaders, content)
 
-            if not rangemethod:
-                logger.debug('Non-range method, returning response as-is')
-                return self._send_response(fheaders, resheaders, ignoreheaders, content)
+            if httpmethod in METADATA_METHODS and status in CACHEABLE_STATUSES:
+                metadatacache.record(url, status, fheaders, None if httpmethod == 'head' else content, reqheaders)
 
-            if status == 200:
+            if rangemethod and status == 200:
                 # Last paragraph (re proxies) of
                 # http://tools.ietf.org/html/rfc2616#section-14.35.2
                 # says we SHOULD send back 206 and cache entire entity in this
-                # case. Disregarding for the sake of simplicity because of
-                # App Engine's peculiar environment.
-                logger.debug('Destination server does not support range requests, returning response as-is')
+                # case.
+                if ENTITY_CACHE_ENABLED and not shared:
+                    entity = make_entry(status, fheaders, content, reqheaders, ignoreheaders, entitycache.clock(), ENTITY_CACHE_MINSECS)
+                    if entity and entitycache.insert((url,), entity):
+                        logger.debug('Cached entire entity for %s', url)
+                logger.debug('Destination server does not support range requests, returning requested range of entire entity')
+                prefetcher.ignores_ranges(url)
+                return self._send_range(fheaders, resheaders, ignoreheaders, content, range_start, range_end)
+
+            # a 206 is only cached under the range requested if it is
+            # exactly that range, see below
+            if cachekey and not shared and status != 206:
+                self._store(cachekey, status, fheaders, content, reqheaders)
+
+            if not rangemethod:
+                logger.debug('Non-range method, returning response as-is')
                 return self._send_response(fheaders, resheaders, ignoreheaders, content)
 
             if status == 206:
@@ -260,21 +1069,23 @@ class LaeproxyHandler(webapp.RequestHandler):
                 resheaders[H_UPSTREAM_CONTENT_RANGE] = crange
                 logger.debug('Upstream Content-Range: %s', crange)
                 try:
-                    assert crange.startswith('bytes '), 'Content-Range only supported in bytes'
-                    sent, total = crange[6:].split('/', 1)
-                    start, end = [int(i) for i in sent.split('-', 1)]
-                    total = int(total)
+                    start, end, total = parse_content_range(crange)
                 except Exception as e:
                     logger.warn('Error parsing upstream Content-Range %r: %r, returning 206 response as-is', crange, e)
-                    logger.debug(format_exc())
+                    logger.debug('Content-Range parsing error details', exc_info=True)
                     return self._send_response(fheaders, resheaders, ignoreheaders, content)
 
-                logger.debug('Parsed Content-Range: %d-%d/%d', start, end, total)
-                entire = start == 0 and end == total - 1
+                logger.debug('Parsed Content-Range: %d-%d/%s', start, end, total)
+                entire = start == 0 and end == (total or 0) - 1
 
                 # check if the 206 actually fulfills it
                 if start == range_start and end <= range_end: # could have requested more than there is
                     logger.debug('Upstream 206 response fulfills upstream range request, returning as-is')
+                    if cachekey and not shared and contentlen == end - start + 1:
+                        self._store(cachekey, status, fheaders, content, reqheaders)
+                elif total is not None and start <= range_start <= end and contentlen == end - start + 1:
+                    logger.debug('Upstream 206 response covers more than requested, trimming to %d-%d', range_start, range_end)
+                    return self._send_range(fheaders, resheaders, ignoreheaders, content, range_start, range_end, start, total)
                 else:
                     logger.warn('Upstream Content-Range %r does not match range requested upstream %r', crange, reqheaders.get('range', '(no range?)'))
                     logger.warn('Returning upstream 206 response as-is, originator should verify')
@@ -289,21 +1100,306 @@ class LaeproxyHandler(webapp.RequestHandler):
     def catch_deadline_exceeded(handler):
         @wraps(handler)
         def wrapper(self, *args, **kw):
-            resheaders = self.response.headers
+            res = self.response
+            resheaders = res.headers
+            timer = self.timer = PhaseTimer()
+            self.upstream_host = None
+            self.prefetches = []
+            self.sent = 0
             try:
-                return handler(self, *args, **kw)
+                if self._over_limit():
+                    return
+                handler(self, *args, **kw)
+                for key in self.prefetches:
+                    prefetcher.settle(key)
             except DeadlineExceededError:
+                traffic.incr(('errors', 'DeadlineExceededError'))
                 resheaders[H_LAEPROXY_RESULT] = resheaders.get(H_LAEPROXY_RESULT, '') + MISSED_DEADLINE_GAE
                 return self.error(504)
             finally:
-                resheaders[H_LAEPROXY_VER] = __version__
+                resheaders[H_LAEPROXY_VER] = LAEPROXY_VERSION
+                count_request(handler.__name__, res.status_int, self.request.content_length)
+                timer.stop()
+                resheaders[H_SERVER_TIMING] = timer.server_timing()
+                result = result_class(res.status_int, resheaders.get(H_LAEPROXY_RESULT, ''))
+                latency.record(timer,
+                    host=self.upstream_host or '(none)',
+                    method=handler.__name__,
+                    result=result,
+                    )
+                if sampled(res.status_int):
+                    log_request(
+                        method=handler.__name__,
+                        host=self.upstream_host,
+                        range=self.request.headers.get('range'),
+                        status=res.status_int,
+                        # streamed bodies are sent after we return
+                        bytes=int(resheaders.get('Content-Length', 0)) if H_STREAMED in resheaders else self.sent,
+                        result=result,
+                        ms=round(timer.elapsed, 1),
+                        phases=dict((k, round(v, 1)) for k, v in timer.phases.items()),
+                        )
         return wrapper
 
     for method in METHODS:
         locals()[method] = catch_deadline_exceeded(make_handler(method))
 
+class BatchHandler(webapp.RequestHandler):
+    '''
+    Executes many proxied requests in one client round trip.
+
+    The request body is a JSON list of entries like::
+
+        {"method": "get", "url": "http://host/path", "headers": {...}, "range": "bytes=x-y"}
+
+    Entries are fetched concurrently, subject to the same limits as single
+    requests (multiple ranges and H_FANOUT excepted), and only methods
+    without a payload are supported. Results are written in the order they
+    complete, each framed as a line of JSON::
+
+        {"index": <entry index>, "status": <status>, "headers": [[name, value], ...], "length": <n>}
+
+    followed by CRLF, n bytes of body and CRLF.
+
+    Bodies are cut short once the response reaches BATCH_RES_MAXBYTES (see
+    _write_frame), and entries not yet fetched by then are answered with a
+    503. webapp buffers the whole response, so frames reach the client all
+    at once when the batch is done, just in the order they completed.
+    '''
+
+    def _write_frame(self, index, status, headers, content):
+        '''
+        Writes a frame, cutting its body short if it would take the response
+        past BATCH_RES_MAXBYTES. A body cut short is marked with H_TRUNCATED
+        and its Content-Range corrected. One with no room left at all is
+        replaced with a 503 BATCH_TOO_LARGE frame.
+        '''
+        if len(content) > self.budget:
+            if self.budget <= 0:
+                status, headers, content = 503, [(H_LAEPROXY_RESULT, BATCH_TOO_LARGE)], ''
+            else:
+                content = content[:self.budget]
+                headers = truncated_headers(headers, len(content))
+        self.budget -= len(content)
+        meta = json.dumps({'index': index, 'status': status, 'headers': headers, 'length': len(content)})
+        count_sent(self.request.remote_addr, len(content))
+        out = self.response.out
+        out.write(meta + '\r\n')
+        out.write(content.tobytes() if isinstance(content, memoryview) else content)
+        out.write('\r\n')
+
+    def _prepare(self, entry):
+        '''
+        Validates a batch entry. Returns (method, url, scheme, host, headers,
+        range), with range an inclusive (start, end) pair or None.
+        '''
+        try:
+            method = str(entry.get('method', 'get')).lower()
+            scheme, rest = str(entry['url']).split('://', 1)
+            headers = dict((str(k).lower(), str(v)) for k, v in entry.get('headers', {}).items())
+        except Exception:
+            raise Rejected(400, 'Invalid batch entry')
+        if method not in BATCH_METHODS:
+            raise Rejected(400, 'Method %s unsupported in batch' % method)
+        url, scheme, host = target_url(scheme + '/' + rest, self.request.host)
+        strip_headers(headers)
+        range = None
+        if method in RANGE_METHODS:
+            rangeheader = entry.get('range') or headers.get('range')
+            ranges, _ = check_ranges(parse_range(rangeheader and str(rangeheader)))
+            if len(ranges) != 1:
+                raise Rejected(400, 'Multiple ranges unsupported in batch')
+            range = ranges[0]
+            headers['range'] = 'bytes=%d-%d' % range
+        return method, url, scheme, host, headers, range
+
+    def _result_frame(self, index, item, fetched):
+        method, url, scheme, host, headers, range = item
+        count_fetched(host, fetched)
+        status = fetched.status_code
+        fheaders = fetched.headers
+        content = fetched.content
+        loc = fheaders.get('location', '')
+        absloc = absolute_location(loc, scheme, host)
+        if absloc:
+            fheaders['location'] = absloc
+        ignoreheaders = conn_header_set(fheaders) | HOPBYHOP
+        extra = [
+            (H_LAEPROXY_RESULT, RETRIEVED_FROM_NET % now()),
+            (H_UPSTREAM_STATUS_CODE, str(status)),
+            (H_UPSTREAM_SERVER, fheaders.get('server', '')),
+            ]
+        headers = [(k, v) for k, v in fheaders.items() if k.lower() not in ignoreheaders]
+        if fetched.content_was_truncated:
+            extra.append((H_TRUNCATED, 'true'))
+        elif range:
+            status, headers, content = self._trim(url, range, status, headers, content, extra)
+        self._write_frame(index, status, headers + extra, content)
+
+    def _trim(self, url, range, status, headers, content, extra):
+        '''
+        Trims a 200 or 206 response to range, adding its Content-Range to
+        extra. Returns (status, headers, content), as they were if the
+        response doesn't cover range.
+        '''
+        if status not in (200, 206):
+            return status, headers, content
+        try:
+            start, end, total, content = extract(status, dict((k.lower(), v) for k, v in headers), content, *range)
+        except ValueError as e:
+            logger.warn('Returning %s response for %s as-is: %s', status, url, e)
+            return status, headers, content
+        extra.append(('Content-Range', format_content_range(start, end, total)))
+        return 206, [(k, v) for k, v in headers if k.lower() not in ('content-length', 'content-range')], content
+
+    def _post(self):
+        req = self.request
+        res = self.response
+        try:
+            check_payload(req.body)
+            entries = json.loads(req.body)
+            assert isinstance(entries, list) and all(isinstance(i, dict) for i in entries)
+        except Rejected as e:
+            res.headers[H_LAEPROXY_RESULT] = e.result
+            return self.error(e.status)
+        except (ValueError, AssertionError):
+            res.headers[H_LAEPROXY_RESULT] = 'Invalid batch'
+            return self.error(400)
+        if len(entries) > BATCH_MAX_ENTRIES:
+            res.headers[H_LAEPROXY_RESULT] = 'At most %d batch entries supported' % BATCH_MAX_ENTRIES
+            return self.error(400)
+        # each entry counts as a request against the client's limits
+        retry = admission(clientlimits, req.remote_addr, max(1, len(entries)))
+        if retry:
+            res.headers[H_LAEPROXY_RESULT] = CLIENT_RATE_LIMITED
+            res.headers['Retry-After'] = retry
+            return self.error(503)
+
+        res.headers['Content-Type'] = BATCH_CONTENT_TYPE
+        self.budget = BATCH_RES_MAXBYTES
+        pending = []
+        for index, entry in enumerate(entries):
+            try:
+                item = self._prepare(entry)
+            except Rejected as e:
+                self._write_frame(index, e.status, [(H_LAEPROXY_RESULT, e.result)], '')
+                continue
+            method, url, scheme, host, headers, range = item
+            if range and request_allows_cache(headers):
+                cached = responsecache.get((url,) + range, headers)
+                if cached:
+                    extra = [(H_LAEPROXY_RESULT, RETRIEVED_FROM_CACHE % now())]
+                    status, headers, content = self._trim(url, range, cached.status, list(cached.headers), cached.content, extra)
+                    self._write_frame(index, status, headers + extra, content)
+                    continue
+            refused = refusal(url, host)
+            if refused:
+                status, result, retry = refused
+                self._write_frame(index, status, [(H_LAEPROXY_RESULT, result)] + ([('Retry-After', retry)] if retry else []), '')
+                continue
+            pending.append((index, item))
+
+        running = {}
+        while pending or running:
+            while pending and len(running) < FANOUT_MAX_RPCS:
+                index, item = pending.pop(0)
+                if self.budget <= 0:
+                    # no room left for what it would fetch
+                    self._write_frame(index, 503, [(H_LAEPROXY_RESULT, BATCH_TOO_LARGE)], '')
+                    continue
+                method, url, scheme, host, headers, range = item
+                rpc = fetch_async(url,
+                    method=method.upper(),
+                    headers=headers,
+                    allow_truncated=True,
+                    follow_redirects=False,
+                    deadline=fetch_deadline(self.started),
+                    validate_certificate=True,
+                    )
+                running[rpc] = index, item
+            rpc = wait_any(list(running))
+            index, item = running.pop(rpc)
+            try:
+                fetched = rpc.get_result()
+            except Exception as e:
+                status, result = fetch_error(item[1], e, item[3])
+                self._write_frame(index, status, [(H_LAEPROXY_RESULT, result)], '')
+                continue
+            self._result_frame(index, item, fetched)
+        logger.debug('Batch of %d entries done, %d bytes to spare', len(entries), self.budget)
+
+    def post(self):
+        resheaders = self.response.headers
+        self.started = monotonic()
+        try:
+            return self._post()
+        except DeadlineExceededError:
+            traffic.incr(('errors', 'DeadlineExceededError'))
+            resheaders[H_LAEPROXY_RESULT] = MISSED_DEADLINE_GAE.lstrip()
+            return self.error(504)
+        finally:
+            resheaders[H_LAEPROXY_VER] = LAEPROXY_VERSION
+            status = self.response.status_int
+            count_request('batch', status, self.request.content_length)
+            if sampled(status):
+                log_request(
+                    method='batch',
+                    status=status,
+                    bytes=BATCH_RES_MAXBYTES - getattr(self, 'budget', BATCH_RES_MAXBYTES),
+                    result=result_class(status, resheaders.get(H_LAEPROXY_RESULT, '')),
+                    ms=round((monotonic() - self.started) * 1000, 1),
+                    )
+
+
+class StatsHandler(webapp.RequestHandler):
+    '''
+    Serves this instance's stats as JSON, or in the Prometheus text format
+    if format=prometheus is passed. With scope=global, serves the counters
+    added up across instances in memcache instead, if
+    STATS_MEMCACHE_ENABLED. Restricted to admins in app.yaml, and see
+    admin_allowed for running standalone.
+    '''
+
+    @admin_only
+    def get(self):
+        req = self.request
+        res = self.response
+        if req.get('scope') == 'global':
+            if not (STATS_MEMCACHE_ENABLED and aggregate):
+                res.headers[H_LAEPROXY_RESULT] = 'Stats aggregation disabled'
+                return self.error(404)
+            stats = aggregate.totals()
+        else:
+            stats = instance_stats()
+        if req.get('format') == 'prometheus':
+            res.headers['Content-Type'] = 'text/plain; version=0.0.4'
+            res.out.write(prometheus_text(stats))
+        else:
+            res.headers['Content-Type'] = 'application/json'
+            res.out.write(json.dumps(stats, sort_keys=True))
+
+
+class WarmupHandler(webapp.RequestHandler):
+    '''
+    Answers the warmup requests App Engine sends new instances before giving
+    them user requests (see inbound_services in app.yaml).
+    '''
+
+    @admin_only
+    def get(self):
+        started = monotonic()
+        fetched = warm_up()
+        logger.info('Warmed up in %dms, %d of %d warmup urls fetched',
+            (monotonic() - started) * 1000, fetched, len(WARMUP_URLS))
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.out.write('ok\n')
+
+
 app = webapp.WSGIApplication((
     (r'/http(s)?/.*', LaeproxyHandler),
+    (r'/batch', BatchHandler),
+    (r'/_laeproxy/stats', StatsHandler),
+    (r'/_ah/warmup', WarmupHandler),
     ), debug=DEV)
 
 def main():
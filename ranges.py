@@ -0,0 +1,98 @@
+'''
+Byte range helpers for laeproxy.
+'''
+
+
+def parse_content_range(value):
+    '''
+    Parses a Content-Range header of the form "bytes x-y/z" into
+    (x, y, z), with z None if the entity length is unknown ("*").
+    Raises ValueError on anything else.
+    '''
+    if not value.startswith('bytes '):
+        raise ValueError('Content-Range only supported in bytes')
+    sent, total = value[6:].split('/', 1)
+    start, end = [int(i) for i in sent.split('-', 1)]
+    total = None if total.strip() == '*' else int(total)
+    if not (0 <= start <= end) or (total is not None and end >= total):
+        raise ValueError('Invalid Content-Range %r' % value)
+    return start, end, total
+
+
+def format_content_range(start, end, total):
+    return 'bytes %d-%d/%s' % (start, end, '*' if total is None else total)
+
+
+def view(content, start, end):
+    '''
+    Returns bytes start through end (inclusive) of content without copying
+    them, or content itself if that is all of it.
+    '''
+    if start == 0 and end == len(content) - 1:
+        return content
+    return memoryview(content)[start:end+1]
+
+
+def extract(status, headers, content, start, end):
+    '''
+    Returns (start, end, total, body) for the part of an upstream response
+    that covers a range starting at start, trimmed to end, with body a view
+    of content. Raises ValueError if the response doesn't cover start.
+    '''
+    if status == 200:
+        cstart, total = 0, len(content)
+        cend = total - 1
+    elif status == 206:
+        cstart, cend, total = parse_content_range(headers.get('content-range', ''))
+        if len(content) != cend - cstart + 1:
+            raise ValueError('Content-Range does not match body length %d' % len(content))
+    else:
+        raise ValueError('Unexpected status %d' % status)
+    if not cstart <= start <= cend:
+        raise ValueError('Response covers %d-%d, not %d' % (cstart, cend, start))
+    end = min(end, cend)
+    return start, end, total, view(content, start - cstart, end - cstart)
+
+
+def multipart_byteranges(parts, content_type, boundary):
+    '''
+    Renders (start, end, total, body) parts as a multipart/byteranges body,
+    per http://tools.ietf.org/html/rfc2616#section-19.2.
+    '''
+    out = bytearray()
+    for start, end, total, body in parts:
+        out += ('--%s\r\n' % boundary).encode('ascii')
+        if content_type:
+            out += ('Content-Type: %s\r\n' % content_type).encode('latin-1')
+        out += ('Content-Range: %s\r\n\r\n' % format_content_range(start, end, total)).encode('ascii')
+        out += body
+        out += b'\r\n'
+    out += ('--%s--\r\n' % boundary).encode('ascii')
+    return out
+
+
+def parse_range(value):
+    '''
+    Parses a Range header the way webob 1.1 does, into a list of (start, end)
+    pairs with uninclusive end, None for an open end and a negative start
+    for a suffix range. Returns None if value is not a valid bytes range.
+    '''
+    if not value or not value.startswith('bytes='):
+        return None
+    ranges = []
+    for spec in value[6:].split(','):
+        start, sep, end = spec.strip().partition('-')
+        if not sep:
+            return None
+        try:
+            if not start:
+                ranges.append((-int(end), None))
+                continue
+            start = int(start)
+            end = int(end) + 1 if end else None
+        except ValueError:
+            return None
+        if start < 0 or (end is not None and start >= end):
+            return None
+        ranges.append((start, end))
+    return ranges
@@ -0,0 +1,440 @@
+'''
+In-process counters and latency histograms for laeproxy.
+
+Handler threads only ever touch their own shard, so the request path never
+contends on a lock. Locks are taken once per thread, when it first
+registers its shard, and by readers summing across shards. Shards of
+threads that have ended are folded into a base shard then, so there are
+never many more shards than live threads.
+'''
+
+from collections import OrderedDict, defaultdict
+from math import log
+from numbers import Number
+
+import logging
+import re
+import threading
+
+try:
+    from time import monotonic
+except ImportError: # python 2, which has no monotonic clock we can use on App Engine
+    from time import time as _time
+    _clock_lock = threading.Lock()
+    _clock_last = [0]
+
+    def monotonic():
+        '''
+        The wall clock, held still while it is set back so that durations
+        taken with it never come out negative (only short).
+        '''
+        t = _time()
+        with _clock_lock:
+            if t > _clock_last[0]:
+                _clock_last[0] = t
+            return _clock_last[0]
+
+from constants import *
+
+logger = logging.getLogger('laeproxy')
+
+
+class _Sharded(object):
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = [] # (thread, shard) for threads seen since the last fold
+        self._base = self._new_shard() # what ended threads added up to
+        self._lock = threading.Lock()
+
+    def _new_shard(self):
+        raise NotImplementedError
+
+    def _merge(self, into, shard):
+        raise NotImplementedError
+
+    def _copy(self, shard):
+        raise NotImplementedError
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = self._new_shard()
+            with self._lock:
+                self._fold()
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def _fold(self):
+        '''
+        Merges the shards of threads that have ended into the base shard.
+        Called with the lock held. Ended threads can't touch their shards
+        any more, so nothing is lost.
+        '''
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                self._merge(self._base, shard)
+        self._shards = live
+
+    def _copies(self):
+        '''
+        Returns copies of the base shard and every live thread's shard.
+        '''
+        with self._lock:
+            self._fold()
+            return [self._copy(self._base)] + [self._copy(shard) for thread, shard in self._shards]
+
+
+class Counters(_Sharded):
+    '''
+    Counters named by strings, or by (name, key) pairs for counts broken
+    down by something like upstream host.
+    '''
+
+    def _new_shard(self):
+        return defaultdict(int)
+
+    def _merge(self, into, shard):
+        for k, v in shard.items():
+            into[k] += v
+
+    def _copy(self, shard):
+        # dict.copy is atomic under the GIL, iterating a live shard is not
+        return shard.copy()
+
+    def incr(self, name, n=1):
+        self._shard()[name] += n
+
+    def snapshot(self):
+        total = defaultdict(int)
+        for shard in self._copies():
+            self._merge(total, shard)
+        return dict(total)
+
+
+class Histogram(_Sharded):
+    '''
+    Histogram of durations in milliseconds. Buckets grow geometrically, so
+    memory stays fixed however many values are recorded, and percentiles
+    are accurate to within one bucket (LATENCY_BUCKET_GROWTH).
+    '''
+
+    def __init__(self, nbuckets=LATENCY_BUCKETS, least=LATENCY_MIN_MS, growth=LATENCY_BUCKET_GROWTH):
+        self.nbuckets = nbuckets
+        self.least = least
+        self.growth = growth
+        self._loggrowth = log(growth)
+        _Sharded.__init__(self)
+
+    def _new_shard(self):
+        return [0] * self.nbuckets
+
+    def _merge(self, into, shard):
+        for i, n in enumerate(shard):
+            into[i] += n
+
+    def _copy(self, shard):
+        return list(shard)
+
+    def bound(self, i):
+        '''
+        Upper bound of bucket i.
+        '''
+        return self.least * self.growth ** i
+
+    def add(self, ms):
+        i = int(log(ms / self.least) / self._loggrowth) + 1 if ms > self.least else 0
+        self._shard()[min(i, self.nbuckets - 1)] += 1
+
+    def counts(self):
+        counts = [0] * self.nbuckets
+        for shard in self._copies():
+            self._merge(counts, shard)
+        return counts
+
+    def summary(self, percentiles=LATENCY_PERCENTILES):
+        '''
+        Returns the number of values recorded and, for each percentile, the
+        upper bound of the bucket it falls in, like {'count': 12, 'p50': 1.2}.
+        '''
+        counts = self.counts()
+        total = sum(counts)
+        summary = {'count': total}
+        for p in percentiles:
+            rank = total * p / 100.0
+            seen = 0
+            for i, n in enumerate(counts):
+                seen += n
+                if n and seen >= rank:
+                    break
+            summary['p%s' % p] = round(self.bound(i), 3) if total else None
+        return summary
+
+
+class LatencyStats(object):
+    '''
+    Histograms of request latency broken down by dimension (upstream host,
+    method, result class) plus one per handler phase. Each dimension keeps
+    at most maxkeys histograms, values for further keys are lumped together
+    under STATS_OTHER_KEY.
+    '''
+
+    def __init__(self, maxkeys=LATENCY_MAX_KEYS):
+        self.maxkeys = maxkeys
+        self._histograms = {}
+        self._nkeys = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def histogram(self, dimension, key):
+        histogram = self._histograms.get((dimension, key))
+        if histogram is None:
+            with self._lock:
+                if (dimension, key) not in self._histograms:
+                    if self._nkeys[dimension] >= self.maxkeys:
+                        key = STATS_OTHER_KEY
+                        self._histograms.setdefault((dimension, key), Histogram())
+                    else:
+                        self._nkeys[dimension] += 1
+                        self._histograms[(dimension, key)] = Histogram()
+                histogram = self._histograms[(dimension, key)]
+        return histogram
+
+    def record(self, timer, **dimensions):
+        for dimension, key in dimensions.items():
+            self.histogram(dimension, key).add(timer.elapsed)
+        for phase, ms in timer.phases.items():
+            self.histogram('phase', phase).add(ms)
+
+    def stats(self):
+        stats = defaultdict(dict)
+        for (dimension, key), histogram in list(self._histograms.items()):
+            stats[dimension][key] = histogram.summary()
+        return dict(stats)
+
+
+class PhaseTimer(object):
+    '''
+    Times the phases of handling a request with a monotonic clock. Each
+    call to mark ends the named phase, which is taken to have started at
+    the previous mark. Phases marked more than once add up.
+    '''
+
+    def __init__(self, clock=monotonic):
+        self.clock = clock
+        self.started = self._last = clock()
+        self.phases = OrderedDict() # name -> ms
+        self.elapsed = None
+
+    def mark(self, phase):
+        t = self.clock()
+        self.phases[phase] = self.phases.get(phase, 0) + (t - self._last) * 1000
+        self._last = t
+
+    def stop(self):
+        self.elapsed = (self.clock() - self.started) * 1000
+        return self.elapsed
+
+    def server_timing(self):
+        '''
+        Value for a Server-Timing header, per
+        http://www.w3.org/TR/server-timing/.
+        '''
+        phases = list(self.phases.items()) + [('total', self.elapsed)]
+        return ', '.join('%s;dur=%.1f' % i for i in phases if i[1] is not None)
+
+
+class KeyCap(object):
+    '''
+    Admits the first maxkeys keys it sees and maps any others to
+    STATS_OTHER_KEY, to bound the memory used by counts broken down by key.
+    '''
+
+    def __init__(self, maxkeys):
+        self.maxkeys = maxkeys
+        self._keys = set()
+        self._lock = threading.Lock()
+
+    def __call__(self, key):
+        if key in self._keys:
+            return key
+        if len(self._keys) >= self.maxkeys:
+            return STATS_OTHER_KEY
+        with self._lock:
+            if len(self._keys) < self.maxkeys:
+                self._keys.add(key)
+                return key
+        return STATS_OTHER_KEY
+
+
+def nest(counts):
+    '''
+    Turns the (name, key) counters of a Counters snapshot into nested
+    dicts, e.g. {('errors', 'DownloadError'): 2} into
+    {'errors': {'DownloadError': 2}}, leaving other counters alone.
+    '''
+    nested = {}
+    for name, n in counts.items():
+        if isinstance(name, tuple):
+            name, key = name
+            nested.setdefault(name, {})[key] = n
+        else:
+            nested[name] = n
+    return nested
+
+
+class MemcacheAggregate(object):
+    '''
+    Adds up Counters across instances in memcache.
+
+    sources maps names to Counters. maybe_flush, called on the request path,
+    adds what they've counted since the last flush to memcache with a
+    single offset_multi call, at most every interval seconds and on one
+    thread at a time; other threads never wait for it. memcache can't list
+    keys, so the names of the counters are kept in an index updated with
+    compare-and-set.
+
+    client must be a memcache.Client, for gets and cas.
+    '''
+
+    def __init__(self, client, sources, namespace=STATS_MEMCACHE_NAMESPACE,
+            interval=STATS_MEMCACHE_INTERVAL, clock=monotonic):
+        self.client = client
+        self.sources = sources
+        self.namespace = namespace
+        self.interval = interval
+        self.clock = clock
+        self._flushed = {}
+        self._indexed = set()
+        self._next = clock() + interval
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(source, name):
+        if isinstance(name, tuple):
+            name = '%s|%s' % name
+        return '%s/%s' % (source, name)
+
+    @staticmethod
+    def _unkey(key):
+        source, name = key.split('/', 1)
+        if '|' in name:
+            name = tuple(name.split('|', 1))
+        return source, name
+
+    def maybe_flush(self):
+        if self.clock() < self._next or not self._lock.acquire(False):
+            return
+        try:
+            self._next = self.clock() + self.interval
+            self.flush()
+        except Exception as e:
+            logger.warn('Flushing stats to memcache failed: %r', e)
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        current = {}
+        for source, counters in self.sources.items():
+            for name, n in counters.snapshot().items():
+                current[self._key(source, name)] = n
+        deltas = dict((k, n - self._flushed.get(k, 0)) for k, n in current.items())
+        deltas = dict((k, n) for k, n in deltas.items() if n)
+        if not deltas:
+            return
+        if not self._index(set(deltas) - self._indexed):
+            return
+        self.client.offset_multi(deltas, namespace=self.namespace, initial_value=0)
+        self._flushed = current
+
+    def _index(self, names):
+        if not names:
+            return True
+        client, key, ns = self.client, STATS_MEMCACHE_INDEX_KEY, self.namespace
+        for attempt in range(3):
+            index = client.gets(key, namespace=ns)
+            if index is None:
+                done = client.add(key, frozenset(names), namespace=ns)
+            elif len(index | names) > STATS_MEMCACHE_MAXKEYS:
+                logger.warn('Too many stats keys in memcache, not adding %d more', len(names - index))
+                return False
+            else:
+                done = names <= index or client.cas(key, index | names, namespace=ns)
+            if done:
+                self._indexed |= names
+                return True
+        return False
+
+    def totals(self):
+        '''
+        Returns the counters added up across instances, by source name,
+        like {source: {counter: n}}, nested like nest does.
+        '''
+        index = self.client.get(STATS_MEMCACHE_INDEX_KEY, namespace=self.namespace) or ()
+        values = self.client.get_multi(list(index), namespace=self.namespace) if index else {}
+        totals = defaultdict(dict)
+        for key, n in values.items():
+            source, name = self._unkey(key)
+            totals[source][name] = int(n)
+        return dict((source, nest(counts)) for source, counts in totals.items())
+
+
+def _metric_name(*parts):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', '_'.join(parts))
+
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _samples(name, labels, value):
+    '''
+    Returns the exposition lines for value: a number as a sample of name,
+    a dict as the samples of name suffixed with each of its keys in turn.
+    Anything else, like None for a stat not known yet, isn't a sample.
+    '''
+    if isinstance(value, dict):
+        lines = []
+        for key, v in sorted(value.items()):
+            lines.extend(_samples(_metric_name(name, str(key)), labels, v))
+        return lines
+    if isinstance(value, Number):
+        return ['%s%s %s' % (name, '{%s}' % labels if labels else '', int(value) if isinstance(value, bool) else value)]
+    return []
+
+
+def prometheus_text(stats, prefix='laeproxy'):
+    '''
+    Renders stats in the Prometheus text exposition format. stats maps
+    section names to numbers or to dicts of counters, which may themselves
+    be dicts by key (labelled per PROMETHEUS_LABELS) of counts or of dicts
+    of numbers, rendered as one series per number. The 'latency' section is
+    rendered as summaries, from LatencyStats.stats.
+    '''
+    lines = []
+    for section, values in sorted(stats.items()):
+        if section == 'latency':
+            name = _metric_name(prefix, 'latency_ms')
+            lines.append('# TYPE %s summary' % name)
+            for dimension, keys in sorted(values.items()):
+                for key, summary in sorted(keys.items()):
+                    labels = 'dimension="%s",key="%s"' % (dimension, _label_value(key))
+                    for p in LATENCY_PERCENTILES:
+                        if summary['p%s' % p] is not None:
+                            lines.append('%s{%s,quantile="%s"} %s' % (name, labels, p / 100.0, summary['p%s' % p]))
+                    lines.append('%s_count{%s} %s' % (name, labels, summary['count']))
+        elif isinstance(values, dict):
+            for counter, value in sorted(values.items()):
+                name = _metric_name(prefix, section, counter)
+                if isinstance(value, dict):
+                    label = PROMETHEUS_LABELS.get(counter, 'key')
+                    for key, n in sorted(value.items()):
+                        lines.extend(_samples(name, '%s="%s"' % (label, _label_value(key)), n))
+                else:
+                    lines.extend(_samples(name, '', value))
+        else:
+            lines.extend(_samples(_metric_name(prefix, section), '', values))
+    return '\n'.join(lines) + '\n'
@@ -1,14 +1,29 @@
 #!/usr/bin/env python2.7
 
+from admission import RateLimiter
+from cache import CacheEntry, MemcacheTier
 from constants import *
 from functools import partial
 from gaedriver import load_config_from_file, setup_app, teardown_app
+from json import dumps, loads
 from multiprocessing import Process
-from requests import get
+from requests import get, head, post
+from threading import Event, Thread
+from upstream import CircuitBreaker, SingleFlight
+from uuid import uuid4
 from unittest2 import TestCase, main
 from webob import Request, Response, __version__ as webob_version
 from wsgiref.simple_server import make_server
 
+import re
+import sys
+import time
+
+sys.path.append('bench')
+from gaestub import MemcacheClient
+
+import laeproxy
+
 TEST_CONFIG_FILE = './gaedriver.conf'
 config = load_config_from_file(TEST_CONFIG_FILE)
 
@@ -68,22 +83,46 @@ class MockServer(object):
             handler(req, res, *args, **kw)
         return res(environ, start_response)
 
-    def _handle_echo(self, req, res, msg=''):
+    def _handle_echo(self, req, res, msg='', status=200, delay=0):
         '''
-        Creates a response body matching the value of the 'msg' parameter.
+        Creates a response body matching the value of the 'msg' parameter,
+        with the status code passed as 'status', after 'delay' seconds.
         '''
+        time.sleep(float(delay))
+        res.status_int = int(status)
         res.text = unicode(msg)
 
+    def _handle_header(self, req, res, name):
+        '''
+        Creates a response body matching the value of the request header
+        named by the 'name' parameter.
+        '''
+        res.text = unicode(req.headers.get(name, ''))
+
+    def _handle_cookies(self, req, res, *names, **kw):
+        '''
+        Sets a cookie for each name passed, in separate Set-Cookie headers.
+        A nonce parameter is ignored, as for _handle_size.
+        '''
+        for name in names:
+            res.headers.add('Set-Cookie', '%s=1' % name)
+        res.text = u'cookies'
+
     def _handle_redirect(self, req, res, location, status=302):
         res.status_int = status
         res.location = location
 
-    def _handle_size(self, req, res, size=URLFETCH_RES_MAXBYTES, ignore_range=False):
+    def _handle_size(self, req, res, size=URLFETCH_RES_MAXBYTES, ignore_range=False, max_age=None, etag=None, nonce=None, extra=0):
         '''
         Creates a dummy response body of the requested size.
 
+        If max_age is passed, the response is marked cacheable for that many
+        seconds, and if etag is passed it is sent as the response's ETag.
+        nonce is ignored and lets tests defeat laeproxy's cache.
+
         If ignore_range is False and a Range header is sent of the form
-        'bytes=x-y', it will be honored.
+        'bytes=x-y', it will be honored, with extra more bytes than asked for
+        if extra is passed.
 
         We don't have to bother with range requests of other forms because
         laeproxy does not accept them (tested for in
@@ -99,7 +138,7 @@ class MockServer(object):
             try:
                 ranges = req.range.ranges
                 assert ranges
-                start, end = ranges[0][0], ranges[0][1]
+                start, end = ranges[0][0], min(ranges[0][1] + int(extra), size)
                 res.status_int = 206
                 res.headers['content-range'] = 'bytes %d-%d/%d' % (start, end-1, size)
                 total = end - start # webob uses uninclusive end so no need to add 1
@@ -108,6 +147,10 @@ class MockServer(object):
             except Exception as e:
                 res.status_int = 400
                 res.text = u'No size passed in via query string or Range header\n%s' % e
+        if max_age is not None:
+            res.cache_control = 'max-age=%s' % max_age
+        if etag is not None:
+            res.headers['etag'] = '"%s"' % etag
         res.text = u'-' * size
 
 
@@ -133,6 +176,39 @@ class LaeproxyTest(TestCase):
         res = self._make_mockserver_req('echo', msg=msg)
         self.assertEqual(res.text, msg)
 
+    def test_server_timing(self):
+        '''
+        Every response should break down where laeproxy spent its time.
+        '''
+        res = self._make_mockserver_req('echo', msg='hi')
+        phases = [i.split(';')[0] for i in res.headers[H_SERVER_TIMING].split(', ')]
+        self.assertEqual(phases[0], 'url')
+        self.assertIn('fetch', phases)
+        self.assertEqual(phases[-1], 'total')
+
+    def test_chunk_size_advertised(self):
+        '''
+        Range responses should recommend a chunk size for the upstream host,
+        and ranges up to RANGE_REQ_SIZE should always be accepted.
+        '''
+        res = self._make_mockserver_req('size', size=RANGE_REQ_SIZE)
+        self.assertEqual(res.status_code, 206)
+        chunksize = int(res.headers[H_CHUNK_SIZE])
+        self.assertTrue(CHUNK_MIN_SIZE <= chunksize <= CHUNK_MAX_SIZE)
+
+    def test_range_limit_not_raised_by_chunk_size(self):
+        '''
+        However fast an upstream host has been, clients not sending H_FANOUT
+        may not request more than RANGE_REQ_SIZE bytes at once.
+        '''
+        for i in range(CHUNK_MIN_SAMPLES + 1):
+            res = self._make_mockserver_req('size', size=RANGE_REQ_SIZE, nonce=uuid4().hex)
+            self.assertEqual(res.status_code, 206)
+            self.assertTrue(int(res.headers[H_CHUNK_SIZE]) <= RANGE_REQ_SIZE)
+        res = self._make_mockserver_req('size', headers={'range': 'bytes=0-%d' % RANGE_REQ_SIZE})
+        self.assertEqual(res.status_code, 400)
+        self.assertNotIn(H_UPSTREAM_STATUS_CODE, res.headers)
+
     def test_unsatisfiable_ranges_rejected(self):
         '''
         Tests that laeproxy rejects requests without a
@@ -144,7 +220,7 @@ class LaeproxyTest(TestCase):
             'bytes=5-',      # open-ended
             'bytes=-5',      # tail
             'bytes=2-1',     # nonsensical
-            'bytes=4-5,7-8', # multipart
+            'bytes=4-5,7-',  # multipart with open-ended part
             'bytes=0-%d' % RANGE_REQ_SIZE, # one byte too big
             )
         for i in UNSATISFIABLE_RANGES:
@@ -153,6 +229,40 @@ class LaeproxyTest(TestCase):
             # laeproxy never even forwarded the request
             self.assertNotIn(H_UPSTREAM_STATUS_CODE, res.headers)
 
+    def test_multipart_ranges(self):
+        '''
+        Requests for multiple ranges should get a multipart/byteranges 206
+        with one part per range.
+        '''
+        res = self._make_mockserver_req('size', size=100, headers={'range': 'bytes=4-5,7-8'})
+        self.assertEqual(res.status_code, 206)
+        self.assertTrue(res.headers['content-type'].startswith('multipart/byteranges; boundary='))
+        self.assertIn('Content-Range: bytes 4-5/100', res.text)
+        self.assertIn('Content-Range: bytes 7-8/100', res.text)
+
+    def test_multipart_ranges_upstream_error(self):
+        '''
+        An error status from upstream for a request for multiple ranges
+        should be passed through with its body, as for a single range.
+        '''
+        res = self._make_mockserver_req('echo', msg='gone', status=404, headers={'range': 'bytes=0-1,4-5'})
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(res.headers[H_UPSTREAM_STATUS_CODE], '404')
+        self.assertEqual(res.text, 'gone')
+
+    def test_multipart_ranges_range_ignoring_server(self):
+        '''
+        If destination server ignores Range headers, every part of a
+        multipart response should be cut from the entire entity it sends.
+        '''
+        res = self._make_mockserver_req('size', size=100, ignore_range=True, nonce=uuid4().hex,
+            headers={'range': 'bytes=4-5,7-8,90-109'})
+        self.assertEqual(res.status_code, 206)
+        self.assertEqual(res.headers[H_UPSTREAM_STATUS_CODE], '200')
+        self.assertIn('Content-Range: bytes 4-5/100', res.text)
+        self.assertIn('Content-Range: bytes 7-8/100', res.text)
+        self.assertIn('Content-Range: bytes 90-99/100', res.text)
+
     def test_range_honoring_server(self):
         '''
         If destination server honors range headers, requesting a range up
@@ -163,6 +273,19 @@ class LaeproxyTest(TestCase):
         self.assertEqual(len(res.text), size)
         self.assertEqual(res.status_code, 206)
 
+    def test_fanout_range(self):
+        '''
+        Clients sending H_FANOUT may request more than RANGE_REQ_SIZE bytes,
+        which laeproxy fetches as concurrent sub-ranges.
+        '''
+        size = RANGE_REQ_SIZE * 3
+        res = self._make_mockserver_req('size', size=size,
+            headers={'range': 'bytes=0-%d' % (size-1), H_FANOUT: '1'})
+        self.assertEqual(res.status_code, 206)
+        self.assertEqual(len(res.text), size)
+        self.assertEqual(res.headers[H_FANOUT], '3')
+        self.assertEqual(res.headers['content-range'], 'bytes 0-%d/%d' % (size-1, size))
+
     def test_range_ignoring_server(self):
         '''
         If destination server ignores Range headers and the requested entity
@@ -176,6 +299,163 @@ class LaeproxyTest(TestCase):
         self.assertIn(H_TRUNCATED, res.headers)
         self.assertEqual(res.headers[H_UPSTREAM_STATUS_CODE], '200')
 
+    def test_cacheable_response_served_from_cache(self):
+        '''
+        A cacheable range response should be answered from laeproxy's cache
+        the second time it is requested, without changing the body.
+        '''
+        params = dict(size=RANGE_REQ_SIZE, max_age=60, nonce=uuid4().hex)
+        res1 = self._make_mockserver_req('size', **params)
+        res2 = self._make_mockserver_req('size', **params)
+        self.assertTrue(res1.headers[H_LAEPROXY_RESULT].startswith(RETRIEVED_FROM_NET[:-2]))
+        self.assertTrue(res2.headers[H_LAEPROXY_RESULT].startswith(RETRIEVED_FROM_CACHE[:-2]))
+        self.assertEqual(res2.status_code, 206)
+        self.assertEqual(res1.text, res2.text)
+
+    def test_oversized_range_response_not_cached_untrimmed(self):
+        '''
+        If upstream answers with more than the range requested, laeproxy
+        should trim it, and answer the same request the same way again
+        rather than from an untrimmed cached copy.
+        '''
+        params = dict(size=1000, max_age=60, extra=100, nonce=uuid4().hex)
+        for i in range(2):
+            res = self._make_mockserver_req('size', headers={'range': 'bytes=0-99'}, **params)
+            self.assertEqual(res.status_code, 206)
+            self.assertEqual(res.headers['content-range'], 'bytes 0-99/1000')
+            self.assertEqual(len(res.text), 100)
+
+    def test_conditional_request_answered_locally(self):
+        '''
+        Once laeproxy has seen a fresh response with an ETag, it should answer
+        conditional requests matching it with a 304 without going upstream
+        (MockServer never sends 304s itself).
+        '''
+        params = dict(size=100, max_age=60, etag='v1', nonce=uuid4().hex)
+        res1 = self._make_mockserver_req('size', **params)
+        self.assertEqual(res1.headers['etag'], '"v1"')
+        res2 = self._make_mockserver_req('size', headers={'range': 'bytes=0-99', 'if-none-match': '"v1"'}, **params)
+        self.assertEqual(res2.status_code, 304)
+        self.assertTrue(res2.headers[H_LAEPROXY_RESULT].startswith(NOT_MODIFIED_LOCAL[:-2]))
+
+    def test_size_probe_answered_from_metadata(self):
+        '''
+        After a fresh response for an entity, a "bytes=0-0" probe should be
+        answered with its total length without going upstream.
+        '''
+        params = dict(size=1000, max_age=60, nonce=uuid4().hex)
+        self._make_mockserver_req('size', headers={'range': 'bytes=0-99'}, **params)
+        res = self._make_mockserver_req('size', headers={'range': 'bytes=0-0'}, **params)
+        self.assertEqual(res.status_code, 206)
+        self.assertEqual(res.headers['content-range'], 'bytes 0-0/1000')
+        self.assertEqual(res.text, '-')
+        self.assertTrue(res.headers[H_LAEPROXY_RESULT].startswith(RETRIEVED_FROM_METADATA[:-2]))
+        self.assertNotIn(H_UPSTREAM_STATUS_CODE, res.headers)
+
+    def test_sequential_ranges_prefetched(self):
+        '''
+        Once a client's range requests for a url look sequential, the ranges
+        that follow should be answered from what laeproxy prefetched.
+        '''
+        params = dict(size=1000, nonce=uuid4().hex)
+        for start in (0, 100):
+            self._make_mockserver_req('size', headers={'range': 'bytes=%d-%d' % (start, start+99)}, **params)
+        res = self._make_mockserver_req('size', headers={'range': 'bytes=200-299'}, **params)
+        self.assertEqual(res.status_code, 206)
+        self.assertEqual(res.headers['content-range'], 'bytes 200-299/1000')
+        self.assertEqual(len(res.text), 100)
+        self.assertTrue(res.headers[H_LAEPROXY_RESULT].startswith(RETRIEVED_FROM_PREFETCH[:-2]))
+
+    def test_range_ignoring_server_entity_cached(self):
+        '''
+        If destination server ignores Range headers but sends the entire
+        entity, laeproxy should answer with the requested range as a 206 and
+        serve the following range from the entity it kept.
+        '''
+        size = RANGE_REQ_SIZE * 2
+        params = dict(size=size, ignore_range=True, nonce=uuid4().hex)
+        res1 = self._make_mockserver_req('size', **params)
+        self.assertEqual(res1.status_code, 206)
+        self.assertEqual(len(res1.text), RANGE_REQ_SIZE)
+        self.assertEqual(res1.headers['content-range'], 'bytes 0-%d/%d' % (RANGE_REQ_SIZE-1, size))
+        self.assertEqual(res1.headers[H_UPSTREAM_STATUS_CODE], '200')
+        res2 = self._make_mockserver_req('size', headers={'range': 'bytes=%d-%d' % (RANGE_REQ_SIZE, size-1)}, **params)
+        self.assertEqual(res2.status_code, 206)
+        self.assertEqual(len(res2.text), RANGE_REQ_SIZE)
+        self.assertTrue(res2.headers[H_LAEPROXY_RESULT].startswith(RETRIEVED_FROM_ENTITY_CACHE[:-2]))
+
+    def test_stats_prometheus_format(self):
+        '''
+        Every line of the stats in the Prometheus text format should be a
+        valid sample or a comment, including the per-host chunk sizes and
+        hedger latencies.
+        '''
+        self._make_mockserver_req('echo', msg='hi')
+        url = 'http://%s/_laeproxy/stats' % config.app_hostname
+        stats = get(url).json()
+        res = get(url + '?format=prometheus')
+        self.assertEqual(res.status_code, 200)
+        series = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{[a-zA-Z_][a-zA-Z0-9_]*="(\\.|[^"\\])*"'
+            r'(,[a-zA-Z_][a-zA-Z0-9_]*="(\\.|[^"\\])*")*\})? (\S+)$')
+        names = set()
+        for line in res.text.splitlines():
+            if line.startswith('#'):
+                continue
+            match = series.match(line)
+            self.assertTrue(match, line)
+            float(match.group(6))
+            names.add(match.group(1) + (match.group(2) or '').split('=')[0])
+        self.assertIn('laeproxy_chunksizes_hosts_chunk_size{host', names)
+        if stats['hedger'].get('hosts'):
+            self.assertIn('laeproxy_hedger_hosts_p50{host', names)
+
+    def _post_batch(self, entries):
+        '''
+        Posts entries to /batch and returns its frames as a dict of index to
+        (meta, body).
+        '''
+        res = post('http://%s/batch' % config.app_hostname, data=dumps(entries))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['content-type'], BATCH_CONTENT_TYPE)
+        frames = {}
+        body = res.content
+        while body:
+            meta, body = body.split('\r\n', 1)
+            meta = loads(meta)
+            frames[meta['index']] = meta, body[:meta['length']]
+            body = body[meta['length'] + 2:]
+        return frames
+
+    def test_batch(self):
+        '''
+        Entries posted to /batch should each come back in their own frame,
+        in whatever order they completed.
+        '''
+        mockserver = 'http://localhost:%d/' % MOCKSERVER_PORT
+        entries = [
+            {'url': mockserver + 'size?size=100', 'range': 'bytes=0-9'},
+            {'url': mockserver + 'echo?msg=hello', 'range': 'bytes=0-99'},
+            {'method': 'post', 'url': mockserver + 'echo'},
+            ]
+        frames = self._post_batch(entries)
+        self.assertEqual(sorted(frames), [0, 1, 2])
+        self.assertEqual(frames[0][0]['status'], 206)
+        self.assertEqual(frames[0][1], '-' * 10)
+        self.assertEqual(frames[1][1], 'hello')
+        self.assertEqual(frames[2][0]['status'], 400)
+
+    def test_batch_oversized_range_response_trimmed(self):
+        '''
+        A batch entry should come back trimmed to its range even if upstream
+        answers with more, however many times it is asked for.
+        '''
+        url = 'http://localhost:%d/size?size=1000&max_age=60&extra=100&nonce=%s' % (MOCKSERVER_PORT, uuid4().hex)
+        for i in range(2):
+            meta, body = self._post_batch([{'url': url, 'range': 'bytes=0-9'}])[0]
+            self.assertEqual(meta['status'], 206)
+            self.assertIn(['Content-Range', 'bytes 0-9/1000'], meta['headers'])
+            self.assertEqual(body, '-' * 10)
+
     def test_invalid_relative_location_header(self):
         '''
         If destination server sends a Location header with a relative uri,
@@ -188,6 +468,68 @@ class LaeproxyTest(TestCase):
         self.assertFalse(loc.startswith('http://' + config.app_hostname))
         self.assertTrue(loc.startswith('http://localhost:%d' % MOCKSERVER_PORT))
 
+    def test_redirect_followed(self):
+        '''
+        Clients sending H_FOLLOW_REDIRECTS should get the requested range of
+        what the redirect points to, and where that was.
+        '''
+        res = self._make_mockserver_req('redirect', location='/size',
+            headers={'range': 'bytes=0-9', H_FOLLOW_REDIRECTS: '1'})
+        self.assertEqual(res.status_code, 206)
+        self.assertEqual(res.text, '-' * 10)
+        self.assertEqual(res.headers[H_FINAL_URL], 'http://localhost:%d/size' % MOCKSERVER_PORT)
+
+    def test_redirect_to_other_host_drops_credentials(self):
+        '''
+        The client's Authorization header should follow a redirect on the
+        same host but not one to another host.
+        '''
+        for host, expected in (('localhost', 'secret'), ('127.0.0.1', '')):
+            location = 'http://%s:%d/header?name=Authorization' % (host, MOCKSERVER_PORT)
+            res = self._make_mockserver_req('redirect', location=location,
+                headers={'authorization': 'secret', H_FOLLOW_REDIRECTS: '1'})
+            self.assertEqual(res.text, expected)
+
+    def test_repeated_headers_kept(self):
+        '''
+        Repeated upstream response headers like Set-Cookie should all reach
+        the client.
+        '''
+        res = self._make_mockserver_req('cookies/a/b', nonce=uuid4().hex)
+        self.assertEqual(res.headers['set-cookie'], 'a=1, b=1')
+
+    def test_concurrent_requests_coalesced(self):
+        '''
+        Identical requests arriving while the first is being fetched should
+        share its response rather than each fetch their own.
+        '''
+        url = self.app_root + 'echo?msg=%s&delay=0.5' % uuid4().hex
+        results = []
+        threads = [Thread(target=lambda: results.append(head(url))) for i in range(4)]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.05)
+        for thread in threads:
+            thread.join()
+        self.assertEqual([res.status_code for res in results], [200] * 4)
+        self.assertEqual(sum(H_COALESCED in res.headers for res in results), 3)
+
+    def test_failing_host_fails_fast(self):
+        '''
+        Once fetches from a host have failed BREAKER_FAILURES times in a row,
+        requests for it should be refused with a 503 and a Retry-After
+        without trying it again.
+        '''
+        url = 'http://%s/http/localhost:1/' % config.app_hostname
+        for i in range(BREAKER_FAILURES + 1):
+            res = get(url, headers={'range': 'bytes=0-9'})
+            if res.status_code == 503:
+                break
+            self.assertEqual(res.status_code, 504)
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.headers[H_LAEPROXY_RESULT], CIRCUIT_OPEN)
+        self.assertTrue(0 < int(res.headers['retry-after']) <= BREAKER_COOLDOWN_SECS)
+
     if TEST_REMOTE:
         def test_google_humanstxt(self):
             url_direct = 'http://www.google.com/humans.txt'
@@ -214,6 +556,163 @@ class LaeproxyTest(TestCase):
 
 
 
+class CircuitBreakerTest(TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.breaker = CircuitBreaker(threshold=2, cooldown=10, clock=lambda: self.now)
+
+    def test_opens_after_threshold(self):
+        self.breaker.failed('host')
+        self.assertEqual(self.breaker.allow('host'), 0)
+        self.breaker.failed('host')
+        self.assertEqual(self.breaker.allow('host'), 10)
+        self.now = 4
+        self.assertEqual(self.breaker.allow('host'), 6)
+
+    def test_half_open_trial(self):
+        '''
+        Once the cooldown is over, one trial fetch should be let through at
+        a time; its failure reopens the circuit, its success closes it.
+        '''
+        self.breaker.failed('host')
+        self.breaker.failed('host')
+        self.now = 10
+        self.assertEqual(self.breaker.allow('host'), 0)
+        self.assertEqual(self.breaker.allow('host'), 10)
+        self.breaker.failed('host')
+        self.now = 15
+        self.assertEqual(self.breaker.allow('host'), 5)
+        self.now = 20
+        self.assertEqual(self.breaker.allow('host'), 0)
+        self.breaker.succeeded('host')
+        self.assertEqual(self.breaker.allow('host'), 0)
+        self.assertEqual(self.breaker.allow('host'), 0)
+        self.breaker.failed('host')
+        self.assertEqual(self.breaker.allow('host'), 0)
+
+
+class SingleFlightTest(TestCase):
+
+    def test_identical_calls_share_one(self):
+        started, release = Event(), Event()
+        calls = []
+        results = []
+
+        def fn():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 'result'
+
+        flight = SingleFlight()
+        threads = [Thread(target=lambda: results.append(flight.do('key', fn))) for i in range(4)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [('result', False)] + [('result', True)] * 3)
+
+
+class AdmissionTest(TestCase):
+    '''
+    Drives laeproxy's WSGI app in this process with a client rate limit
+    small enough to hit, so that other tests' clients aren't refused.
+    '''
+
+    def setUp(self):
+        self.limits, laeproxy.clientlimits = laeproxy.clientlimits, RateLimiter(1, 2)
+
+    def tearDown(self):
+        laeproxy.clientlimits = self.limits
+
+    def _get(self, client):
+        url = '/http/localhost:%d/echo?msg=hi' % MOCKSERVER_PORT
+        return Request.blank(url, headers={'range': 'bytes=0-9'},
+            environ={'REMOTE_ADDR': client}).get_response(laeproxy.app)
+
+    def test_client_over_rate_limit_refused(self):
+        '''
+        A client that has used up its burst should get a 503 with a
+        Retry-After, without the request going upstream, while other
+        clients are still let through.
+        '''
+        for i in range(2):
+            self.assertEqual(self._get('10.0.0.1').status_int, 206)
+        res = self._get('10.0.0.1')
+        self.assertEqual(res.status_int, 503)
+        self.assertEqual(res.headers[H_LAEPROXY_RESULT], CLIENT_RATE_LIMITED)
+        self.assertEqual(res.headers['Retry-After'], '1')
+        self.assertNotIn(H_UPSTREAM_STATUS_CODE, res.headers)
+        self.assertEqual(self._get('10.0.0.2').status_int, 206)
+
+
+class FailingDeleteClient(MemcacheClient):
+
+    def delete(self, key, namespace=None):
+        raise Exception('memcache unavailable')
+
+
+class MemcacheTierTest(TestCase):
+    '''
+    MemcacheTier against gaestub's in-memory memcache.
+    '''
+
+    def _entry(self, content):
+        return CacheEntry(200, [('Content-Type', 'text/plain')], content, None, (), 1000, 2000)
+
+    def _tier(self, client):
+        return MemcacheTier(client, clock=lambda: 1000)
+
+    def test_chunked_round_trip(self):
+        '''
+        Bodies larger than a memcache value should be split into chunks and
+        put back together.
+        '''
+        client = MemcacheClient()
+        tier = self._tier(client)
+        content = b'-' * (MEMCACHE_CHUNK_SIZE * 2 + 10)
+        self.assertTrue(tier.put(('url',), self._entry(content)))
+        self.assertEqual(len(client._data), 4) # the manifest and 3 chunks
+        entry = tier.get(('url',), {})
+        self.assertEqual(entry.status, 200)
+        self.assertEqual(entry.content, content)
+
+    def test_evicted_chunk_misses(self):
+        '''
+        An entry missing a chunk should be a miss, not a truncated body, and
+        its manifest should be dropped.
+        '''
+        client = MemcacheClient()
+        tier = self._tier(client)
+        tier.put(('url',), self._entry(b'-' * (MEMCACHE_CHUNK_SIZE + 10)))
+        chunk = [k for k in client._data if k[1].startswith('c1:')][0]
+        del client._data[chunk]
+        self.assertIsNone(tier.get(('url',), {}))
+        self.assertEqual([k for k in client._data if k[1].startswith('m1:')], [])
+        self.assertEqual(tier.stats()['partial_eviction'], 1)
+
+    def test_failing_delete_still_misses(self):
+        '''
+        memcache failing to drop the manifest of a partly evicted entry
+        should not break lookups.
+        '''
+        client = FailingDeleteClient()
+        tier = self._tier(client)
+        tier.put(('url',), self._entry(b'-' * (MEMCACHE_CHUNK_SIZE + 10)))
+        chunk = [k for k in client._data if k[1].startswith('c1:')][0]
+        del client._data[chunk]
+        self.assertIsNone(tier.get(('url',), {}))
+        self.assertIsNone(tier.get(('url',), {}))
+        self.assertTrue(tier.put(('other',), self._entry(b'small')))
+        self.assertEqual(tier.get(('other',), {}).content, b'small')
+
+
 def start_server():
     httpd = make_server('localhost', MOCKSERVER_PORT, MockServer())
     httpd.serve_forever()
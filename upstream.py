@@ -0,0 +1,623 @@
+'''
+Helpers for talking to upstream servers.
+'''
+
+from collections import OrderedDict
+from stats import Counters, LatencyStats, monotonic
+
+import logging
+import threading
+import time
+
+from constants import *
+
+logger = logging.getLogger('laeproxy')
+
+
+class CoalesceTimeout(Exception):
+    '''
+    Raised to a caller that gave up waiting for a coalesced call.
+    '''
+
+
+class _Call(object):
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = self.error = None
+
+
+class SingleFlight(object):
+    '''
+    Coalesces identical concurrent calls. The first caller for a key makes
+    the call; callers arriving with the same key while it is in flight wait
+    up to maxwait seconds and get its outcome instead of making their own.
+    '''
+
+    def __init__(self, maxwait=COALESCE_MAXWAITSECS, nstripes=COALESCE_STRIPES):
+        self.maxwait = maxwait
+        self._stripes = [(threading.Lock(), {}) for i in range(nstripes)]
+        self.counters = Counters()
+
+    def do(self, key, fn):
+        '''
+        Returns (fn's result, whether it was shared with another caller),
+        or raises what fn raised.
+        '''
+        lock, calls = self._stripes[hash(key) % len(self._stripes)]
+        with lock:
+            call = calls.get(key)
+            leader = call is None
+            if leader:
+                call = calls[key] = _Call()
+        if leader:
+            try:
+                call.result = fn()
+            except Exception as e:
+                call.error = e
+            finally:
+                if call.result is None and call.error is None:
+                    # fn was interrupted by something like DeadlineExceededError
+                    call.error = CoalesceTimeout('Coalesced call for %r did not complete' % (key,))
+                with lock:
+                    del calls[key]
+                call.done.set()
+            self.counters.incr('calls')
+        elif call.done.wait(self.maxwait):
+            self.counters.incr('coalesced')
+        else:
+            self.counters.incr('timeout')
+            raise CoalesceTimeout('Gave up waiting for %r after %ss' % (key, self.maxwait))
+        if call.error is not None:
+            raise call.error
+        return call.result, not leader
+
+    def stats(self):
+        stats = self.counters.snapshot()
+        stats['in_flight'] = sum(len(calls) for lock, calls in self._stripes)
+        return stats
+
+
+class _HostEstimate(object):
+    __slots__ = ('latency', 'rate', 'samples', 'chunk')
+
+    def __init__(self, chunk):
+        self.latency = self.rate = None
+        self.samples = 0
+        self.chunk = chunk
+
+
+class ChunkSizer(object):
+    '''
+    Recommends a range size per upstream host from its observed latency
+    and throughput, kept as moving averages weighted by alpha, for up to
+    maxhosts recently seen hosts.
+
+    A chunk should take about CHUNK_TARGET_SECS to fetch, and never more
+    than CHUNK_DEADLINE_SHARE of the fetch deadline, so slow hosts get
+    smaller chunks that don't risk missing it and fast ones bigger chunks
+    that save round trips. Until a host has CHUNK_MIN_SAMPLES throughput
+    samples, or for unknown hosts, the recommendation is RANGE_REQ_SIZE.
+    Recommendations drop as soon as a host looks slower, but grow by at
+    most CHUNK_MAX_GROWTH times per sample.
+
+    The recommendation sizes the sub-ranges of fanned out fetches; it never
+    changes what ranges clients may request.
+    '''
+
+    def __init__(self, maxhosts=CHUNK_MAX_HOSTS, alpha=CHUNK_EWMA_ALPHA, deadline=URLFETCH_REQ_MAXSECS):
+        self.maxhosts = maxhosts
+        self.alpha = alpha
+        self.secs = min(CHUNK_TARGET_SECS, deadline * CHUNK_DEADLINE_SHARE)
+        self._hosts = OrderedDict() # host -> _HostEstimate, most recently updated last
+        self._lock = threading.Lock()
+        self.counters = Counters()
+
+    def _average(self, old, new):
+        return new if old is None else old + self.alpha * (new - old)
+
+    def record(self, host, nbytes, secs, ttfb=None):
+        '''
+        Records a fetch from host of nbytes that took secs, ttfb of which
+        were spent waiting for the response headers, if known.
+        '''
+        if not host or secs <= 0:
+            return
+        with self._lock:
+            est = self._hosts.pop(host, None) or _HostEstimate(RANGE_REQ_SIZE)
+            self._hosts[host] = est
+            while len(self._hosts) > self.maxhosts:
+                self._hosts.popitem(last=False)
+            if ttfb is not None:
+                est.latency = self._average(est.latency, ttfb)
+            elif nbytes < CHUNK_RATE_MINBYTES:
+                # too small to say much about throughput, so mostly latency
+                est.latency = self._average(est.latency, secs)
+            if nbytes >= CHUNK_RATE_MINBYTES:
+                transfer = max(secs - (est.latency or 0), secs * 0.1)
+                est.rate = self._average(est.rate, nbytes / transfer)
+                est.samples += 1
+            old, est.chunk = est.chunk, self._recommend(est, est.chunk)
+        self.counters.incr('samples')
+        if est.chunk != old:
+            self.counters.incr('raised' if est.chunk > old else 'lowered')
+            logger.debug('Chunk size for %s now %d (latency %.3fs, %.0f bytes/s)',
+                host, est.chunk, est.latency or 0, est.rate or 0)
+
+    def _recommend(self, est, old):
+        if est.samples < CHUNK_MIN_SAMPLES:
+            return RANGE_REQ_SIZE
+        size = est.rate * max(self.secs - (est.latency or 0), 0)
+        size = min(size, old * CHUNK_MAX_GROWTH)
+        size = int(size) // CHUNK_SIZE_STEP * CHUNK_SIZE_STEP
+        return max(CHUNK_MIN_SIZE, min(size, CHUNK_MAX_SIZE))
+
+    def recommend(self, host):
+        '''
+        Returns the recommended range size for host.
+        '''
+        est = self._hosts.get(host)
+        return est.chunk if est else RANGE_REQ_SIZE
+
+    def stats(self):
+        stats = self.counters.snapshot()
+        with self._lock:
+            hosts = list(self._hosts.items())
+        stats['hosts'] = dict((host, {
+            'chunk_size': est.chunk,
+            'latency_ms': est.latency and round(est.latency * 1000, 1),
+            'bytes_per_sec': est.rate and int(est.rate),
+            'samples': est.samples,
+            }) for host, est in hosts)
+        return stats
+
+
+class Hedger(object):
+    '''
+    Races a slow upstream fetch against an identical one. Keeps histograms
+    of fetch latency per upstream host, and once a host has minsamples, a
+    fetch from it still unanswered after the host's percentile latency (but
+    at least HEDGE_MIN_DELAY_SECS) is repeated, and the result of whichever
+    completes first without error is used.
+    '''
+
+    def __init__(self, percentile=HEDGE_PERCENTILE, minsamples=HEDGE_MIN_SAMPLES,
+            maxhosts=HEDGE_MAX_HOSTS, clock=monotonic):
+        self.percentile = percentile
+        self.minsamples = minsamples
+        self.clock = clock
+        self.latency = LatencyStats(maxhosts)
+        self.counters = Counters()
+
+    def delay(self, histogram):
+        '''
+        Returns how long to wait before hedging a fetch whose latency is
+        recorded in histogram, or None if there are too few samples yet.
+        '''
+        summary = histogram.summary((self.percentile,))
+        if summary['count'] < self.minsamples:
+            return None
+        return max(summary['p%s' % self.percentile] / 1000.0, HEDGE_MIN_DELAY_SECS)
+
+    def race(self, host, start, wait_any, deadline):
+        '''
+        Returns the result of the async fetch that start(deadline) starts
+        and returns the rpc for, hedged if it's slow. wait_any(rpcs,
+        timeout) is the backend's. The losing rpc is discarded if it can be,
+        otherwise its result is ignored.
+        '''
+        histogram = self.latency.histogram('host', host)
+        delay = self.delay(histogram)
+        self.counters.incr('fetches')
+        started = self.clock()
+        primary = start(deadline)
+        if delay is None or delay >= deadline or wait_any([primary], delay) is primary:
+            result = primary.get_result()
+            histogram.add((self.clock() - started) * 1000)
+            return result
+
+        self.counters.incr('hedged')
+        logger.debug('Hedging fetch from %s after %.3fs', host, delay)
+        hedge = start(deadline - delay)
+        pending = [primary, hedge]
+        while True:
+            rpc = wait_any(pending)
+            pending.remove(rpc)
+            try:
+                result = rpc.get_result()
+            except Exception:
+                if pending:
+                    continue
+                self.counters.incr('both_failed')
+                raise
+            histogram.add((self.clock() - started) * 1000 - (delay * 1000 if rpc is hedge else 0))
+            self.counters.incr('hedge_won' if rpc is hedge else 'primary_won')
+            for rpc in pending:
+                getattr(rpc, 'discard', lambda: None)()
+            return result
+
+    def stats(self):
+        stats = self.counters.snapshot()
+        fetches, hedged = stats.get('fetches', 0), stats.get('hedged', 0)
+        stats['hedge_rate'] = round(float(hedged) / fetches, 4) if fetches else 0
+        stats['hedge_win_rate'] = round(float(stats.get('hedge_won', 0)) / hedged, 4) if hedged else 0
+        stats['hosts'] = self.latency.stats().get('host', {})
+        return stats
+
+
+class _Circuit(object):
+    __slots__ = ('failures', 'opened')
+
+    def __init__(self):
+        self.failures = 0
+        self.opened = None # when it opened or last let a trial through, if open
+
+
+class CircuitBreaker(object):
+    '''
+    Fails fetches from upstream hosts that keep failing fast, rather than
+    let each tie up a handler thread until its deadline.
+
+    A host's circuit opens after threshold consecutive failures. While it is
+    open, allow refuses fetches from the host, except for one trial every
+    cooldown seconds (half-open), and the first fetch to succeed closes it.
+    State is kept for up to maxhosts recently failing hosts.
+
+    Failures retrying won't fix, like invalid urls or hosts that don't
+    resolve, are remembered by key for negttl seconds along with the
+    response they got, for negative to replay.
+
+    If client (a memcache client) is passed, circuits opening are published
+    there for cooldown seconds, and a host's first failure on another
+    instance opens its circuit there too.
+    '''
+
+    def __init__(self, threshold=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN_SECS, maxhosts=BREAKER_MAX_HOSTS,
+            negttl=NEGATIVE_CACHE_SECS, negmax=NEGATIVE_CACHE_MAXKEYS, client=None,
+            namespace=BREAKER_MEMCACHE_NAMESPACE, clock=monotonic, wallclock=time.time):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.maxhosts = maxhosts
+        self.negttl = negttl
+        self.negmax = negmax
+        self.client = client
+        self.namespace = namespace
+        self.clock = clock
+        self.wallclock = wallclock
+        self._hosts = OrderedDict() # host -> _Circuit, most recently failed last
+        self._negative = OrderedDict() # key -> (expires, status, result), oldest first
+        self._lock = threading.Lock()
+        self.counters = Counters()
+
+    def allow(self, host):
+        '''
+        Returns 0 if a fetch from host may go ahead, otherwise the seconds
+        until the next trial fetch will be let through.
+        '''
+        circuit = self._hosts.get(host)
+        if circuit is None or circuit.opened is None:
+            return 0
+        with self._lock:
+            now = self.clock()
+            wait = circuit.opened + self.cooldown - now
+            if wait <= 0:
+                circuit.opened = now
+        if wait <= 0:
+            self.counters.incr('trials')
+            logger.debug('Letting a trial fetch from %s through', host)
+            return 0
+        self.counters.incr('rejected')
+        return wait
+
+    def succeeded(self, host):
+        '''
+        Records a successful fetch from host.
+        '''
+        if host not in self._hosts:
+            return
+        with self._lock:
+            circuit = self._hosts.pop(host, None)
+        if circuit and circuit.opened is not None:
+            self.counters.incr('closed')
+            logger.info('Circuit for %s closed', host)
+            self._publish(host, None)
+
+    def failed(self, host):
+        '''
+        Records a failed fetch from host.
+        '''
+        if not host:
+            return
+        with self._lock:
+            circuit = self._hosts.pop(host, None) or _Circuit()
+            self._hosts[host] = circuit
+            while len(self._hosts) > self.maxhosts:
+                self._hosts.popitem(last=False)
+            circuit.failures += 1
+            if circuit.opened is not None: # a trial failed
+                circuit.opened = self.clock()
+                return
+            opening = circuit.failures >= self.threshold
+            if opening:
+                circuit.opened = self.clock()
+        if opening:
+            self.counters.incr('opened')
+            logger.warn('Circuit for %s opened after %d failures', host, circuit.failures)
+            self._publish(host, self.cooldown)
+            return
+        remaining = self._shared(host)
+        if remaining:
+            with self._lock:
+                if circuit.opened is None:
+                    circuit.opened = self.clock() - self.cooldown + remaining
+            self.counters.incr('opened_shared')
+            logger.warn('Circuit for %s opened, failing on other instances', host)
+
+    def _publish(self, host, secs):
+        if self.client is None:
+            return
+        try:
+            if secs:
+                self.client.set(host, self.wallclock() + secs, time=secs, namespace=self.namespace)
+            else:
+                self.client.delete(host, namespace=self.namespace)
+        except Exception as e:
+            logger.warn('Sharing circuit for %s in memcache failed: %r', host, e)
+
+    def _shared(self, host):
+        '''
+        Returns how long host's circuit stays open on other instances.
+        '''
+        if self.client is None:
+            return 0
+        try:
+            until = self.client.get(host, namespace=self.namespace)
+        except Exception as e:
+            logger.warn('Reading circuit for %s from memcache failed: %r', host, e)
+            return 0
+        return max(0, min(until - self.wallclock(), self.cooldown)) if until else 0
+
+    def remember(self, key, status, result):
+        '''
+        Remembers that fetching key (a url or host) failed for good, and was
+        answered with status and H_LAEPROXY_RESULT result.
+        '''
+        if not key:
+            return
+        with self._lock:
+            self._negative.pop(key, None)
+            self._negative[key] = (self.clock() + self.negttl, status, result)
+            while len(self._negative) > self.negmax:
+                self._negative.popitem(last=False)
+        self.counters.incr('negative_stored')
+
+    def negative(self, key):
+        '''
+        Returns the (status, result) remembered for key, or None.
+        '''
+        hit = self._negative.get(key)
+        if hit is None:
+            return None
+        if hit[0] <= self.clock():
+            with self._lock:
+                if self._negative.get(key) is hit:
+                    del self._negative[key]
+            return None
+        self.counters.incr('negative_hits')
+        return hit[1:]
+
+    def stats(self):
+        stats = self.counters.snapshot()
+        now = self.clock()
+        with self._lock:
+            stats['open_hosts'] = dict((host, max(0, round(circuit.opened + self.cooldown - now, 1)))
+                for host, circuit in self._hosts.items() if circuit.opened is not None)
+            stats['negative_keys'] = len(self._negative)
+        return stats
+
+
+class _Prefetch(object):
+    __slots__ = ('rpc', 'nbytes', 'expires', 'settled', 'result', 'error')
+
+    def __init__(self, nbytes, expires):
+        self.rpc = self.result = self.error = None
+        self.nbytes = nbytes
+        self.expires = expires
+        self.settled = False
+
+    def settle(self):
+        try:
+            self.result = self.rpc.get_result()
+        except Exception as e:
+            self.error = e
+        self.settled = True
+
+
+class Prefetcher(object):
+    '''
+    Fetches the next chunk ahead of clients downloading a url sequentially.
+
+    observe is told of each single range request a client makes for a url,
+    and if it starts where the client's last one for the url ended, returns
+    the next depth ranges of the same size, unless the first is already
+    being prefetched. So prefetches are made depth at a time, which is what
+    saves time when rpcs can't outlive the request that made them. The
+    caller has start fetch them, and each outcome is kept for up to ttl
+    seconds for claim to hand to the client's request for that range.
+    In-flight and unclaimed prefetches are limited to maxbytes in all,
+    counted as the bytes asked for until their responses are in and then
+    as the bytes those hold, and the sequences of up to maxstreams (client,
+    url) pairs are followed.
+
+    Urls found to be served ignoring Range headers, with the entire entity,
+    aren't prefetched for rangeless_ttl seconds (see ignores_ranges). Up to
+    maxstreams of them are remembered.
+
+    Unclaimed prefetches are counted as wasted once they expire.
+    '''
+
+    def __init__(self, depth=PREFETCH_DEPTH, maxbytes=PREFETCH_MAXBYTES, ttl=PREFETCH_TTL_SECS,
+            maxstreams=PREFETCH_MAX_STREAMS, rangeless_ttl=PREFETCH_RANGELESS_SECS, clock=monotonic):
+        self.depth = depth
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.maxstreams = maxstreams
+        self.rangeless_ttl = rangeless_ttl
+        self.clock = clock
+        self._streams = OrderedDict() # (client, url) -> end of last range, most recent last
+        self._prefetches = OrderedDict() # (client, url, start, end) -> _Prefetch, oldest first
+        self._rangeless = OrderedDict() # url -> until when it's not prefetched, most recent last
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.counters = Counters()
+
+    def observe(self, client, url, start, end, total=None):
+        '''
+        Records a request from client for bytes start through end of url, of
+        total bytes if known. Returns the (start, end) ranges to prefetch.
+        '''
+        key = client, url
+        with self._lock:
+            last = self._streams.pop(key, None)
+            self._streams[key] = end
+            while len(self._streams) > self.maxstreams:
+                self._streams.popitem(last=False)
+        if last is None or start != last + 1 or key + (end + 1, end + end - start + 1) in self._prefetches:
+            return []
+        size = end - start + 1
+        ranges = [(i, i + size - 1) for i in range(end + 1, end + 1 + size * self.depth, size)]
+        # ends past total are left as the client would send them
+        return [(i, j) for i, j in ranges if total is None or i < total]
+
+    def ignores_ranges(self, url):
+        '''
+        Records that a range request for url was answered with the entire
+        entity, so prefetching it would fetch that again for each range.
+        '''
+        with self._lock:
+            self._rangeless.pop(url, None)
+            self._rangeless[url] = self.clock() + self.rangeless_ttl
+            while len(self._rangeless) > self.maxstreams:
+                self._rangeless.popitem(last=False)
+
+    def ranges_ignored(self, url):
+        '''
+        Returns whether range requests for url were recently answered with
+        the entire entity.
+        '''
+        return self._rangeless.get(url, 0) > self.clock()
+
+    def start(self, key, nbytes, fetch):
+        '''
+        Prefetches nbytes for key (client, url, start, end) with the rpc
+        fetch() starts, unless that would go over budget, url is served
+        ignoring ranges, or it's already being prefetched. Returns whether
+        it did.
+        '''
+        # count what's come in so far by its actual size
+        with self._lock:
+            prefetches = list(self._prefetches.items())
+        for pending, prefetch in prefetches:
+            if not prefetch.settled and prefetch.rpc is not None and getattr(prefetch.rpc, 'done', lambda: False)():
+                self._settle(pending, prefetch)
+        now = self.clock()
+        with self._lock:
+            self._expire(now)
+            if key in self._prefetches:
+                return False
+            if self._rangeless.get(key[1], 0) > now:
+                self.counters.incr('skipped_rangeless')
+                return False
+            if self._bytes + nbytes > self.maxbytes:
+                self.counters.incr('over_budget')
+                return False
+            prefetch = self._prefetches[key] = _Prefetch(nbytes, now + self.ttl)
+            self._bytes += nbytes
+        try:
+            prefetch.rpc = fetch()
+        except Exception as e:
+            logger.warn('Prefetching %s failed: %r', key[1:], e)
+            self._drop(key)
+            return False
+        self.counters.incr('started')
+        return True
+
+    def settle(self, key):
+        '''
+        Waits for the prefetch for key to complete, so that it can be
+        claimed without waiting on its rpc.
+        '''
+        prefetch = self._prefetches.get(key)
+        if prefetch is not None and prefetch.rpc is not None and not prefetch.settled:
+            self._settle(key, prefetch)
+
+    def _settle(self, key, prefetch):
+        '''
+        Waits for prefetch's rpc, then counts it against the budget by the
+        bytes it actually got rather than asked for, and notes if its url was
+        served ignoring the range.
+        '''
+        prefetch.settle()
+        result = prefetch.result
+        if result is None:
+            return
+        if result.status_code == 200:
+            self.ignores_ranges(key[1])
+        with self._lock:
+            if self._prefetches.get(key) is prefetch:
+                self._bytes += len(result.content) - prefetch.nbytes
+                prefetch.nbytes = len(result.content)
+
+    def claim(self, key, wait=False):
+        '''
+        Returns the result of the prefetch for key and forgets it, or None if
+        there's none or it failed. Only waits for one still in flight if
+        wait, otherwise leaves it to be settled.
+        '''
+        with self._lock:
+            prefetch = self._prefetches.get(key)
+            if prefetch is None or prefetch.rpc is None or not (prefetch.settled or wait):
+                return None
+            del self._prefetches[key]
+            self._bytes -= prefetch.nbytes
+        if not prefetch.settled:
+            self._settle(key, prefetch)
+        if prefetch.error is not None:
+            logger.debug('Prefetch of %s failed: %r', key[1:], prefetch.error)
+            self.counters.incr('failed')
+            return None
+        self.counters.incr('hits')
+        self.counters.incr('hit_bytes', len(prefetch.result.content))
+        return prefetch.result
+
+    def _drop(self, key):
+        with self._lock:
+            prefetch = self._prefetches.pop(key, None)
+            if prefetch is not None:
+                self._bytes -= prefetch.nbytes
+
+    def _expire(self, now):
+        while self._prefetches:
+            key, prefetch = next(iter(self._prefetches.items()))
+            if prefetch.expires > now:
+                break
+            del self._prefetches[key]
+            self._bytes -= prefetch.nbytes
+            self.counters.incr('wasted')
+            self.counters.incr('wasted_bytes', prefetch.nbytes)
+            if not prefetch.settled:
+                getattr(prefetch.rpc, 'discard', lambda: None)()
+
+    def stats(self):
+        now = self.clock()
+        with self._lock:
+            self._expire(now)
+            stats = self.counters.snapshot()
+            stats['pending'] = len(self._prefetches)
+            stats['pending_bytes'] = self._bytes
+            stats['streams'] = len(self._streams)
+            stats['rangeless_urls'] = sum(1 for until in self._rangeless.values() if until > now)
+        started = stats.get('started', 0)
+        stats['hit_rate'] = round(float(stats.get('hits', 0)) / started, 4) if started else 0
+        return stats
@@ -0,0 +1,199 @@
+'''
+Request validation and response helpers shared by laeproxy's request
+handlers (laeproxy.py) and its ASGI app (asgi.py).
+'''
+
+try:
+    from urllib import unquote
+    from urlparse import urljoin, urlsplit, urlunsplit
+except ImportError: # python 3
+    from urllib.parse import unquote, urljoin, urlsplit, urlunsplit
+
+from datetime import datetime
+
+import logging
+
+from constants import *
+
+logger = logging.getLogger('laeproxy')
+
+now = datetime.utcnow
+
+
+class Rejected(Exception):
+    '''
+    Raised for requests we refuse to forward upstream. status is the status
+    code to respond with and result the value for H_LAEPROXY_RESULT.
+    '''
+
+    def __init__(self, status, result):
+        Exception.__init__(self, result)
+        self.status = status
+        self.result = result
+
+
+def target_url(path_qs, reqhost):
+    '''
+    Reconstructs the original url from a request path of the form
+    /<scheme>/<host>/<rest>. Returns (url, scheme, host).
+    '''
+    path = path_qs.lstrip('/')
+    try:
+        scheme, rest = path.split('/', 1)
+        parts = rest.split('/', 1)
+    except ValueError:
+        logger.debug('Invalid url: %s', path)
+        raise Rejected(404, 'Invalid url')
+    try:
+        rest = parts[1]
+    except IndexError:
+        rest = ''
+    host = unquote(parts[0])
+    if not host:
+        logger.debug('No host specified: %s', path)
+        raise Rejected(404, 'Missing host')
+    if reqhost.lower() == host.lower():
+        logger.info('Ignoring recursive request: %s', path)
+        raise Rejected(404, IGNORED_RECURSIVE)
+    url = scheme + '://' + host + '/' + rest
+    logger.debug('Target url: %s', url)
+    return url, scheme, host
+
+
+def redirect_limit(value):
+    '''
+    Returns the number of redirects to follow for a request whose
+    H_FOLLOW_REDIRECTS header is value (None if absent): as many as it
+    says, or REDIRECT_FOLLOW_MAX if it's not a number, at most
+    REDIRECT_FOLLOW_MAX.
+    '''
+    if value is None:
+        return 0
+    try:
+        limit = int(value)
+    except ValueError:
+        limit = REDIRECT_FOLLOW_MAX
+    return max(0, min(limit, REDIRECT_FOLLOW_MAX))
+
+
+def redirect_target(url, location, reqhost):
+    '''
+    Returns (url, scheme, host) for where a redirect from url to Location
+    header value location points, or None if we shouldn't follow it: if
+    it's not to an http(s) url, or back at us (reqhost).
+    '''
+    try:
+        parts = urlsplit(urljoin(url, location.strip()))
+    except ValueError:
+        return None
+    scheme, host = parts.scheme.lower(), parts.netloc
+    if scheme not in ('http', 'https') or not host or host.lower() == reqhost.lower():
+        logger.debug('Not following redirect from %s to %s', url, location)
+        return None
+    target = urlunsplit((scheme, host, parts.path or '/', parts.query, ''))
+    return target, scheme, host
+
+
+def check_payload(payload):
+    if payload and len(payload) >= URLFETCH_REQ_MAXBYTES:
+        raise Rejected(400, REQ_TOO_LARGE)
+
+
+def check_ranges(ranges, fanout=False):
+    '''
+    Checks the (start, end) pairs of a Range header, parsed the way webob
+    does (uninclusive end, None if open-ended), against the limits in
+    constants.py. fanout says whether the client opted in to ranges over
+    RANGE_REQ_SIZE.
+
+    Returns the ranges with inclusive ends, and whether to fan out.
+    '''
+    if not ranges:
+        logger.debug('No upstream range header')
+        raise Rejected(400, 'Missing or invalid range header')
+    if len(ranges) > MULTIRANGE_MAX_PARTS:
+        logger.debug('%d ranges requested', len(ranges))
+        raise Rejected(400, 'At most %d ranges supported' % MULTIRANGE_MAX_PARTS)
+    if any(start is None or end is None for start, end in ranges):
+        logger.debug('Expected range header of the form bytes=x-y')
+        raise Rejected(400, 'Range must be of the form bytes=x-y')
+    ranges = [(start, end - 1) for start, end in ranges] # webob uses uninclusive end, we use inclusive
+    fanout = fanout and len(ranges) == 1
+    for range_start, range_end in ranges:
+        if not (0 <= range_start <= range_end):
+            logger.debug('Range must satisfy 0 <= range_start <= range_end')
+            raise Rejected(416, 'Range must satisfy 0 <= range_start <= range_end')
+        nbytes_requested = range_end - range_start + 1
+        fanout = fanout and nbytes_requested > RANGE_REQ_SIZE
+        maxbytes = FANOUT_MAXBYTES if fanout else RANGE_REQ_SIZE
+        if nbytes_requested > maxbytes:
+            logger.warn('Range specifies %d bytes, limit is %d', nbytes_requested, maxbytes)
+            raise Rejected(400, 'Range specifies %d bytes, limit is %d' % (nbytes_requested, maxbytes))
+    nbytes_requested = sum(end - start + 1 for start, end in ranges)
+    if nbytes_requested > FANOUT_MAXBYTES:
+        logger.warn('Ranges specify %d bytes, limit is %d', nbytes_requested, FANOUT_MAXBYTES)
+        raise Rejected(400, 'Ranges specify %d bytes, limit is %d' % (nbytes_requested, FANOUT_MAXBYTES))
+    return ranges, fanout
+
+
+def strip_headers(reqheaders):
+    '''
+    Removes the request headers that should not be forwarded upstream.
+    Returns the (name, value) pairs removed.
+    '''
+    ignoreheaders = conn_header_set(reqheaders) | IGNOREHEADERS
+    return [(i, reqheaders.pop(i)) for i in ignoreheaders if i in reqheaders]
+
+
+def conn_header_set(headers):
+    conn_header = headers.get('connection', '').lower()
+    stripped = (i.strip() for i in conn_header.split(','))
+    return frozenset(filter(None, stripped) if conn_header else ())
+
+
+def absolute_location(loc, scheme, host):
+    '''
+    Returns Location header value loc made absolute if it is relative (#14),
+    otherwise None.
+    '''
+    if loc and not loc.startswith('http'):
+        path = loc if loc.startswith('/') else '/' + loc
+        return scheme + '://' + host + path
+
+
+def copy_headers(frm, to, ignore):
+    '''
+    Copies the headers in frm not named in ignore to to. Returns the
+    (name, value) pairs left out.
+    '''
+    ignored = []
+    for k, v in frm.items():
+        if ignore and k.lower() not in ignore:
+            to[k] = v
+        else:
+            ignored.append((k, v))
+    return ignored
+
+
+def error_result(url, e, host, invalid=(), notfound=(), failed=(), overquota=()):
+    '''
+    Returns the status code and H_LAEPROXY_RESULT to respond with when
+    fetching url from host raised e, given the exception classes the
+    backend raises for an invalid url, an unknown host, a failed or timed
+    out fetch and an exhausted quota.
+    '''
+    if isinstance(e, invalid):
+        logger.debug('InvalidURLError: %s', url)
+        return 404, 'Invalid url'
+    if isinstance(e, notfound):
+        logger.warn('Upstream host %s not found', host)
+        return 502, UPSTREAM_NOT_FOUND
+    if isinstance(e, failed):
+        logger.warn(MISSED_DEADLINE_URLFETCH)
+        return 504, MISSED_DEADLINE_URLFETCH
+    if isinstance(e, overquota):
+        logger.warn(EXCEEDED_URLFETCH_QUOTA)
+        return 503, EXCEEDED_URLFETCH_QUOTA
+    logger.error('Unexpected error: %s', e)
+    logger.debug('Unexpected error details', exc_info=True)
+    return 500, UNEXPECTED_ERROR % e
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+'''
+WSGI entry point for running laeproxy outside App Engine, fetching through
+backend.PooledBackend. Needs webapp2 (pip install webapp2 webob), and runs
+under any WSGI server, e.g. one process per core with::
+
+    gunicorn --workers 4 --threads 16 wsgi:application
+
+or for local testing (e.g. with test.py, setting cluster_hostname in
+gaedriver.conf to match)::
+
+    python wsgi.py [port]
+
+Each process keeps its own connection pools and caches, and there is no
+memcache tier.
+'''
+
+try:
+    from socketserver import ThreadingMixIn
+except ImportError: # python 2
+    from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, make_server
+
+import sys
+
+from laeproxy import app as application
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+def main(port=8080):
+    server = make_server('', int(port), application, server_class=ThreadingWSGIServer)
+    print('laeproxy listening on port %d' % server.server_port)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])